@@ -0,0 +1,82 @@
+"""
+Offline stand-ins for the LLM and the embedding model.
+
+Both are deterministic and sleep for a configurable latency, so the
+pipeline around them can be measured without network access and with
+repeatable numbers.
+"""
+
+import asyncio
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from utils.embeddings import HashingEmbeddings
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering after `latency` seconds (time to first token) and
+    streaming `answer_tokens` words `token_latency` seconds apart.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    answer_tokens: int = 20
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def _tokens(self, messages):
+        # Deterministic answer built from the words of the prompt
+        words = " ".join(str(message.content) for message in messages).split() or ["answer"]
+        return [f"{words[i % len(words)]} " for i in range(self.answer_tokens)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency + self.token_latency * self.answer_tokens)
+        message = AIMessage(content="".join(self._tokens(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency + self.token_latency * self.answer_tokens)
+        message = AIMessage(content="".join(self._tokens(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for token in self._tokens(messages):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for token in self._tokens(messages):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class SlowHashingEmbeddings(HashingEmbeddings):
+    """
+    Local hashing embeddings that take `latency` seconds per call, like a
+    remote embedding API answering one batch per round trip.
+    """
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.model_name = f"{self.model_name}-benchmark"
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return super().embed_query(text)
+
+    def embed_queries(self, texts):
+        time.sleep(self.latency)
+        return super().embed_queries(texts)
@@ -0,0 +1,335 @@
+"""
+End-to-end benchmarks of the upload and question-answering pipeline.
+
+The FastAPI app runs in-process with the offline stand-ins from
+`benchmarks.fakes` in place of the LLM and the embedding model, so runs
+need no network and are repeatable. Measured:
+
+- upload throughput (documents, pages and MB per second, including
+  background extraction and indexing),
+- extraction time per page,
+- index build time,
+- WebSocket question latency (p50/p95/p99) at increasing concurrency.
+
+Results are written as JSON so runs can be compared:
+
+    python -m benchmarks.run --output benchmark_results.json
+
+Unless `DATABASE_URL` is set, the run uses a throwaway SQLite database in
+its working directory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+@dataclass
+class BenchmarkConfig:
+    documents: int = 8
+    pages: int = 20
+    upload_concurrency: int = 4
+    extraction_pages: int = 200
+    index_pages: int = 200
+    concurrency: list = field(default_factory=lambda: [1, 4, 16])
+    questions: int = 5
+    llm_latency: float = 0.2
+    token_latency: float = 0.0
+    embedding_latency: float = 0.05
+
+
+WORDS = (
+    "project experience engineer python data pipeline latency service design team "
+    "customer report analysis model training deployment cloud database security"
+).split()
+
+
+def make_page_text(seed, page_number, words=300):
+    rng = np.random.default_rng(seed * 100_003 + page_number)
+    body = " ".join(WORDS[i] for i in rng.integers(0, len(WORDS), words))
+    return f"Document {seed} page {page_number}. {body}."
+
+
+def make_pdf(seed, pages):
+    """Build a PDF of `pages` pages of text whose bytes are unique to `seed`."""
+    import fitz
+
+    doc = fitz.open()
+    for page_number in range(pages):
+        text = make_page_text(seed, page_number)
+        doc.new_page().insert_textbox(fitz.Rect(40, 40, 560, 800), text, fontsize=9)
+    return doc.tobytes()
+
+
+def summarize(latencies):
+    latencies = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "count": int(len(latencies)),
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(latencies.max()),
+    }
+
+
+@contextmanager
+def offline_stack(workdir, config):
+    """
+    Point the app at `workdir` and swap the LLM and embedding model for the
+    fakes, restoring everything afterwards.
+    """
+    import main
+    from benchmarks.fakes import FakeChatModel, SlowHashingEmbeddings
+    from utils import embedding_cache, nlp2
+
+    llm = FakeChatModel(latency=config.llm_latency, token_latency=config.token_latency)
+    embeddings = SlowHashingEmbeddings(latency=config.embedding_latency)
+    patches = [
+        (nlp2, "VECTOR_INDEX_DIRECTORY", os.path.join(workdir, "vector_index")),
+        (nlp2, "get_embeddings", lambda: embedding_cache.with_embedding_cache(embeddings)),
+        (nlp2, "get_llm_router", lambda: llm),
+        (embedding_cache, "EMBEDDING_CACHE_DIRECTORY", os.path.join(workdir, "embedding_cache")),
+        (main, "UPLOAD_DIRECTORY", os.path.join(workdir, "pdf_uploads")),
+        # Every question is new, so measure the pipeline rather than the cache
+        (nlp2.answer_cache, "similarity_threshold", 0.0),
+    ]
+    originals = [(target, name, getattr(target, name)) for target, name, _ in patches]
+    os.makedirs(os.path.join(workdir, "pdf_uploads"), exist_ok=True)
+    for target, name, value in patches:
+        setattr(target, name, value)
+    nlp2.qa_chain_cache.clear()
+    nlp2.answer_cache.clear()
+    try:
+        yield
+    finally:
+        for target, name, value in originals:
+            setattr(target, name, value)
+        nlp2.qa_chain_cache.clear()
+        nlp2.answer_cache.clear()
+
+
+async def bench_extraction(workdir, config):
+    from utils.extraction import extract_pdf_pages
+
+    path = os.path.join(workdir, "extraction.pdf")
+    with open(path, "wb") as f:
+        f.write(make_pdf(0, config.extraction_pages))
+    # Start the worker processes before timing
+    await extract_pdf_pages(path)
+
+    start = time.perf_counter()
+    pages = await extract_pdf_pages(path)
+    elapsed = time.perf_counter() - start
+    return {
+        "pages": len(pages),
+        "seconds": elapsed,
+        "ms_per_page": elapsed / len(pages) * 1000,
+    }
+
+
+def bench_index(config):
+    from utils.nlp2 import index_document
+
+    pages = [make_page_text(1, page_number) for page_number in range(config.index_pages)]
+    start = time.perf_counter()
+    chunks = index_document(uuid.uuid4().hex, pages)
+    elapsed = time.perf_counter() - start
+    return {
+        "pages": len(pages),
+        "chunks": len(chunks),
+        "seconds": elapsed,
+        "chunks_per_second": len(chunks) / elapsed,
+    }
+
+
+async def bench_uploads(user_id, config):
+    from httpx import AsyncClient
+
+    from database.config import async_engine
+    from main import app
+
+    pdfs = [make_pdf(uuid.uuid4().int % 10**9, config.pages) for _ in range(config.documents)]
+    semaphore = asyncio.Semaphore(config.upload_concurrency)
+
+    async with AsyncClient(app=app, base_url="http://benchmark") as client:
+        async def upload(index, data):
+            async with semaphore:
+                files = {"file": (f"benchmark-{index}.pdf", data, "application/pdf")}
+                response = await client.post("/upload-pdf/", params={"user_id": user_id}, files=files)
+                response.raise_for_status()
+                # In-process, background processing finishes with the request
+                job_id = response.json()["job_id"]
+                status = (await client.get(f"/upload-pdf/status/{job_id}")).json()["status"] if job_id else "done"
+                if status != "done":
+                    raise RuntimeError(f"Upload {index} ended with status {status}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(upload(index, data) for index, data in enumerate(pdfs)))
+        elapsed = time.perf_counter() - start
+    await async_engine.dispose()
+
+    megabytes = sum(map(len, pdfs)) / 1024 / 1024
+    return {
+        "documents": len(pdfs),
+        "pages": len(pdfs) * config.pages,
+        "megabytes": megabytes,
+        "seconds": elapsed,
+        "documents_per_second": len(pdfs) / elapsed,
+        "pages_per_second": len(pdfs) * config.pages / elapsed,
+        "megabytes_per_second": megabytes / elapsed,
+    }
+
+
+def bench_questions(user_id, config):
+    from fastapi.testclient import TestClient
+
+    from main import app
+
+    def ask(client, socket_number, concurrency):
+        latencies, rejected = [], 0
+        with client.websocket_connect(f"/ws/question-answer?user_id={user_id}") as websocket:
+            for question_number in range(config.questions):
+                question = f"Which project used python? ({concurrency}/{socket_number}/{question_number})"
+                start = time.perf_counter()
+                websocket.send_text(json.dumps({"type": "question", "content": question}))
+                frame = json.loads(websocket.receive_text())
+                while frame["type"] == "queued":
+                    frame = json.loads(websocket.receive_text())
+                if frame["type"] == "busy":
+                    rejected += 1
+                else:
+                    latencies.append(time.perf_counter() - start)
+        return latencies, rejected
+
+    results = {}
+    with TestClient(app) as client:
+        for concurrency in config.concurrency:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = list(pool.map(lambda n: ask(client, n, concurrency), range(concurrency)))
+            elapsed = time.perf_counter() - start
+            latencies = sum((latencies for latencies, _ in outcomes), [])
+            results[str(concurrency)] = {
+                **(summarize(latencies) if latencies else {"count": 0}),
+                # Questions refused by admission control with a busy frame
+                "rejected": sum(rejected for _, rejected in outcomes),
+                "seconds": elapsed,
+                "questions_per_second": len(latencies) / elapsed,
+            }
+    return results
+
+
+def delete_benchmark_documents(user_id):
+    from database.config import session_scope
+    from database.models import PDFChunk, PDFDocument, PDFPage
+
+    with session_scope() as db:
+        documents = db.query(PDFDocument).filter_by(user_id=user_id)
+        content_hashes = {pdf.content_hash for pdf in documents}
+        for model in (PDFPage, PDFChunk):
+            db.query(model).filter(model.content_hash.in_(content_hashes)).delete()
+        documents.delete()
+        db.commit()
+
+
+def run_benchmarks(config, workdir):
+    """Run every benchmark with `config` inside `workdir` and return the results."""
+    from utils.extraction import shutdown_process_pool
+
+    user_id = uuid.uuid4().int % 10**9
+    results = {}
+    with offline_stack(workdir, config):
+        try:
+            results["extraction"] = asyncio.run(bench_extraction(workdir, config))
+            results["index"] = bench_index(config)
+            results["upload"] = asyncio.run(bench_uploads(user_id, config))
+            results["questions"] = bench_questions(user_id, config)
+        finally:
+            delete_benchmark_documents(user_id)
+            shutdown_process_pool()
+    return results
+
+
+def print_summary(results):
+    print(f"extraction: {results['extraction']['ms_per_page']:.2f} ms/page")
+    print(f"index:      {results['index']['chunks_per_second']:.0f} chunks/s")
+    print(f"upload:     {results['upload']['documents_per_second']:.2f} docs/s, "
+          f"{results['upload']['pages_per_second']:.1f} pages/s")
+    for concurrency, stats in results["questions"].items():
+        if not stats["count"]:
+            print(f"questions x{concurrency}: all {stats['rejected']} rejected")
+            continue
+        print(f"questions x{concurrency}: p50 {stats['p50_ms']:.0f} ms, p95 {stats['p95_ms']:.0f} ms, "
+              f"p99 {stats['p99_ms']:.0f} ms, {stats['questions_per_second']:.1f} q/s, "
+              f"{stats['rejected']} rejected")
+
+
+def main(argv=None):
+    defaults = BenchmarkConfig()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--documents", type=int, default=defaults.documents)
+    parser.add_argument("--pages", type=int, default=defaults.pages)
+    parser.add_argument("--upload-concurrency", type=int, default=defaults.upload_concurrency)
+    parser.add_argument("--extraction-pages", type=int, default=defaults.extraction_pages)
+    parser.add_argument("--index-pages", type=int, default=defaults.index_pages)
+    parser.add_argument("--concurrency", default=",".join(map(str, defaults.concurrency)),
+                        help="comma separated numbers of concurrent WebSockets")
+    parser.add_argument("--questions", type=int, default=defaults.questions, help="questions per WebSocket")
+    parser.add_argument("--llm-latency", type=float, default=defaults.llm_latency)
+    parser.add_argument("--token-latency", type=float, default=defaults.token_latency)
+    parser.add_argument("--embedding-latency", type=float, default=defaults.embedding_latency)
+    args = parser.parse_args(argv)
+
+    config = BenchmarkConfig(
+        documents=args.documents,
+        pages=args.pages,
+        upload_concurrency=args.upload_concurrency,
+        extraction_pages=args.extraction_pages,
+        index_pages=args.index_pages,
+        concurrency=[int(level) for level in args.concurrency.split(",")],
+        questions=args.questions,
+        llm_latency=args.llm_latency,
+        token_latency=args.token_latency,
+        embedding_latency=args.embedding_latency,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        # Must be set before the app (and its database engine) is imported
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+        os.environ.setdefault("EMBEDDING_BACKEND", "local")
+        started_at = datetime.now(timezone.utc).isoformat()
+        results = run_benchmarks(config, workdir)
+
+    report = {
+        "started_at": started_at,
+        "config": asdict(config),
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_summary(results)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,32 +5,199 @@ It creates the database tables if they don't exist and sets up
 the session maker for the database connection.
 """
 
-from sqlalchemy import create_engine
+from contextlib import asynccontextmanager, contextmanager
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from database.models import Base
+from database.models import Base, backfill_content_hashes, backfill_pdf_pages
+from utils.metrics import record_stage
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv('.env')
 
+# Connection pool settings for server databases: connections kept open,
+# extra connections allowed under bursts, seconds to wait for a free one,
+# and age in seconds after which a connection is replaced (servers drop
+# idle connections)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Milliseconds a SQLite connection waits for a lock before failing
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+
+SQLITE_FALLBACK_URL = "sqlite:///./database.db"
+
+# Async driver used for each database backend by the request handlers
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run while an upload is being written
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# Every statement of every engine (sync and async) is timed as `db_query`
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, "query_started_at", None)
+    if started_at is not None:
+        record_stage("db_query", time.perf_counter() - started_at)
+
+
+def create_database_engine(url):
+    """
+    Create the engine for `url` with pooling tuned for many concurrent
+    requests. SQLite files get WAL mode and pragmas on every connection.
+    """
+    if url.startswith("sqlite"):
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT / 1000},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+        event.listen(engine, "connect", set_sqlite_pragmas)
+        return engine
+    return create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+def get_async_database_url(url):
+    """Return `url` with its driver swapped for the backend's async driver."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for database backend {backend!r}")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def create_async_database_engine(url):
+    """
+    Create the asyncio engine for `url`, pooled and configured like the
+    sync engine from `create_database_engine`.
+    """
+    url = get_async_database_url(url)
+    if url.get_backend_name() == "sqlite":
+        engine = create_async_engine(
+            url,
+            connect_args={"timeout": SQLITE_BUSY_TIMEOUT / 1000},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+        return engine
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
 # The database URL is either the environment variable
 # DATABASE_URL or a default SQLite database
 DATABASE_URL = os.getenv('DATABASE_URL')
 try:
     # Try to create the engine with the DATABASE_URL
-    engine = create_engine(DATABASE_URL)
-    # Test the connection
-    engine.connect()
+    engine = create_database_engine(DATABASE_URL)
+    # Test the connection, returning it to the pool straight away
+    with engine.connect():
+        pass
 except Exception as e:
     print(f"Failed to connect to {DATABASE_URL}: {str(e)}")
     print("Falling back to local SQLite database")
     # Fall back to local SQLite database
-    DATABASE_URL = "sqlite:///./database.db"
-    engine = create_engine(DATABASE_URL)
+    DATABASE_URL = SQLITE_FALLBACK_URL
+    engine = create_database_engine(DATABASE_URL)
 
-# Create the session maker
+# Create the session makers: sync sessions for scripts and startup work,
+# async sessions for request handlers so queries never block the event loop
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_database_engine(DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+@contextmanager
+def session_scope():
+    """
+    Session for one unit of database work. Its connection goes back to the
+    pool as soon as the block exits, so callers that live long (such as
+    WebSockets) hold a connection only while they actually query.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """Async counterpart of `session_scope` for code running on the event loop."""
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
+
+
+def add_missing_columns(engine):
+    """
+    Add columns (and their indexes) introduced after a table was first
+    created, since `create_all` only creates tables that are missing.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        with engine.begin() as conn:
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 
 # Create the database tables if they don't exist
 Base.metadata.create_all(bind=engine)
+add_missing_columns(engine)
+
+with session_scope() as db:
+    backfill_content_hashes(db)
+    backfill_pdf_pages(db)
 
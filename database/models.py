@@ -1,7 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, Text, Index, delete, func, select, tuple_, update
+from sqlalchemy.orm import declarative_base, deferred
 from datetime import datetime
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import hashlib
+
+from utils.chunking import count_tokens
+from utils.extraction import PAGE_SEPARATOR
 
 Base = declarative_base()
 
@@ -18,19 +23,255 @@ class PDFDocument(Base):
     # The date and time the file was uploaded, defaulting to the current time
     upload_date = Column(DateTime, default=datetime.utcnow)
 
-    # Stores extracted text content
-    content = Column(Text) 
+    # Extracted text of documents stored before pages were split out into
+    # `pdf_pages`; moved there at startup and left empty afterwards. Deferred
+    # so loading a document never pulls the body unless asked for
+    content = deferred(Column(Text))
+
+    # SHA-256 of the uploaded bytes; identical files share extracted text,
+    # chunks and embeddings through it
+    content_hash = Column(String(64), index=True)
+
+    # Number of extracted pages in `pdf_pages`; NULL until extraction is done
+    page_count = Column(Integer)
+
+    # True once the content is known to be in the vector and keyword
+    # indexes; NULL for documents stored before indexing existed, which are
+    # checked (and indexed if need be) once, when first asked about
+    indexed = Column(Boolean)
     
     # Add user_id to associate with each user
     user_id = Column(Integer, index=True)  
 
+    # Serves a user's documents newest first, including keyset pagination,
+    # straight from the index
+    __table_args__ = (
+        Index("ix_pdf_documents_user_upload", "user_id", "upload_date", "id"),
+    )
+
+
+class PDFPage(Base):
+    """
+    Extracted text of one page, shared by every PDF with the same bytes.
+    """
+    __tablename__ = "pdf_pages"
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    # 1-based page number
+    page_number = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+
+    __table_args__ = (
+        Index("ix_pdf_pages_content_hash_page", "content_hash", "page_number", unique=True),
+    )
+
+
+class PDFChunk(Base):
+    """
+    One indexed chunk of a document, in the order it was added to the
+    vector index (its vector id is `<content_hash>-<chunk_index>`).
+    """
+    __tablename__ = "pdf_chunks"
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    chunk_index = Column(Integer, nullable=False)
+    page_number = Column(Integer, nullable=False)
+    # Character offset of the chunk within its page
+    start_offset = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_pdf_chunks_content_hash_chunk", "content_hash", "chunk_index", unique=True),
+    )
+
+
+def make_pdf_pages(content_hash, pages):
+    # Rows for the text of each page, in order
+    return [
+        PDFPage(content_hash=content_hash, page_number=page_number, text=text)
+        for page_number, text in enumerate(pages, start=1)
+    ]
+
+
+def make_pdf_chunks(content_hash, chunks):
+    # Rows for split documents tagged with `page` and `start_index` metadata
+    return [
+        PDFChunk(
+            content_hash=content_hash,
+            chunk_index=chunk_index,
+            page_number=chunk.metadata.get("page", 1),
+            start_offset=chunk.metadata.get("start_index", 0),
+            text=chunk.page_content,
+            token_count=chunk.metadata.get("token_count") or count_tokens(chunk.page_content),
+        )
+        for chunk_index, chunk in enumerate(chunks)
+    ]
+
+
+# Each query is built once as a statement, so the sync functions (scripts,
+# startup) and their async variants (request handlers) cannot drift apart.
+# Listings select columns explicitly and never load page or chunk text.
+
+def pdf_documents_for_user_query(user_id: int):
+    # (id, content_hash) of every PDF of this user whose text has been
+    # extracted, newest first
+    return (
+        select(PDFDocument.id, PDFDocument.content_hash)
+        .where(PDFDocument.user_id == user_id, PDFDocument.page_count.isnot(None))
+        .order_by(PDFDocument.upload_date.desc(), PDFDocument.id.desc())
+    )
+
+
+def unindexed_content_hashes_for_user_query(user_id: int):
+    # Content hashes of this user's extracted PDFs not yet known to be indexed
+    return (
+        select(PDFDocument.content_hash)
+        .where(
+            PDFDocument.user_id == user_id,
+            PDFDocument.page_count.isnot(None),
+            PDFDocument.indexed.isnot(True),
+        )
+        .distinct()
+    )
+
+
+# Metadata returned by document listings
+PDF_DOCUMENT_FIELDS = (
+    PDFDocument.id,
+    PDFDocument.filename,
+    PDFDocument.upload_date,
+    PDFDocument.content_hash,
+    PDFDocument.page_count,
+)
+
+
+def pdf_document_page_query(user_id: int, limit: int, after=None):
+    # Up to `limit` documents of this user, newest first, continuing after
+    # the (upload_date, id) of the last document of the previous page
+    query = select(*PDF_DOCUMENT_FIELDS).where(PDFDocument.user_id == user_id)
+    if after is not None:
+        query = query.where(tuple_(PDFDocument.upload_date, PDFDocument.id) < tuple_(*after))
+    return query.order_by(PDFDocument.upload_date.desc(), PDFDocument.id.desc()).limit(limit)
+
+
+def pdf_document_query(user_id: int, document_id: int):
+    # Metadata of one document, if it belongs to this user
+    return select(*PDF_DOCUMENT_FIELDS).where(PDFDocument.id == document_id, PDFDocument.user_id == user_id)
+
+
+def pdf_pages_by_hash_query(content_hash: str):
+    # Text of each page shared by every PDF with these bytes, in page order
+    return (
+        select(PDFPage.text)
+        .where(PDFPage.content_hash == content_hash)
+        .order_by(PDFPage.page_number)
+    )
+
+
 def get_pdf_content_for_user(db: Session, user_id: int):
-    # Fetch content of PDFs associated with this user
-    result = db.query(PDFDocument.content).filter(PDFDocument.user_id == user_id).all()
-    # Fetch content of the most recent PDF
-    result = (
-        db.query(PDFDocument.content)
-        .order_by(PDFDocument.upload_date.desc())
-        .first()
-    )
-    return result.content if result else None
\ No newline at end of file
+    # Text of the most recent PDF associated with this user
+    document = db.execute(pdf_documents_for_user_query(user_id).limit(1)).first()
+    if document is None:
+        return None
+    return PAGE_SEPARATOR.join(get_pdf_pages_by_hash(db, document.content_hash))
+
+
+def get_pdf_documents_for_user(db: Session, user_id: int):
+    return db.execute(pdf_documents_for_user_query(user_id)).all()
+
+
+def get_pdf_pages_by_hash(db: Session, content_hash: str):
+    return db.execute(pdf_pages_by_hash_query(content_hash)).scalars().all()
+
+
+async def get_pdf_documents_for_user_async(db: AsyncSession, user_id: int):
+    return (await db.execute(pdf_documents_for_user_query(user_id))).all()
+
+
+async def get_unindexed_content_hashes_for_user_async(db: AsyncSession, user_id: int):
+    return (await db.execute(unindexed_content_hashes_for_user_query(user_id))).scalars().all()
+
+
+async def mark_pdf_documents_indexed_async(db: AsyncSession, content_hashes):
+    # Flag every document sharing these contents, of any user
+    await db.execute(
+        update(PDFDocument).where(PDFDocument.content_hash.in_(list(content_hashes))).values(indexed=True)
+    )
+
+
+async def list_pdf_documents_async(db: AsyncSession, user_id: int, limit: int, after=None):
+    return (await db.execute(pdf_document_page_query(user_id, limit, after))).all()
+
+
+async def get_pdf_document_async(db: AsyncSession, user_id: int, document_id: int):
+    return (await db.execute(pdf_document_query(user_id, document_id))).first()
+
+
+async def get_pdf_pages_by_hash_async(db: AsyncSession, content_hash: str):
+    return (await db.execute(pdf_pages_by_hash_query(content_hash))).scalars().all()
+
+
+async def replace_pdf_pages_async(db: AsyncSession, content_hash: str, pages):
+    # Store the extracted pages of a document, dropping any older extraction
+    await db.execute(delete(PDFPage).where(PDFPage.content_hash == content_hash))
+    db.add_all(make_pdf_pages(content_hash, pages))
+
+
+async def replace_pdf_chunks_async(db: AsyncSession, content_hash: str, chunks):
+    # Store the chunks a document was indexed as, dropping the previous ones
+    await db.execute(delete(PDFChunk).where(PDFChunk.content_hash == content_hash))
+    db.add_all(make_pdf_chunks(content_hash, chunks))
+
+
+async def count_pdf_documents_by_hash_async(db: AsyncSession, content_hash: str):
+    # Number of documents, of any user, whose content is this hash
+    return (await db.execute(
+        select(func.count()).select_from(PDFDocument).where(PDFDocument.content_hash == content_hash)
+    )).scalar()
+
+
+async def delete_pdf_content_async(db: AsyncSession, content_hash: str):
+    # Drop the pages and chunks stored for a content hash
+    await db.execute(delete(PDFPage).where(PDFPage.content_hash == content_hash))
+    await db.execute(delete(PDFChunk).where(PDFChunk.content_hash == content_hash))
+
+
+def backfill_content_hashes(db: Session):
+    """
+    Give PDFs stored before content hashing a hash of their extracted text,
+    so they can still be indexed and looked up by hash.
+    """
+    rows = (
+        db.query(PDFDocument.id, PDFDocument.content)
+        .filter(PDFDocument.content_hash.is_(None), PDFDocument.content.isnot(None))
+        .all()
+    )
+    for row in rows:
+        db.query(PDFDocument).filter_by(id=row.id).update(
+            {"content_hash": hashlib.sha256(row.content.encode()).hexdigest()}
+        )
+    db.commit()
+
+
+def backfill_pdf_pages(db: Session):
+    """
+    Move the text of PDFs stored before page storage existed out of the
+    `content` column into `pdf_pages`.
+    """
+    rows = (
+        db.query(PDFDocument.id, PDFDocument.content_hash, PDFDocument.content)
+        .filter(PDFDocument.page_count.is_(None), PDFDocument.content.isnot(None))
+        .all()
+    )
+    stored = set()
+    for row in rows:
+        pages = row.content.split(PAGE_SEPARATOR)
+        if row.content_hash not in stored:
+            db.query(PDFPage).filter_by(content_hash=row.content_hash).delete()
+            db.add_all(make_pdf_pages(row.content_hash, pages))
+            stored.add(row.content_hash)
+        db.query(PDFDocument).filter_by(id=row.id).update({"content": None, "page_count": len(pages)})
+    db.commit()
@@ -4,6 +4,7 @@ import requests
 import websockets
 import json
 import asyncio
+import time
 
 # deployed
 DEPLOYED_URL = 'https://backend-internship-assignment.onrender.com' 
@@ -26,6 +27,26 @@ with st.sidebar:
     add_vertical_space(5)
     st.write("Made for backend assignment project")
 
+def wait_for_upload(job, poll_interval=1.0, timeout=600):
+    """Poll the upload's job until it is done or failed, showing its progress."""
+    progress = st.progress(0.0, text="Processing PDF...")
+    deadline = time.monotonic() + timeout
+    while job["status"] not in ("done", "failed"):
+        if time.monotonic() > deadline:
+            return {"status": "failed", "error": "Processing timed out."}
+        time.sleep(poll_interval)
+        response = requests.get(f"{DEPLOYED_URL}/upload-pdf/status/{job['job_id']}")
+        if response.status_code != 200:
+            return {"status": "failed", "error": response.text}
+        job = response.json()
+        if job.get("pages_total"):
+            progress.progress(
+                job["pages_done"] / job["pages_total"],
+                text=f"{job['status'].capitalize()} ({job['pages_done']}/{job['pages_total']} pages)...",
+            )
+    progress.empty()
+    return job
+
 def main():
     st.header("Chat with your PDF")
     st.subheader('Upload your PDF here')
@@ -42,13 +63,19 @@ def main():
     # Add upload button
     if pdf_file is not None:
         if st.button("Upload PDF"):
-            response = requests.post(f"{DEPLOYED_URL}/upload-pdf/", files={"file": pdf_file})
+            response = requests.post(f"{DEPLOYED_URL}/upload-pdf/", files={"file": pdf_file}, params={"user_id": 102})
             # Print the response from the server
             if response.status_code == 200:
-                st.write("Successfully completed")
-                st.session_state.ws_connected = True
-                # Clear previous messages when new PDF is uploaded
-                st.session_state.messages = []
+                # The PDF is extracted and indexed in the background; questions
+                # can only be answered from it once that is done
+                job = wait_for_upload(response.json())
+                if job["status"] == "done":
+                    st.write("Successfully completed")
+                    st.session_state.ws_connected = True
+                    # Clear previous messages when new PDF is uploaded
+                    st.session_state.messages = []
+                else:
+                    st.write(f"Processing failed: {job.get('error') or 'unknown error'}")
             else:
                 st.write("Upload Failed")
 
@@ -85,15 +112,29 @@ def main():
                                 
                                 await websocket.send(json.dumps({
                                     "type": "question",
-                                    "content": prompt
+                                    "content": prompt,
+                                    "stream": True
                                 }))
                                 
-                                # Use asyncio.wait_for to set a timeout
-                                response = await asyncio.wait_for(
-                                    websocket.recv(),
-                                    timeout=300  # 5 minutes timeout
-                                )
-                                return json.loads(response)
+                                # Render tokens as they arrive; the timeout
+                                # now bounds the gap between frames
+                                answer = ""
+                                while True:
+                                    response = json.loads(await asyncio.wait_for(
+                                        websocket.recv(),
+                                        timeout=300  # 5 minutes timeout
+                                    ))
+                                    if response["type"] == "answer_chunk":
+                                        answer += response["content"]
+                                        response_placeholder.markdown(answer)
+                                    elif response["type"] == "queued":
+                                        response_placeholder.markdown(f"Waiting in line (position {response['position']})...")
+                                    elif response["type"] == "indexing":
+                                        response_placeholder.markdown(
+                                            f"Preparing your documents ({response['done']}/{response['total']})..."
+                                        )
+                                    elif response["type"] in ("answer_end", "answer", "busy", "error"):
+                                        return response
                         except asyncio.TimeoutError:
                             return {"content": "Response timed out. Please try again."}
                         except Exception as e:
@@ -1,18 +1,52 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, BackgroundTasks, Query
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-import fitz  # PyMuPDF for PDF text extraction
+from typing import Optional
 from pathlib import Path
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
 import os
 import random
+import hashlib
+import tempfile
+import uuid
+import weakref
 
 # Local imports
-from database.config import SessionLocal
-from database.models import PDFDocument
+from database.config import AsyncSessionLocal, async_engine, async_session_scope
+from database.models import (
+    PDFDocument,
+    count_pdf_documents_by_hash_async,
+    delete_pdf_content_async,
+    get_pdf_document_async,
+    list_pdf_documents_async,
+    replace_pdf_chunks_async,
+    replace_pdf_pages_async,
+)
+from utils.cache import LRUCache
+from utils.extraction import extract_pdf_pages, shutdown_process_pool
+from utils.metrics import ERRORS, registry, timed
+from utils.nlp2 import answer_cache, delete_document_index, index_document, run_blocking, QA_EXECUTOR_WORKERS
 
 from websocket.question_answer import router as ws_router # type: ignore
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # LangChain runs sync-only steps (e.g. Chroma searches) in the loop's default
+    # executor; bound it so a burst of questions cannot spawn unlimited threads
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=QA_EXECUTOR_WORKERS, thread_name_prefix="langchain")
+    )
+    yield
+    shutdown_process_pool()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Include the WebSocket router
 app.include_router(ws_router)
@@ -20,70 +54,370 @@ app.include_router(ws_router)
 # Directory to save uploaded PDFs
 UPLOAD_DIRECTORY = "pdf_uploads"
 Path(UPLOAD_DIRECTORY).mkdir(exist_ok=True)
+# Size of the pieces an upload is read and written in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
+# Progress of background extraction and indexing, keyed by job id; jobs
+# still running are also held by `uploads_in_flight`, which is never evicted
+upload_jobs = LRUCache(maxsize=1000, ttl=3600)
+# Bytes being extracted and indexed by this worker, keyed by content hash:
+# the job and the document of every user waiting for it
+uploads_in_flight = {}
+# Serialises the check for known bytes with the start of their processing,
+# one lock per event loop since asyncio locks are bound to one
+_upload_locks = weakref.WeakKeyDictionary()
+# Documents returned per page by the listing endpoint, by default and at most
+DOCUMENT_PAGE_SIZE = 50
+MAX_DOCUMENT_PAGE_SIZE = 500
 
-def get_current_user_id():
-    # [todo]
-    return random.randint(0, 500)
+UPLOADS_IN_PROGRESS = registry.gauge("pdf_qa_uploads_in_progress", "Uploads being extracted or indexed.")
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+
+def get_upload_lock():
+    loop = asyncio.get_running_loop()
+    lock = _upload_locks.get(loop)
+    if lock is None:
+        lock = asyncio.Lock()
+        _upload_locks[loop] = lock
+    return lock
+
+def get_current_user_id(user_id: Optional[int] = None):
+    # [todo] replace with real authentication; until then clients may say
+    # which user they are so their uploads can be queried over the WebSocket
+    return user_id if user_id is not None else random.randint(0, 500)
+
+# Dependency to get an async DB session, so queries do not block the event loop
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
+
+def spool_upload(source, destination, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy the file object `source` into `destination` through one reusable
+    buffer, hashing the bytes on the way, so memory stays at `chunk_size`
+    however large the upload. Returns (size, first 5 bytes, SHA-256 hex).
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    hasher = hashlib.sha256()
+    size = 0
+    header = b""
+    while read := source.readinto(buffer):
+        chunk = view[:read]
+        if len(header) < 5:
+            header += bytes(chunk[:5 - len(header)])
+        hasher.update(chunk)
+        destination.write(chunk)
+        size += read
+    return size, header, hasher.hexdigest()
+
+async def release_content(content_hash):
+    """
+    Drop the pages, chunks, vectors and file of a content hash that no
+    document refers to any more. Call with the upload lock held, so bytes
+    uploaded again meanwhile are not deleted under their new job.
+    """
+    if content_hash in uploads_in_flight:
+        return
+    async with async_session_scope() as db:
+        if await count_pdf_documents_by_hash_async(db, content_hash):
+            return
+        await delete_pdf_content_async(db, content_hash)
+        await db.commit()
+    await run_blocking(delete_document_index, content_hash)
+    file_path = os.path.join(UPLOAD_DIRECTORY, f"{content_hash}.pdf")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+async def process_uploaded_pdf(job, document_id, content_hash, file_path, previous_hash=None, uploaded_at=None):
+    """
+    Extract, store and index an uploaded PDF, recording progress on the
+    `job` dict, which is held here rather than looked up so a job evicted
+    from `upload_jobs` while it waits still runs.
+
+    With `previous_hash` the upload is a new version of that document,
+    uploaded at `uploaded_at`: the vectors of unchanged chunks are reused,
+    and the document switches to the new content only once it is fully
+    indexed, unless a later upload has replaced it meanwhile. Whichever
+    content is left unused, the one replaced or a failed or outdated new
+    version, is released.
+    """
+    def on_progress(pages_done, pages_total):
+        job["pages_done"] = pages_done
+        job["pages_total"] = pages_total
+
+    UPLOADS_IN_PROGRESS.inc()
+    try:
+        job["status"] = "extracting"
+        with timed("extraction"):
+            pages = await extract_pdf_pages(file_path, on_progress=on_progress)
+
+        # Store one row per page rather than the whole text in the document row
+        async with async_session_scope() as db:
+            await replace_pdf_pages_async(db, content_hash, pages)
+            await db.commit()
+
+        # Chunk and embed the document once so questions only need retrieval
+        job["status"] = "indexing"
+        chunks = await run_blocking(index_document, content_hash, pages, previous_hash=previous_hash)
+
+        # The document becomes visible to questions once it is indexed, and
+        # so do those of the other users who uploaded the same bytes meanwhile
+        async with get_upload_lock():
+            async with async_session_scope() as db:
+                waiting = uploads_in_flight.pop(content_hash, {}).get("documents", {})
+                await replace_pdf_chunks_async(db, content_hash, chunks)
+                values = {"content_hash": content_hash, "page_count": len(pages), "indexed": True}
+                released = None
+                if previous_hash:
+                    # Several versions may be processed at once, so release
+                    # the content the document points to now, not the one it
+                    # pointed to at upload; a version finishing after a later
+                    # one has been switched in is itself outdated
+                    current = (await db.execute(
+                        select(PDFDocument.content_hash, PDFDocument.upload_date).where(PDFDocument.id == document_id)
+                    )).one_or_none()
+                    if current is None or current.upload_date > uploaded_at:
+                        values = None
+                        released = content_hash
+                    else:
+                        values["upload_date"] = uploaded_at
+                        if current.content_hash != content_hash:
+                            released = current.content_hash
+                if values is not None:
+                    await db.execute(update(PDFDocument).where(PDFDocument.id == document_id).values(**values))
+                others = [other_id for other_id in waiting.values() if other_id != document_id]
+                if others:
+                    await db.execute(
+                        update(PDFDocument).where(PDFDocument.id.in_(others)).values(page_count=len(pages), indexed=True)
+                    )
+                await db.commit()
+            if released:
+                answer_cache.invalidate(released)
+                await release_content(released)
+        job["status"] = "done"
+    except Exception as e:
+        print(f"Failed to process PDF {document_id}: {str(e)}")
+        ERRORS.inc(stage="upload")
+        job["status"] = "failed"
+        job["error"] = str(e)
+        if previous_hash:
+            # The document keeps its current content; drop what was stored
+            # of the new version, file included
+            try:
+                async with get_upload_lock():
+                    uploads_in_flight.pop(content_hash, None)
+                    await release_content(content_hash)
+            except Exception as error:
+                print(f"Failed to release PDF content {content_hash}: {str(error)}")
     finally:
-        db.close()
+        uploads_in_flight.pop(content_hash, None)
+        UPLOADS_IN_PROGRESS.dec()
 
 @app.get("/")
 async def root():
     return {"message": "FastAPI server is running!"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 # PDF upload endpoint
 @app.post("/upload-pdf/")
 async def upload_pdf(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     user_id: int = Depends(get_current_user_id)
     ):
     # Ensure file is a PDF
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="File must be a PDF.")
     
-    # Read and extract content from the PDF
+    # Spool the upload to disk next to its final location so it never sits
+    # in memory whole; the copy runs off the event loop
+    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_DIRECTORY, suffix=".part")
     try:
-        pdf_data = await file.read()
-        if len(pdf_data) == 0:
+        with os.fdopen(fd, "wb") as f:
+            size, header, content_hash = await run_in_threadpool(spool_upload, file.file, f)
+        if size == 0:
             raise HTTPException(status_code=400, detail="Uploaded file is empty.")
-        
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
-        pdf_text = ""
-        for page in doc:
-            pdf_text += page.get_text()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Error processing PDF file.")
-    # Check if a PDF with the same filename already exists in the database
-    existing_pdf = db.query(PDFDocument).filter_by(filename=file.filename).first()
-    if existing_pdf:
-        print("this pdf already exist so updating the time")
-        # Update the upload_date if the file already exists
-        existing_pdf.upload_date = datetime.utcnow()
-        db.commit()
-        db.refresh(existing_pdf)
-        return {"message": "PDF uploaded successfully", "id": existing_pdf.id}
-    # Save the PDF file locally
-    file_path = os.path.join(UPLOAD_DIRECTORY, file.filename)
-    with open(file_path, "wb") as f:
-        f.write(pdf_data)
-        
-    # Save file metadata and content to the database
-    new_pdf = PDFDocument(
-        filename=file.filename,
-        upload_date=datetime.utcnow(),
-        content=pdf_text,
-        user_id=user_id # Associate the PDF with the user
-    )
-    db.add(new_pdf)
-    db.commit()
-    db.refresh(new_pdf)
+        if header != b"%PDF-":
+            raise HTTPException(status_code=400, detail="File must be a PDF.")
+    except Exception:
+        os.remove(temp_path)
+        raise
 
-    return {"message": "PDF uploaded successfully", "id": new_pdf.id}
\ No newline at end of file
+    async with get_upload_lock():
+        # The same bytes uploaded a moment ago are still being processed:
+        # follow that job rather than extracting and indexing them twice
+        in_flight = uploads_in_flight.get(content_hash)
+        if in_flight is not None:
+            os.remove(temp_path)
+            document_id = in_flight["documents"].get(user_id)
+            if document_id is None:
+                pdf = PDFDocument(
+                    filename=file.filename,
+                    upload_date=datetime.utcnow(),
+                    content_hash=content_hash,
+                    user_id=user_id
+                )
+                db.add(pdf)
+                await db.commit()
+                await db.refresh(pdf)
+                document_id = in_flight["documents"][user_id] = pdf.id
+            job = in_flight["job"]
+            return {
+                "message": "PDF uploaded successfully",
+                "id": document_id,
+                "job_id": job["job_id"],
+                "status": job["status"],
+            }
+
+        # Known bytes skip extraction and indexing: the pages, chunks and
+        # embeddings are shared with the earlier upload
+        existing_pdf = (await db.execute(
+            select(PDFDocument)
+            .where(PDFDocument.content_hash == content_hash, PDFDocument.page_count.isnot(None))
+            .order_by(PDFDocument.user_id != user_id)
+            .limit(1)
+        )).scalar()
+        if existing_pdf:
+            os.remove(temp_path)
+            if existing_pdf.user_id == user_id:
+                # Update the upload_date if this user already uploaded the file,
+                # and answer questions about it afresh
+                existing_pdf.upload_date = datetime.utcnow()
+                answer_cache.invalidate(content_hash)
+                pdf = existing_pdf
+            else:
+                pdf = PDFDocument(
+                    filename=file.filename,
+                    upload_date=datetime.utcnow(),
+                    page_count=existing_pdf.page_count,
+                    indexed=existing_pdf.indexed,
+                    content_hash=content_hash,
+                    user_id=user_id
+                )
+                db.add(pdf)
+            await db.commit()
+            await db.refresh(pdf)
+            return {
+                "message": "PDF uploaded successfully",
+                "id": pdf.id,
+                "job_id": None,
+                "status": "done",
+            }
+
+        # Save the PDF file locally under its hash, so same-named files never collide
+        file_path = os.path.join(UPLOAD_DIRECTORY, f"{content_hash}.pdf")
+        os.replace(temp_path, file_path)
+
+        # Changed bytes under a name this user already uploaded are a new
+        # version of that document, re-indexed incrementally
+        previous_pdf = (await db.execute(
+            select(PDFDocument)
+            .where(
+                PDFDocument.user_id == user_id,
+                PDFDocument.filename == file.filename,
+                PDFDocument.page_count.isnot(None),
+            )
+            .order_by(PDFDocument.upload_date.desc(), PDFDocument.id.desc())
+            .limit(1)
+        )).scalar()
+        uploaded_at = datetime.utcnow()
+        if previous_pdf:
+            new_pdf = previous_pdf
+            previous_hash = previous_pdf.content_hash
+        else:
+            # Save file metadata now; the content is filled in once extracted
+            new_pdf = PDFDocument(
+                filename=file.filename,
+                upload_date=uploaded_at,
+                content_hash=content_hash,
+                user_id=user_id # Associate the PDF with the user
+            )
+            db.add(new_pdf)
+            await db.commit()
+            await db.refresh(new_pdf)
+            previous_hash = None
+
+        # Extract and index in the background so the request returns right away
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "document_id": new_pdf.id,
+            "status": "queued",
+            "pages_done": 0,
+            "pages_total": None,
+            "error": None,
+        }
+        upload_jobs.set(job_id, job)
+        uploads_in_flight[content_hash] = {"job": job, "documents": {user_id: new_pdf.id}}
+        background_tasks.add_task(
+            process_uploaded_pdf, job, new_pdf.id, content_hash, file_path, previous_hash, uploaded_at
+        )
+
+        return {
+            "message": "PDF uploaded successfully",
+            "id": new_pdf.id,
+            "job_id": job_id,
+            "status": "queued",
+        }
+
+# Upload processing status endpoint
+@app.get("/upload-pdf/status/{job_id}")
+async def upload_status(job_id: str):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        # Evicted from the cache but still running
+        job = next((in_flight["job"] for in_flight in uploads_in_flight.values() if in_flight["job"]["job_id"] == job_id), None)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job not found.")
+    return job
+
+
+def encode_cursor(upload_date, document_id):
+    return base64.urlsafe_b64encode(f"{upload_date.isoformat()}|{document_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        upload_date, document_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(upload_date), int(document_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+
+# Document listing endpoint
+@app.get("/documents/")
+async def list_documents(
+    limit: int = Query(DOCUMENT_PAGE_SIZE, ge=1, le=MAX_DOCUMENT_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(get_current_user_id)
+    ):
+    # Keyset pagination: each page continues after the last (upload_date, id)
+    # seen, so every page is one range scan of the user's index
+    after = decode_cursor(cursor) if cursor else None
+    documents = await list_pdf_documents_async(db, user_id, limit, after)
+    next_cursor = None
+    if len(documents) == limit:
+        next_cursor = encode_cursor(documents[-1].upload_date, documents[-1].id)
+    return {
+        "documents": [document._asdict() for document in documents],
+        "next_cursor": next_cursor,
+    }
+
+# Document detail endpoint
+@app.get("/documents/{document_id}")
+async def get_document(
+    document_id: int,
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(get_current_user_id)
+    ):
+    document = await get_pdf_document_async(db, user_id, document_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found.")
+    return document._asdict()
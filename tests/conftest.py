@@ -0,0 +1,59 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# Index with the local embedding backend so tests never call a remote API
+os.environ.setdefault("EMBEDDING_BACKEND", "local")
+
+# Keep test data out of the working tree's database: unless a database is
+# configured, the suite runs against a throwaway SQLite file
+_database_directory = tempfile.mkdtemp(prefix="pdf-qa-tests-")
+atexit.register(shutil.rmtree, _database_directory, ignore_errors=True)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_database_directory}/database.db")
+
+
+@pytest.fixture(autouse=True)
+def clear_answer_cache():
+    # Answers cached by one test must not satisfy questions in another
+    from utils.nlp2 import answer_cache
+
+    answer_cache.clear()
+    yield
+    answer_cache.clear()
+
+
+@pytest.fixture
+def stub_qa_session(monkeypatch):
+    """
+    Serve question-answer WebSockets from a given chain instead of the
+    user's indexed documents.
+
+    Call it with the chain to answer with. Sessions see `documents` as the
+    user's `(document_id, content_hash)` rows, all already indexed; with
+    `documents=None` the documents are read from the test database.
+    """
+    from websocket import question_answer
+
+    def stub(chain, documents=((1, "abc"),)):
+        monkeypatch.setattr(question_answer, "find_unindexed_documents", lambda content_hashes: [])
+        monkeypatch.setattr(question_answer, "get_qa_chain", lambda content_hashes: chain)
+        if documents is None:
+            return
+
+        async def get_documents(db, user_id):
+            return list(documents)
+
+        async def get_unindexed_content_hashes(db, user_id):
+            return []
+
+        async def mark_indexed(db, content_hashes):
+            pass
+
+        monkeypatch.setattr(question_answer, "get_pdf_documents_for_user_async", get_documents)
+        monkeypatch.setattr(question_answer, "get_unindexed_content_hashes_for_user_async", get_unindexed_content_hashes)
+        monkeypatch.setattr(question_answer, "mark_pdf_documents_indexed_async", mark_indexed)
+
+    return stub
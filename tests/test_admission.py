@@ -0,0 +1,138 @@
+"""
+Test admission control for questions
+
+This test module checks that waiting questions are admitted round-robin
+across users with their place in line, that overload is refused early
+rather than queued, and that full or idle WebSocket sessions are shed.
+"""
+
+import asyncio
+import json
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from main import app
+from utils import nlp2
+from utils.admission import FairQueue, QueueFullError, QueueTimeoutError
+from websocket import question_answer
+
+
+@pytest.mark.asyncio
+async def test_waiting_questions_are_admitted_round_robin():
+    """
+    Test that one user's burst does not hold back another user's question
+    """
+    queue = FairQueue(concurrency=1, max_depth=10)
+    await queue.acquire("x")
+    admitted, positions = [], {}
+
+    async def ask(user, name):
+        async def on_queued(position):
+            positions[name] = position
+        async with queue.slot(user, on_queued):
+            admitted.append(name)
+
+    tasks = []
+    for user, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+        tasks.append(asyncio.ensure_future(ask(user, name)))
+        await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(*tasks)
+
+    assert admitted == ["a1", "b1", "a2", "a3"]
+    assert positions == {"a1": 1, "a2": 2, "a3": 3, "b1": 2}
+    assert queue.running == 0 and queue.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_overload_is_refused_and_waiters_can_leave():
+    """
+    Test that a full queue refuses, a timed out question leaves the line,
+    and a cancelled one passes its slot on
+    """
+    queue = FairQueue(concurrency=1, max_depth=1, timeout=0.01)
+    await queue.acquire("a")
+
+    with pytest.raises(QueueTimeoutError):
+        await queue.acquire("b")
+    assert queue.depth == 0
+
+    waiter = asyncio.ensure_future(queue.acquire("b"))
+    await asyncio.sleep(0)
+    with pytest.raises(QueueFullError):
+        await queue.acquire("c")
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    queue.release()
+
+    assert queue.depth == 0 and queue.running == 0
+
+
+class FakeRetrievalChain:
+    async def ainvoke(self, inputs):
+        return {"input": inputs["input"], "answer": "Acme."}
+
+
+@pytest.fixture
+def session(stub_qa_session, monkeypatch):
+    stub_qa_session(FakeRetrievalChain())
+    monkeypatch.setattr(nlp2, "_admission_queues", type(nlp2._admission_queues)())
+    return TestClient(app)
+
+
+def test_busy_frame_when_no_slot_can_be_had(session, monkeypatch):
+    """
+    Test that a question is refused with a busy frame and the session stays usable
+    """
+    monkeypatch.setattr(nlp2, "QA_MAX_CONCURRENCY", 0)
+    monkeypatch.setattr(nlp2, "QA_MAX_QUEUE_DEPTH", 0)
+
+    with session.websocket_connect("/ws/question-answer?user_id=1") as websocket:
+        for stream in (False, True):
+            websocket.send_text(json.dumps({"type": "question", "content": str(uuid.uuid4()), "stream": stream}))
+            assert json.loads(websocket.receive_text())["type"] == "busy"
+
+
+def test_full_and_idle_sessions_are_shed(session, monkeypatch):
+    """
+    Test that sessions past the limit are refused and silent ones are closed
+    """
+    monkeypatch.setattr(question_answer, "QA_MAX_SESSIONS", 0)
+    with session.websocket_connect("/ws/question-answer?user_id=1") as websocket:
+        assert json.loads(websocket.receive_text())["type"] == "busy"
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_text()
+    assert closed.value.code == question_answer.TRY_AGAIN_LATER
+
+    monkeypatch.setattr(question_answer, "QA_MAX_SESSIONS", 10)
+    monkeypatch.setattr(question_answer, "QA_SESSION_IDLE_TIMEOUT", 0.05)
+    with session.websocket_connect("/ws/question-answer?user_id=1") as websocket:
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_text()
+    assert closed.value.code == 1000
+    assert not question_answer.sessions
+
+
+def test_session_is_held_while_it_is_set_up(session, monkeypatch):
+    """
+    Test that a connection counts against the limit before its documents
+    are looked up, so a burst of connections cannot overshoot it
+    """
+    counted = []
+
+    async def get_documents(db, user_id):
+        counted.append(len(question_answer.sessions))
+        return [(1, "abc")]
+
+    monkeypatch.setattr(question_answer, "get_pdf_documents_for_user_async", get_documents)
+    monkeypatch.setattr(question_answer, "QA_MAX_SESSIONS", 1)
+    with session.websocket_connect("/ws/question-answer?user_id=1") as websocket:
+        websocket.send_text(json.dumps({"type": "question", "content": str(uuid.uuid4())}))
+        assert json.loads(websocket.receive_text())["content"] == "Acme."
+        with session.websocket_connect("/ws/question-answer?user_id=2") as refused:
+            assert json.loads(refused.receive_text())["type"] == "busy"
+    assert counted == [1]
+    assert not question_answer.sessions
@@ -0,0 +1,247 @@
+"""
+Test the micro-batching of concurrent questions
+
+This test module checks that requests arriving together are handled in
+one call, that identical in-flight questions are answered once, and that
+the batched vector search picks the chunks Chroma's MMR search picks.
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from utils import nlp2
+from utils.batching import MicroBatcher, SingleFlight
+from utils.embeddings import HashingEmbeddings
+
+
+async def run_inline(func, *args):
+    return func(*args)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_items_share_one_call():
+    """
+    Test that items submitted within the window go to one call, in order
+    """
+    calls = []
+
+    def process(items):
+        calls.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher("test", process, run_inline, window=0.01, max_size=8)
+    results = await asyncio.gather(*(batcher.submit(item) for item in range(5)))
+
+    assert results == [0, 2, 4, 6, 8]
+    assert calls == [[0, 1, 2, 3, 4]]
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting_and_errors_reach_callers():
+    """
+    Test that a batch goes out as soon as it is full, and that a failed
+    call fails every request in it
+    """
+    calls = []
+
+    def process(items):
+        calls.append(items)
+        raise RuntimeError("embedding service down")
+
+    batcher = MicroBatcher("test", process, run_inline, window=60, max_size=2)
+    results = await asyncio.wait_for(
+        asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True),
+        timeout=1,
+    )
+
+    assert calls == [["a", "b"]]
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_single_flight_runs_identical_calls_once():
+    """
+    Test that callers of the same key share one call
+    """
+    calls = []
+
+    async def answer(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"answer to {key}"
+
+    flight = SingleFlight()
+    results = await asyncio.gather(*(flight.run(key, lambda _, key=key: answer(key)) for key in ["q", "q", "q", "other"]))
+
+    assert results == ["answer to q"] * 3 + ["answer to other"]
+    assert sorted(calls) == ["other", "q"]
+    # Once answered, the key is free again
+    assert await flight.run("q", lambda _: answer("q")) == "answer to q"
+    assert calls.count("q") == 2
+
+
+@pytest.mark.asyncio
+async def test_single_flight_streams_to_every_caller():
+    """
+    Test that callers of the same key follow one stream, each from its start
+    """
+    calls = []
+
+    async def stream(key):
+        calls.append(key)
+        for part in ["An", "swer"]:
+            await asyncio.sleep(0.01)
+            yield part
+
+    async def follow(flight, key):
+        return [part async for part in flight.stream(key, lambda _: stream(key))]
+
+    flight = SingleFlight()
+    first = asyncio.ensure_future(follow(flight, "q"))
+    await asyncio.sleep(0.015)
+    results = await asyncio.gather(first, follow(flight, "q"), follow(flight, "other"))
+
+    assert results == [["An", "swer"]] * 3
+    assert sorted(calls) == ["other", "q"]
+
+
+@pytest.fixture
+def vector_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(nlp2, "VECTOR_INDEX_DIRECTORY", str(tmp_path / "vector_index"))
+    monkeypatch.setattr(nlp2, "get_embeddings", lambda: HashingEmbeddings(dim=256))
+    monkeypatch.setattr(nlp2, "MMR_FETCH_K", 5)
+    words = "alice project python database customer physics compiler budget design report".split()
+    rng = np.random.default_rng(7)
+    pages = [" ".join(rng.choice(words, size=12)) for _ in range(30)]
+    nlp2.index_document("a1", pages)
+    nlp2.index_document("b2", ["Bob studied physics.", "Bob worked at Initech on compilers."])
+
+
+def test_batched_search_matches_chroma_mmr(vector_index, monkeypatch):
+    """
+    Test that the matrix search selects the same chunks as Chroma's MMR retriever
+    """
+    questions = ["Which project used python?", "Where did Bob work?", "customer database budget"]
+    batched = nlp2.search_questions([(["a1", "b2"], question) for question in questions])
+
+    monkeypatch.setattr(nlp2, "QA_BATCH_SIZE", 0)
+    for question, docs in zip(questions, batched):
+        expected = nlp2.load_retriever(["a1", "b2"], mode="vector").invoke(question)
+        assert sorted(doc.page_content for doc in docs) == sorted(doc.page_content for doc in expected)
+
+
+def test_large_scopes_are_searched_by_chroma(vector_index, monkeypatch):
+    """
+    Test that questions about many documents use the filtered Chroma search
+    instead of loading every document's vectors
+    """
+    monkeypatch.setattr(nlp2, "MATRIX_SEARCH_MAX_DOCUMENTS", 1)
+    monkeypatch.setattr(nlp2, "get_document_vectors", lambda content_hash: pytest.fail("vectors loaded"))
+    question = "Where did Bob work?"
+    [docs] = nlp2.search_questions([(["a1", "b2"], question)])
+
+    monkeypatch.setattr(nlp2, "QA_BATCH_SIZE", 0)
+    expected = nlp2.load_retriever(["a1", "b2"], mode="vector").invoke(question)
+    assert [doc.page_content for doc in docs] == [doc.page_content for doc in expected]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_questions_are_batched_and_deduplicated(vector_index, monkeypatch):
+    """
+    Test that a burst of questions embeds once, searches once and answers
+    identical questions once
+    """
+    embedded, searched, answered = [], [], []
+    monkeypatch.setattr(nlp2, "_batchers", type(nlp2._batchers)())
+    monkeypatch.setattr(nlp2, "QA_BATCH_WINDOW_MS", 20)
+    embed_queries = nlp2.embed_queries
+    monkeypatch.setattr(nlp2, "embed_queries", lambda embeddings, texts: embedded.append(texts) or embed_queries(embeddings, texts))
+    search_questions = nlp2.search_questions
+    monkeypatch.setattr(nlp2, "search_questions", lambda requests: searched.append(requests) or search_questions(requests))
+    nlp2.question_vectors_cache.clear()
+    nlp2.answer_cache.clear()
+
+    async def answer(inputs):
+        docs = await retriever.ainvoke(inputs["input"])
+        answered.append(inputs["input"])
+        await asyncio.sleep(0.01)
+        return {"answer": f"{len(docs)} chunks", "context": docs}
+
+    retriever = nlp2.load_retriever(["a1"], mode="vector")
+    chain = RunnableLambda(answer)
+    questions = ["Which project used python?"] * 3 + ["Which customer used databases?"]
+    answers = await asyncio.gather(*(
+        nlp2.get_answer_from_model(question, ["a1"], retrieval_chain=chain) for question in questions
+    ))
+
+    assert answers == ["3 chunks"] * 4
+    assert embedded == [list(dict.fromkeys(questions))]
+    assert len(searched) == 1 and len(searched[0]) == 2
+    assert sorted(answered) == sorted(set(questions))
+
+
+@pytest.mark.asyncio
+async def test_exact_cache_hit_is_not_embedded(vector_index, monkeypatch):
+    """
+    Test that a question found by its normalised text skips the embedding
+    batch, and a near duplicate goes through it
+    """
+    embedded = []
+    monkeypatch.setattr(nlp2, "_batchers", type(nlp2._batchers)())
+    embed_queries = nlp2.embed_queries
+    monkeypatch.setattr(nlp2, "embed_queries", lambda embeddings, texts: embedded.append(texts) or embed_queries(embeddings, texts))
+    monkeypatch.setattr(nlp2.answer_cache, "similarity_threshold", 0.5)
+    nlp2.question_vectors_cache.clear()
+    nlp2.answer_cache.clear()
+    nlp2.remember_answer("Summarize this", ["a1"], "A summary.", [], nlp2.embed_question("Summarize this"))
+    embedded.clear()
+
+    assert await nlp2.get_answer_from_model("summarize this?", ["a1"]) == "A summary."
+    assert embedded == []
+    assert await nlp2.get_answer_from_model("Summarize this, please", ["a1"]) == "A summary."
+    assert embedded == [["Summarize this, please"]]
+
+
+@pytest.mark.asyncio
+async def test_deduplicated_questions_queue_before_embedding(vector_index, monkeypatch):
+    """
+    Test that every session waiting on a shared answer hears its place in
+    line, and that the question is only embedded once admitted
+    """
+    embedded, positions = [], []
+    monkeypatch.setattr(nlp2, "_batchers", type(nlp2._batchers)())
+    monkeypatch.setattr(nlp2, "_admission_queues", type(nlp2._admission_queues)())
+    monkeypatch.setattr(nlp2, "QA_MAX_CONCURRENCY", 1)
+    embed_queries = nlp2.embed_queries
+    monkeypatch.setattr(nlp2, "embed_queries", lambda embeddings, texts: embedded.append(texts) or embed_queries(embeddings, texts))
+    chain = RunnableLambda(lambda inputs: {"answer": "Initech.", "context": []})
+
+    async def ask(name, stream):
+        async def on_queued(position):
+            positions.append((name, position))
+        if stream:
+            return [kind async for kind, _ in nlp2.stream_answer_from_model(
+                "Where did Bob work?", ["b2"], retrieval_chain=chain, on_queued=on_queued
+            )]
+        return await nlp2.get_answer_from_model("Where did Bob work?", ["b2"], retrieval_chain=chain, on_queued=on_queued)
+
+    for stream in (False, True):
+        nlp2.question_vectors_cache.clear()
+        nlp2.answer_cache.clear()
+        positions.clear()
+        queue = nlp2.get_admission_queue()
+        await queue.acquire("x")
+        tasks = []
+        for name in ("first", "second"):
+            tasks.append(asyncio.ensure_future(ask(name, stream)))
+            await asyncio.sleep(0.01)
+        assert sorted(positions) == [("first", 1), ("second", 1)]
+        assert embedded == []
+        queue.release()
+        results = await asyncio.gather(*tasks)
+        assert results == ([["chunk", "end"]] * 2 if stream else ["Initech."] * 2)
+        assert embedded == [["Where did Bob work?"]]
+        embedded.clear()
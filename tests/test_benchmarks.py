@@ -0,0 +1,34 @@
+"""
+Test the benchmark harness
+
+This test module runs every benchmark with tiny sizes and no simulated
+latency, and checks that each reports its measurements.
+"""
+
+from benchmarks.run import BenchmarkConfig, run_benchmarks
+
+
+def test_benchmarks_report_every_measurement(tmp_path):
+    """
+    Test that a small run measures uploads, extraction, indexing and questions
+    """
+    config = BenchmarkConfig(
+        documents=2,
+        pages=2,
+        upload_concurrency=2,
+        extraction_pages=4,
+        index_pages=4,
+        concurrency=[1, 2],
+        questions=2,
+        llm_latency=0.0,
+        embedding_latency=0.0,
+    )
+
+    results = run_benchmarks(config, str(tmp_path))
+
+    assert results["upload"]["documents"] == 2
+    assert results["extraction"]["pages"] == 4
+    assert results["index"]["chunks"] > 0
+    assert set(results["questions"]) == {"1", "2"}
+    assert results["questions"]["2"]["count"] == 4
+    assert results["questions"]["2"]["p50_ms"] <= results["questions"]["2"]["p99_ms"]
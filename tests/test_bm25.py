@@ -0,0 +1,126 @@
+"""
+Test BM25 keyword retrieval and hybrid fusion
+
+This test module checks that the keyword index finds exact terms, stays
+scoped to the requested documents, persists across processes, and that
+keyword-only retrieval never calls the embedding model.
+"""
+
+import threading
+import time
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from utils import nlp2
+from utils.bm25 import HybridRetriever, KeywordIndexStore, fuse_rankings
+
+
+def make_docs(content_hash, texts):
+    return [Document(page_content=text, metadata={"content_hash": content_hash, "page": i + 1}) for i, text in enumerate(texts)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = KeywordIndexStore(str(tmp_path / "bm25"))
+    store.save("a1", ["a1-0", "a1-1", "a1-2"], make_docs("a1", [
+        "Alice Smith, employee id EMP-4471, worked at Acme.",
+        "Alice studied computer science at MIT.",
+        "Skills: Python, SQL and distributed systems.",
+    ]))
+    store.save("b2", ["b2-0"], make_docs("b2", ["Bob Jones, employee id EMP-9902, studied physics."]))
+    return store
+
+
+def test_search_finds_exact_terms(store):
+    """
+    Test that identifiers and names rank the chunk containing them first
+    """
+    results = store.search(["a1", "b2"], "Who has id EMP-9902?", k=2)
+
+    assert results[0][0].page_content.startswith("Bob Jones")
+    assert results[0][1] > 0
+
+
+def test_search_is_scoped_and_persisted(store, tmp_path):
+    """
+    Test that only requested documents are searched, also after reloading from disk
+    """
+    reopened = KeywordIndexStore(str(tmp_path / "bm25"))
+
+    results = reopened.search(["a1"], "EMP-9902 Bob physics", k=3)
+
+    assert {doc.metadata["content_hash"] for doc, _ in results} <= {"a1"}
+    assert reopened.search(["missing"], "Alice", k=3) == []
+    reopened.delete("a1")
+    assert not reopened.exists("a1")
+
+
+def test_fuse_rankings_rewards_agreement():
+    """
+    Test that a chunk ranked by both retrievers beats chunks found by one
+    """
+    a, b, c = make_docs("x", ["a", "b", "c"])
+
+    assert fuse_rankings([[a, b], [c, b]], k=2) == [b, a]
+
+
+@pytest.mark.asyncio
+async def test_async_keyword_search_runs_off_the_event_loop(store, monkeypatch):
+    """
+    Test that async retrieval loads and scores keyword indexes in another thread
+    """
+    threads = []
+    search = store.search
+    monkeypatch.setattr(store, "search", lambda *args: threads.append(threading.get_ident()) or search(*args))
+    retriever = HybridRetriever(keyword_store=store, content_hashes=["a1", "b2"], k=1)
+
+    docs = await retriever.ainvoke("EMP-9902")
+
+    assert docs[0].page_content.startswith("Bob Jones")
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_keyword_mode_never_embeds(tmp_path, monkeypatch):
+    """
+    Test that keyword retrieval answers without calling the embedding model
+    """
+    queries = []
+
+    class CountingEmbedding(DeterministicFakeEmbedding):
+        def embed_query(self, text):
+            queries.append(text)
+            return super().embed_query(text)
+
+    monkeypatch.setattr(nlp2, "VECTOR_INDEX_DIRECTORY", str(tmp_path / "vector_index"))
+    monkeypatch.setattr(nlp2, "get_embeddings", lambda: CountingEmbedding(size=32))
+    nlp2.index_document("a1", ["Alice worked at Acme under badge 7731.", "Alice studied at MIT."])
+    nlp2.index_document("b2", ["Bob worked at Initech."])
+
+    keyword_docs = nlp2.load_retriever(["a1", "b2"], mode="keyword").invoke("badge 7731")
+    assert queries == []
+    assert keyword_docs[0].page_content == "Alice worked at Acme under badge 7731."
+
+    hybrid_docs = nlp2.load_retriever(["a1", "b2"], mode="hybrid").invoke("badge 7731")
+    assert queries == ["badge 7731"]
+    assert hybrid_docs[0].page_content == "Alice worked at Acme under badge 7731."
+    with pytest.raises(ValueError):
+        nlp2.load_retriever(["a1"], mode="unknown")
+
+
+def test_keyword_search_is_fast(tmp_path):
+    """
+    Test that a keyword search over a loaded index takes well under a millisecond
+    """
+    store = KeywordIndexStore(str(tmp_path / "bm25"))
+    texts = [f"Section {i} covers topic {i % 50} with details about item {i}." for i in range(500)]
+    store.save("big", [f"big-{i}" for i in range(500)], make_docs("big", texts))
+    store.search(["big"], "topic 7 item 307", k=3)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        store.search(["big"], "topic 7 item 307", k=3)
+    elapsed = (time.perf_counter() - start) / 100
+
+    assert elapsed < 0.001
@@ -0,0 +1,179 @@
+"""
+Test the bounded caches used by the QA pipeline
+
+This test module checks LRU eviction and TTL expiry of the cache, that
+WebSocket sessions on the same documents share one QA chain, and that
+repeated questions are answered from the answer cache.
+"""
+
+import threading
+import time
+
+from utils import nlp2
+from utils.cache import AnswerCache, LRUCache
+from utils.embeddings import HashingEmbeddings
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """
+    Test that the cache never grows past its size limit
+    """
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert len(cache) == 2
+    assert "a" in cache
+    assert "b" not in cache
+
+
+def test_lru_cache_expires_entries():
+    """
+    Test that entries older than the TTL are dropped
+    """
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+
+
+def test_qa_chain_is_shared_per_document_set(monkeypatch):
+    """
+    Test that the chain for a set of documents is built once and then reused
+    """
+    built = []
+
+    def fake_create_qa_chain(retriever):
+        built.append(retriever)
+        return object()
+
+    monkeypatch.setattr(nlp2, "qa_chain_cache", LRUCache(maxsize=4))
+    monkeypatch.setattr(nlp2, "load_retriever", lambda content_hash: content_hash)
+    monkeypatch.setattr(nlp2, "create_qa_chain", fake_create_qa_chain)
+
+    first = nlp2.get_qa_chain(["a", "b"])
+    second = nlp2.get_qa_chain(["b", "a"])
+    other = nlp2.get_qa_chain(["c"])
+
+    assert first is second
+    assert other is not first
+    assert built == [("a", "b"), ("c",)]
+
+
+def test_get_or_create_only_blocks_callers_of_the_same_key():
+    """
+    Test that a slow build holds back callers for its key, who share it,
+    but not callers for other keys
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = LRUCache(maxsize=4)
+    release = threading.Event()
+    built = []
+
+    def slow():
+        built.append("slow")
+        release.wait(5)
+        return "slow value"
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        waiting = [executor.submit(cache.get_or_create, "slow", slow) for _ in range(2)]
+        time.sleep(0.05)
+        assert cache.get_or_create("fast", lambda: "fast value") == "fast value"
+        assert not any(future.done() for future in waiting)
+        release.set()
+        assert [future.result() for future in waiting] == ["slow value"] * 2
+    assert built == ["slow"]
+
+
+def test_answer_cache_matches_normalised_questions():
+    """
+    Test that trivially different phrasings of a question hit the cache
+    """
+    cache = AnswerCache(maxsize=4)
+    cache.set(("a",), "Summarize this", "A summary.", [{"page": 1}])
+
+    hit, _ = cache.lookup(("a",), "  summarize THIS? ")
+    other_document, _ = cache.lookup(("b",), "Summarize this")
+
+    assert hit == ("A summary.", [{"page": 1}])
+    assert other_document is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_answer_cache_matches_near_duplicates():
+    """
+    Test that a question close enough in embedding space reuses the answer
+    """
+    embeddings = HashingEmbeddings()
+    cache = AnswerCache(maxsize=4, similarity_threshold=0.8)
+    question = "list the work experience"
+    cache.set(("a",), question, "Acme, Initech.", vector=embeddings.embed_query(question))
+
+    near, _ = cache.lookup(("a",), "List the work experience, please", embeddings.embed_query)
+    far, vector = cache.lookup(("a",), "what is the weather like", embeddings.embed_query)
+
+    assert near == ("Acme, Initech.", [])
+    assert far is None
+    assert vector is not None
+
+
+def test_answer_cache_invalidated_by_document():
+    """
+    Test that re-indexing a document drops answers that used it
+    """
+    cache = AnswerCache(maxsize=4)
+    cache.set(("a", "b"), "q", "answer from a and b")
+    cache.set(("c",), "q", "answer from c")
+
+    cache.invalidate("a")
+
+    assert cache.lookup(("a", "b"), "q")[0] is None
+    assert cache.lookup(("c",), "q")[0] == ("answer from c", [])
+
+
+def test_answer_cache_question_index_stays_bounded():
+    """
+    Test that questions evicted or expired from the cache leave its
+    per-document question index too
+    """
+    cache = AnswerCache(maxsize=4)
+    for i in range(1000):
+        cache.set((f"doc{i % 7}",), f"question {i}", "answer")
+
+    assert len(cache) == 4
+    assert sum(len(questions) for questions in cache._questions.values()) == 4
+
+    cache = AnswerCache(maxsize=4, ttl=0.01)
+    cache.set(("a",), "q", "answer")
+    time.sleep(0.02)
+    assert cache.get(("a",), "q") is None
+    assert cache._questions == {}
+
+
+def test_repeated_question_skips_the_chain(monkeypatch):
+    """
+    Test that asking the same question twice only runs the chain once
+    """
+    import asyncio
+
+    calls = []
+
+    class CountingChain:
+        async def ainvoke(self, inputs):
+            calls.append(inputs["input"])
+            return {"input": inputs["input"], "context": [], "answer": "Acme."}
+
+    monkeypatch.setattr(nlp2, "answer_cache", AnswerCache(maxsize=4))
+
+    async def ask_twice():
+        chain = CountingChain()
+        first = await nlp2.get_answer_from_model("Where did Alice work?", ["a"], chain)
+        second = await nlp2.get_answer_from_model("where did alice work", ["a"], chain)
+        return first, second
+
+    assert asyncio.run(ask_twice()) == ("Acme.", "Acme.")
+    assert calls == ["Where did Alice work?"]
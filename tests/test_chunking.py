@@ -0,0 +1,105 @@
+"""
+Test token-aware chunking
+
+This test module checks chunk sizes and overlap in tokens, that chunks
+respect page and section boundaries, and that long texts are split in
+linear time.
+"""
+
+import time
+
+import pytest
+
+from utils.chunking import chunk_pages, count_tokens, get_chunk_tokens, split_text
+
+
+def test_chunk_size_fits_context_window():
+    """
+    Test that k chunks plus the prompt and answer reserves fit the context
+    """
+    assert get_chunk_tokens(8192, 3) == 256
+    assert get_chunk_tokens(8192, 3, preferred=10_000) * 3 <= 8192 - 512 - 1024
+    assert get_chunk_tokens(2048, 8) == 64
+
+
+def test_split_text_respects_size_and_overlap():
+    """
+    Test that windows stay within the token limit, overlap, and cover the text
+    """
+    text = " ".join(f"word{i}" for i in range(1000))
+
+    spans = split_text(text, chunk_tokens=100, overlap_tokens=10)
+
+    assert all(token_count <= 100 for _, _, token_count in spans)
+    assert all(count_tokens(text[start:end]) == token_count for start, end, token_count in spans)
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    assert text[spans[1][0]:spans[1][1]].startswith("word90 ")
+
+
+def test_split_text_prefers_sentence_ends():
+    """
+    Test that a window ends after a full stop near its end rather than mid-sentence
+    """
+    sentence = "This sentence has exactly ten tokens in it ok."
+    text = " ".join([sentence] * 20)
+
+    spans = split_text(text, chunk_tokens=45, overlap_tokens=0)
+
+    assert all(text[end - 1] == "." for _, end, _ in spans)
+
+
+def test_page_strategy_keeps_page_boundaries():
+    """
+    Test that chunks never span pages and carry their page and offset
+    """
+    pages = ["alpha " * 30, "", "beta " * 30]
+
+    docs = chunk_pages(pages, chunk_tokens=20, metadata={"content_hash": "abc"}, strategy="page")
+
+    assert {doc.metadata["page"] for doc in docs} == {1, 3}
+    for doc in docs:
+        page = pages[doc.metadata["page"] - 1]
+        start = doc.metadata["start_index"]
+        assert page[start:start + len(doc.page_content)] == doc.page_content
+        assert doc.metadata["content_hash"] == "abc"
+        assert set(doc.page_content.split()) in ({"alpha"}, {"beta"})
+
+
+def test_section_strategy_splits_at_headings():
+    """
+    Test that chunks never span sections and carry the heading across pages
+    """
+    pages = [
+        "1. Introduction\nThe scope of this manual.\n\n2. Installation\nRun the installer.",
+        "Continue the installation.\n\nTROUBLESHOOTING\nRestart the service.",
+    ]
+
+    docs = chunk_pages(pages, chunk_tokens=50, strategy="section")
+
+    assert [(doc.metadata["page"], doc.metadata["section"]) for doc in docs] == [
+        (1, "1. Introduction"),
+        (1, "2. Installation"),
+        (2, "2. Installation"),
+        (2, "TROUBLESHOOTING"),
+    ]
+    assert docs[2].page_content == "Continue the installation."
+    with pytest.raises(ValueError):
+        chunk_pages(pages, chunk_tokens=50, strategy="unknown")
+
+
+def test_split_text_is_linear():
+    """
+    Test that splitting a few megabytes takes time proportional to its size
+    """
+    paragraph = "A line of extracted text, with punctuation. " * 20 + "\n\n"
+
+    def timed(repeat):
+        start = time.perf_counter()
+        spans = split_text(paragraph * repeat, chunk_tokens=256)
+        return time.perf_counter() - start, spans
+
+    small, _ = timed(500)
+    large, spans = timed(4000)  # about 3.6 MB
+
+    assert len(spans) > 1000
+    assert large < small * 8 * 3
@@ -0,0 +1,56 @@
+"""
+Test that the question-answer pipeline does not block the event loop
+
+This test module opens several WebSocket sessions at once against a QA
+chain with a fixed latency and checks they all finish in roughly the
+latency of one question rather than the sum of all of them.
+"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+from langchain_core.runnables import RunnableLambda
+
+from main import app
+
+
+LATENCY = 0.5
+SOCKETS = 8
+
+
+def make_slow_chain():
+    def invoke(inputs):
+        # A blocking call would serialize every socket on the worker
+        time.sleep(LATENCY)
+        return {"answer": f"answer to {inputs['input']}"}
+
+    async def ainvoke(inputs):
+        await asyncio.sleep(LATENCY)
+        return {"answer": f"answer to {inputs['input']}"}
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+
+def test_concurrent_sockets_finish_in_max_latency(stub_qa_session):
+    """
+    Test that N concurrent questions take about one latency, not N
+    """
+    stub_qa_session(make_slow_chain())
+
+    def ask(client, i):
+        with client.websocket_connect(f"/ws/question-answer?user_id={i}") as websocket:
+            websocket.send_text(json.dumps({"type": "question", "content": f"question {i}"}))
+            return json.loads(websocket.receive_text())
+
+    # Entering the client shares one event loop between every socket
+    with TestClient(app) as client:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=SOCKETS) as pool:
+            responses = list(pool.map(lambda i: ask(client, i), range(SOCKETS)))
+        elapsed = time.perf_counter() - start
+
+    assert [r["content"] for r in responses] == [f"answer to question {i}" for i in range(SOCKETS)]
+    assert elapsed < LATENCY * SOCKETS / 2
@@ -0,0 +1,195 @@
+"""
+Test the database engine configuration
+
+This test module checks the SQLite engine settings, the async session
+layer, and that open WebSocket sessions do not keep pooled connections
+checked out.
+"""
+
+import json
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from langchain_core.runnables import RunnableLambda
+
+from database.config import (
+    async_engine,
+    async_session_scope,
+    create_database_engine,
+    get_async_database_url,
+    session_scope,
+    DB_POOL_SIZE,
+)
+from database.models import (
+    PDFDocument,
+    PDFPage,
+    backfill_pdf_pages,
+    get_pdf_content_for_user,
+    get_pdf_documents_for_user,
+    get_pdf_documents_for_user_async,
+    get_pdf_pages_by_hash,
+)
+from main import app
+from websocket import question_answer
+
+
+def test_sqlite_engine_uses_wal_and_pool(tmp_path):
+    """
+    Test that SQLite connections are pooled and switched to WAL mode
+    """
+    sqlite_engine = create_database_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+    with sqlite_engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+
+    assert sqlite_engine.pool.size() == DB_POOL_SIZE
+    assert sqlite_engine.pool.checkedout() == 0
+    sqlite_engine.dispose()
+
+
+def test_async_database_urls():
+    """
+    Test that each backend is mapped to its async driver
+    """
+    assert str(get_async_database_url("sqlite:///./database.db")) == "sqlite+aiosqlite:///./database.db"
+    assert str(get_async_database_url("postgresql+psycopg2://u@host/db")) == "postgresql+asyncpg://u@host/db"
+    assert str(get_async_database_url("mysql+pymysql://u@host/db")) == "mysql+aiomysql://u@host/db"
+    with pytest.raises(ValueError):
+        get_async_database_url("oracle://u@host/db")
+
+
+@pytest.mark.asyncio
+async def test_async_queries_match_sync_queries():
+    """
+    Test that the async query variants return what the sync ones do
+    """
+    user_id = uuid.uuid4().int % 10**9
+    with session_scope() as db:
+        db.add_all([
+            PDFDocument(filename="a.pdf", page_count=1, content_hash="a" * 64, user_id=user_id),
+            PDFDocument(filename="b.pdf", page_count=None, content_hash="b" * 64, user_id=user_id),
+        ])
+        db.commit()
+        expected = get_pdf_documents_for_user(db, user_id)
+
+    try:
+        async with async_session_scope() as db:
+            documents = await get_pdf_documents_for_user_async(db, user_id)
+        assert documents == expected
+        assert [content_hash for _, content_hash in documents] == ["a" * 64]
+    finally:
+        with session_scope() as db:
+            db.query(PDFDocument).filter_by(user_id=user_id).delete()
+            db.commit()
+        await async_engine.dispose()
+
+
+def test_legacy_content_moves_to_pages():
+    """
+    Test that text stored in the document row is split out into page rows
+    """
+    user_id = uuid.uuid4().int % 10**9
+    content_hash = uuid.uuid4().hex
+    with session_scope() as db:
+        db.add(PDFDocument(filename="old.pdf", content="page one\fpage two", content_hash=content_hash, user_id=user_id))
+        db.commit()
+        try:
+            backfill_pdf_pages(db)
+
+            pdf = db.query(PDFDocument).filter_by(user_id=user_id).one()
+            assert pdf.content is None
+            assert pdf.page_count == 2
+            assert get_pdf_pages_by_hash(db, content_hash) == ["page one", "page two"]
+            assert get_pdf_content_for_user(db, user_id) == "page one\fpage two"
+        finally:
+            db.query(PDFPage).filter_by(content_hash=content_hash).delete()
+            db.query(PDFDocument).filter_by(user_id=user_id).delete()
+            db.commit()
+
+
+def test_open_sockets_do_not_hold_connections(stub_qa_session):
+    """
+    Test that connections go back to the pool while sockets stay open
+    """
+    stub_qa_session(RunnableLambda(lambda inputs: {"answer": "ok"}), documents=None)
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/question-answer?user_id=1") as first, \
+                client.websocket_connect("/ws/question-answer?user_id=2") as second:
+            for websocket in (first, second):
+                websocket.send_text(json.dumps({"type": "question", "content": "hello"}))
+                websocket.receive_text()
+
+            assert async_engine.pool.checkedout() == 0
+
+
+def test_legacy_documents_are_checked_against_the_index_once(stub_qa_session, monkeypatch):
+    """
+    Test that a document of unknown index state is looked up on the first
+    connection only, and flagged for every document sharing its content
+    """
+    user_id = uuid.uuid4().int % 10**9
+    content_hash = uuid.uuid4().hex
+    with session_scope() as db:
+        db.add_all([
+            PDFDocument(filename="old.pdf", page_count=1, content_hash=content_hash, user_id=user_id),
+            PDFDocument(filename="new.pdf", page_count=1, content_hash=uuid.uuid4().hex, user_id=user_id, indexed=True),
+        ])
+        db.commit()
+    looked_up = []
+    stub_qa_session(RunnableLambda(lambda inputs: {"answer": "ok"}), documents=None)
+    monkeypatch.setattr(question_answer, "find_unindexed_documents", lambda content_hashes: looked_up.append(content_hashes) or [])
+
+    try:
+        with TestClient(app) as client:
+            for _ in range(2):
+                with client.websocket_connect(f"/ws/question-answer?user_id={user_id}") as websocket:
+                    websocket.send_text(json.dumps({"type": "question", "content": str(uuid.uuid4())}))
+                    websocket.receive_text()
+        assert looked_up == [[content_hash]]
+        with session_scope() as db:
+            assert all(pdf.indexed for pdf in db.query(PDFDocument).filter_by(user_id=user_id))
+    finally:
+        with session_scope() as db:
+            db.query(PDFDocument).filter_by(user_id=user_id).delete()
+            db.commit()
+
+
+def test_legacy_indexing_reports_progress_and_failure(stub_qa_session, monkeypatch):
+    """
+    Test that a session indexing legacy documents tells the client, and
+    says so before closing when indexing fails
+    """
+    from starlette.websockets import WebSocketDisconnect
+
+    user_id = uuid.uuid4().int % 10**9
+    content_hash = uuid.uuid4().hex
+    with session_scope() as db:
+        db.add(PDFDocument(filename="old.pdf", page_count=1, content_hash=content_hash, user_id=user_id))
+        db.commit()
+    stub_qa_session(RunnableLambda(lambda inputs: {"answer": "ok"}), documents=None)
+    monkeypatch.setattr(question_answer, "find_unindexed_documents", lambda content_hashes: list(content_hashes))
+
+    def fail(content_hash, pages):
+        raise RuntimeError("embedding service unavailable")
+
+    monkeypatch.setattr(question_answer, "index_document", fail)
+
+    try:
+        with TestClient(app) as client:
+            with client.websocket_connect(f"/ws/question-answer?user_id={user_id}") as websocket:
+                frames = [json.loads(websocket.receive_text()) for _ in range(2)]
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    websocket.receive_text()
+        assert frames == [
+            {"type": "indexing", "done": 0, "total": 1},
+            {"type": "error", "content": question_answer.INDEXING_FAILED_MESSAGE},
+        ]
+        assert closed.value.code == question_answer.INTERNAL_ERROR
+        assert not question_answer.sessions
+    finally:
+        with session_scope() as db:
+            db.query(PDFDocument).filter_by(user_id=user_id).delete()
+            db.commit()
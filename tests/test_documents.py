@@ -0,0 +1,102 @@
+"""
+Test the document listing and detail endpoints
+
+This test module pages through a user's documents with keyset cursors,
+checks that other users' documents stay hidden, and that the listing
+query is served from the composite index.
+"""
+
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import status
+from httpx._client import AsyncClient
+from sqlalchemy.dialects import sqlite
+
+from database.config import engine, session_scope
+from database.models import PDFDocument, pdf_document_page_query
+from main import app
+
+
+@pytest.fixture
+def documents():
+    user_id = uuid.uuid4().int % 10**9
+    start = datetime(2024, 1, 1)
+    with session_scope() as db:
+        # Pairs of documents share an upload date, so ids break the ties
+        pdfs = [
+            PDFDocument(
+                filename=f"{i}.pdf",
+                upload_date=start + timedelta(minutes=i // 2),
+                content_hash=uuid.uuid4().hex,
+                page_count=1,
+                user_id=user_id,
+            )
+            for i in range(25)
+        ]
+        db.add_all(pdfs)
+        db.commit()
+        ids = [pdf.id for pdf in sorted(pdfs, key=lambda pdf: (pdf.upload_date, pdf.id), reverse=True)]
+    yield user_id, ids
+    with session_scope() as db:
+        db.query(PDFDocument).filter_by(user_id=user_id).delete()
+        db.commit()
+
+
+@pytest.mark.asyncio
+async def test_list_documents_pages_with_cursor(documents):
+    """
+    Test that following cursors returns every document once, newest first
+    """
+    user_id, expected_ids = documents
+    seen, cursor = [], None
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        while True:
+            params = {"user_id": user_id, "limit": 10, **({"cursor": cursor} if cursor else {})}
+            response = await client.get("/documents/", params=params)
+            assert response.status_code == status.HTTP_200_OK
+            page = response.json()
+            seen.extend(document["id"] for document in page["documents"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        invalid = await client.get("/documents/", params={"user_id": user_id, "cursor": "???"})
+
+    assert seen == expected_ids
+    assert "content" not in page["documents"][0]
+    assert invalid.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_get_document_is_scoped_to_user(documents):
+    """
+    Test that a document's metadata is only returned to its owner
+    """
+    user_id, ids = documents
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        own = await client.get(f"/documents/{ids[0]}", params={"user_id": user_id})
+        other = await client.get(f"/documents/{ids[0]}", params={"user_id": user_id + 1})
+
+    assert own.status_code == status.HTTP_200_OK
+    assert own.json()["id"] == ids[0]
+    assert own.json()["page_count"] == 1
+    assert other.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_listing_uses_composite_index():
+    """
+    Test that a listing page is a range scan of the (user_id, upload_date, id) index
+    """
+    if engine.dialect.name != "sqlite":
+        pytest.skip("query plan check is written for SQLite")
+    query = pdf_document_page_query(1, 10, after=(datetime(2024, 1, 1), 5))
+    sql = str(query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+
+    with engine.connect() as conn:
+        plan = " ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+
+    assert "ix_pdf_documents_user_upload" in plan
+    assert "TEMP B-TREE" not in plan
@@ -0,0 +1,103 @@
+"""
+Test the persistent embedding cache
+
+This test module checks that cached chunks are not re-embedded, that the
+cache survives reopening from disk and that it evicts least recently
+used entries once full.
+"""
+
+import numpy as np
+
+from utils.embedding_cache import CachedEmbeddings, EmbeddingDiskCache
+from utils.embeddings import HashingEmbeddings
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    def __init__(self):
+        super().__init__(dim=16)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+def test_repeated_chunks_are_embedded_once(tmp_path):
+    """
+    Test that only unseen chunks reach the wrapped embedder
+    """
+    inner = CountingEmbeddings()
+    cache = EmbeddingDiskCache(str(tmp_path), capacity=10)
+    embeddings = CachedEmbeddings(inner, cache, inner.model_name)
+
+    first = embeddings.embed_documents(["a", "b", "a"])
+    second = embeddings.embed_documents(["b", "c"])
+
+    assert inner.embedded == ["a", "b", "c"]
+    assert np.allclose(first[1], second[0])
+    assert np.allclose(first[0], first[2])
+    assert cache.stats() == {"hits": 1, "misses": 3, "entries": 3}
+
+
+def test_cache_persists_on_disk(tmp_path):
+    """
+    Test that vectors written by one process are read back by the next
+    """
+    cache = EmbeddingDiskCache(str(tmp_path), capacity=10)
+    cache.put_many(["x"], np.ones((1, 4), dtype=np.float32))
+
+    reopened = EmbeddingDiskCache(str(tmp_path), capacity=10)
+
+    assert np.allclose(reopened.get_many(["x"])["x"], np.ones(4))
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """
+    Test that a full cache overwrites the entries used longest ago
+    """
+    cache = EmbeddingDiskCache(str(tmp_path), capacity=2)
+    cache.put_many(["a"], np.full((1, 4), 1.0))
+    cache.put_many(["b"], np.full((1, 4), 2.0))
+    cache.get_many(["a"])
+    cache.put_many(["c"], np.full((1, 4), 3.0))
+
+    found = cache.get_many(["a", "b", "c"])
+
+    assert len(cache) == 2
+    assert sorted(found) == ["a", "c"]
+    assert np.allclose(found["c"], 3.0)
+
+
+def test_cache_reopened_with_another_capacity(tmp_path):
+    """
+    Test that a smaller capacity keeps the most recently used vectors and
+    a larger one keeps them all, without refilling the cache
+    """
+    cache = EmbeddingDiskCache(str(tmp_path), capacity=4)
+    for value, key in enumerate("abcd"):
+        cache.put_many([key], np.full((1, 4), float(value)))
+    cache.get_many(["a"])
+
+    smaller = EmbeddingDiskCache(str(tmp_path), capacity=2)
+    found = smaller.get_many(list("abcd"))
+    assert sorted(found) == ["a", "d"]
+    assert np.allclose(found["a"], 0.0) and np.allclose(found["d"], 3.0)
+
+    larger = EmbeddingDiskCache(str(tmp_path), capacity=5)
+    larger.put_many(["e", "f", "g"], np.full((3, 4), 9.0))
+    assert len(larger) == 5
+    assert sorted(larger.get_many(list("adefg"))) == list("adefg")
+
+
+def test_many_keys_are_stored_in_batches(tmp_path):
+    """
+    Test that storing more keys than one query takes works
+    """
+    cache = EmbeddingDiskCache(str(tmp_path), capacity=2000)
+    keys = [f"key {i}" for i in range(1200)]
+    cache.put_many(keys, np.arange(1200 * 4, dtype=np.float32).reshape(1200, 4))
+    cache.put_many(keys[:600], np.zeros((600, 4)))
+
+    found = cache.get_many(keys)
+    assert len(cache) == len(found) == 1200
+    assert np.allclose(found["key 0"], 0.0) and np.allclose(found["key 1199"], np.arange(4796, 4800))
@@ -0,0 +1,60 @@
+"""
+Test the local hashing embedding backend
+
+This test module checks that local embeddings are deterministic,
+normalised, batch-independent and rank related texts above unrelated ones.
+"""
+
+import numpy as np
+import pytest
+
+from utils.embeddings import HashingEmbeddings, create_embeddings
+
+
+def test_local_embeddings_are_deterministic_and_normalised():
+    """
+    Test that the same text always maps to the same unit vector
+    """
+    embeddings = HashingEmbeddings(dim=256)
+
+    first = np.array(embeddings.embed_query("Alice worked at Acme"))
+    second = np.array(HashingEmbeddings(dim=256).embed_query("Alice worked at Acme"))
+
+    assert first.shape == (256,)
+    assert np.allclose(first, second)
+    assert np.isclose(np.linalg.norm(first), 1.0)
+
+
+def test_batched_embedding_matches_single_texts():
+    """
+    Test that splitting texts into batches does not change their vectors
+    """
+    texts = [f"chunk number {i} about topic {i % 3}" for i in range(10)] + [""]
+    batched = HashingEmbeddings(dim=128, batch_size=3).embed_array(texts)
+
+    assert batched.dtype == np.float32
+    assert batched.shape == (11, 128)
+    for text, row in zip(texts, batched):
+        assert np.allclose(row, HashingEmbeddings(dim=128).embed_query(text), atol=1e-6)
+
+
+def test_related_texts_are_closer():
+    """
+    Test that cosine similarity ranks overlapping texts above unrelated ones
+    """
+    embeddings = HashingEmbeddings()
+    query, related, unrelated = embeddings.embed_array([
+        "Where did Alice work as an engineer?",
+        "Alice worked as an engineer at Acme.",
+        "The weather in spring is mild.",
+    ])
+
+    assert query @ related > query @ unrelated
+
+
+def test_unknown_backend_is_rejected():
+    """
+    Test that a misconfigured backend fails loudly
+    """
+    with pytest.raises(ValueError):
+        create_embeddings("missing")
@@ -0,0 +1,42 @@
+"""
+Test parallel PDF text extraction
+
+This test module checks that page ranges extracted across the process
+pool are merged back in page order with progress reported throughout.
+"""
+
+import fitz
+import pytest
+
+from utils.extraction import extract_page_range, extract_pdf_pages, get_page_ranges
+
+
+def test_page_ranges_cover_document_once():
+    """
+    Test that page ranges are consecutive, bounded, and spread over workers
+    """
+    assert get_page_ranges(0) == []
+    assert get_page_ranges(10, workers=4, batch_pages=32) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    ranges = get_page_ranges(1000, workers=4, batch_pages=32)
+    assert ranges[0] == (0, 32) and ranges[-1][1] == 1000
+    assert all(stop == next_start for (_, stop), (next_start, _) in zip(ranges, ranges[1:]))
+
+
+@pytest.mark.asyncio
+async def test_extract_pdf_pages_keeps_page_order(tmp_path):
+    """
+    Test that pages come back in order and progress reaches the page count
+    """
+    doc = fitz.open()
+    for page_number in range(70):
+        doc.new_page().insert_text((72, 72), f"This is page {page_number}")
+    file_path = str(tmp_path / "long.pdf")
+    doc.save(file_path)
+
+    progress = []
+    pages = await extract_pdf_pages(file_path, on_progress=lambda done, total: progress.append((done, total)))
+
+    assert pages == extract_page_range(file_path, 0, 70)
+    assert [page.strip() for page in pages] == [f"This is page {i}" for i in range(70)]
+    assert progress[0] == (0, 70)
+    assert progress[-1] == (70, 70)
@@ -0,0 +1,238 @@
+"""
+Test LLM routing across API keys
+
+This test module runs the router's Groq clients against a local stub of
+the chat completions API to check failover on rate limits, circuit
+breaking of failing keys, and hedging of slow requests.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from utils.llm import LLMEndpoint, LLMRouter, RetryBudget, create_groq_client
+
+
+class StubGroqHandler(BaseHTTPRequestHandler):
+    """Answers like Groq's chat completions API; the API key picks the behaviour."""
+
+    calls = []
+
+    def do_POST(self):
+        key = self.headers["Authorization"].removeprefix("Bearer ")
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubGroqHandler.calls.append(key)
+
+        if key == "limited":
+            self.reply(429, {"error": {"message": "rate limited"}}, {"retry-after": "30"})
+        elif key == "down":
+            self.reply(500, {"error": {"message": "server error"}})
+        elif request.get("stream"):
+            self.stream(["answer ", "from ", key])
+        else:
+            self.reply(200, {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "stub",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": f"answer from {key}"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            })
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream(self, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for index, token in enumerate(tokens):
+            finish_reason = "stop" if index == len(tokens) - 1 else None
+            chunk = {
+                "id": "stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "stub",
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGroqHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StubGroqHandler.calls = []
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def make_router(base_url, *keys, **kwargs):
+    endpoints = [LLMEndpoint(key, create_groq_client(key, base_url), failure_threshold=2) for key in keys]
+    return LLMRouter(endpoints, hedge_delay=0, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_key_fails_over_and_cools_down(stub_server):
+    """
+    Test that a 429 moves the request to the next key and parks the first one
+    """
+    router = make_router(stub_server, "limited", "good")
+
+    first = await router.ainvoke("hello")
+    second = await router.ainvoke("hello")
+
+    assert first.content == second.content == "answer from good"
+    assert StubGroqHandler.calls == ["limited", "good", "good"]
+    assert not router.endpoints[0].is_available()
+
+
+@pytest.mark.asyncio
+async def test_failing_key_opens_circuit(stub_server):
+    """
+    Test that a key failing repeatedly stops receiving requests
+    """
+    router = make_router(stub_server, "down", "good")
+
+    for _ in range(3):
+        assert (await router.ainvoke("hello")).content == "answer from good"
+
+    assert StubGroqHandler.calls == ["down", "good", "down", "good", "good"]
+
+
+@pytest.mark.asyncio
+async def test_stream_fails_over_before_first_token(stub_server):
+    """
+    Test that a stream failing before any token is retried on the next key
+    """
+    router = make_router(stub_server, "down", "good")
+
+    chunks = [chunk.content async for chunk in router.astream("hello")]
+
+    assert chunks == ["answer ", "from ", "good"]
+    assert StubGroqHandler.calls == ["down", "good"]
+
+
+@pytest.mark.asyncio
+async def test_retry_budget_limits_failover(stub_server):
+    """
+    Test that failover stops once the retry budget is spent
+    """
+    router = make_router(stub_server, "down", "good", retry_budget=RetryBudget(ratio=0, max_tokens=1))
+
+    assert (await router.ainvoke("hello")).content == "answer from good"
+    router.endpoints[0].record_success()
+    with pytest.raises(Exception):
+        await router.ainvoke("hello")
+
+
+@pytest.mark.asyncio
+async def test_slow_request_is_hedged():
+    """
+    Test that a slow key is raced against the next one and the first answer wins
+    """
+    async def slow(_):
+        await asyncio.sleep(2)
+        return "slow"
+
+    async def fast(_):
+        return "fast"
+
+    router = LLMRouter(
+        [LLMEndpoint("slow", RunnableLambda(slow)), LLMEndpoint("fast", RunnableLambda(fast))],
+        hedge_delay=0.05,
+    )
+
+    start = time.perf_counter()
+    assert await router.ainvoke("hello") == "fast"
+    assert time.perf_counter() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_half_open_circuit_lets_one_trial_through():
+    """
+    Test that a key whose circuit reopens gets a single trial request
+    while concurrent requests keep going to the next key
+    """
+    calls = []
+    healthy = asyncio.Event()
+
+    async def flaky(_):
+        calls.append("flaky")
+        if not healthy.is_set():
+            raise RuntimeError("server error")
+        await asyncio.sleep(0.05)
+        return "flaky"
+
+    async def good(_):
+        calls.append("good")
+        return "good"
+
+    router = LLMRouter(
+        [LLMEndpoint("flaky", RunnableLambda(flaky), failure_threshold=2, reset_timeout=0.05),
+         LLMEndpoint("good", RunnableLambda(good))],
+        hedge_delay=0,
+        retry_budget=RetryBudget(max_tokens=10),
+    )
+    for _ in range(2):
+        assert await router.ainvoke("hello") == "good"
+    assert await router.ainvoke("hello") == "good"
+    assert calls.count("flaky") == 2
+
+    await asyncio.sleep(0.06)
+    healthy.set()
+    calls.clear()
+    answers = await asyncio.gather(*(router.ainvoke("hello") for _ in range(5)))
+
+    assert sorted(answers) == ["flaky"] + ["good"] * 4
+    assert calls.count("flaky") == 1
+    # The trial succeeded, so the key is back in use
+    assert await router.ainvoke("hello") == "flaky"
+
+
+@pytest.mark.asyncio
+async def test_half_open_backup_is_not_parked_by_healthy_primary():
+    """
+    Test that requests answered by the primary key do not use up a
+    half-open backup's trial, so the backup is tried once it is needed
+    """
+    primary_down = threading.Event()
+
+    def primary(_):
+        if primary_down.is_set():
+            raise RuntimeError("server error")
+        return "primary"
+
+    def backup(_):
+        return "backup"
+
+    backup_endpoint = LLMEndpoint("backup", RunnableLambda(backup), failure_threshold=1, reset_timeout=0.05)
+    router = LLMRouter([LLMEndpoint("primary", RunnableLambda(primary)), backup_endpoint], hedge_delay=0)
+    backup_endpoint.record_failure(RuntimeError("server error"))
+    await asyncio.sleep(0.06)
+
+    for _ in range(3):
+        assert await router.ainvoke("hello") == "primary"
+        assert router.invoke("hello") == "primary"
+    assert backup_endpoint.is_available()
+
+    primary_down.set()
+    assert await router.ainvoke("hello") == "backup"
+    assert backup_endpoint.consecutive_failures == 0
@@ -0,0 +1,137 @@
+"""
+Test the hot-path metrics
+
+This test module checks the Prometheus rendering of the metric types,
+that timing spans reach the request that asked for them (also from the
+QA executor and from batches shared with other requests), and the
+`/metrics` endpoint and answer-frame breakdown.
+"""
+
+import asyncio
+import json
+import threading
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
+
+from main import app
+from utils import nlp2
+from utils.batching import MicroBatcher
+from utils.metrics import MetricsRegistry, collect_timings, record_stage, timed
+from websocket import question_answer
+
+
+def test_registry_renders_prometheus_text():
+    """
+    Test that counters, gauges and cumulative histogram buckets are rendered
+    """
+    registry = MetricsRegistry()
+    registry.counter("hits_total", "Hits.", ["result"]).inc(2, result="hit")
+    registry.gauge("depth", "Depth.", function=lambda: 3)
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+
+    text = registry.render()
+
+    assert '# TYPE hits_total counter\nhits_total{result="hit"} 2.0' in text
+    assert "depth 3.0" in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "latency_seconds_count 3" in text
+    assert registry.counter("hits_total", "Hits.", ["result"]) is registry.counter("hits_total", "Hits.", ["result"])
+    with pytest.raises(ValueError):
+        registry.gauge("hits_total", "Hits.")
+
+
+@pytest.mark.asyncio
+async def test_spans_from_executor_reach_the_request():
+    """
+    Test that spans timed in run_blocking are summed into the caller's timings
+    """
+    def work():
+        with timed("embedding"):
+            pass
+
+    with collect_timings() as timings:
+        await nlp2.run_blocking(work)
+        await nlp2.run_blocking(work)
+    with timed("embedding"):
+        pass
+
+    assert set(timings) == {"embedding"}
+    assert timings["embedding"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_batch_spans_reach_every_request_in_the_batch():
+    """
+    Test that the spans of a batch are credited to each request it served,
+    not only to the one that started it
+    """
+    def process(items):
+        record_stage("embedding", 0.5)
+        return items
+
+    batcher = MicroBatcher("test", process, nlp2.run_blocking, window=0.01)
+
+    async def request(item):
+        with collect_timings() as timings:
+            await batcher.submit(item)
+        return timings
+
+    assert await asyncio.gather(request(1), request(2)) == [{"embedding": 0.5}] * 2
+
+
+@pytest.mark.asyncio
+async def test_executor_queue_depth_counts_waiting_work():
+    """
+    Test that work waiting for an executor thread is counted until it starts
+    """
+    release = threading.Event()
+    busy = [nlp2.run_blocking(release.wait) for _ in range(nlp2.QA_EXECUTOR_WORKERS + 2)]
+    tasks = [asyncio.ensure_future(call) for call in busy]
+    await asyncio.sleep(0.05)
+    assert nlp2.EXECUTOR_QUEUE_DEPTH.value() == 2
+
+    tasks[-1].cancel()
+    await asyncio.sleep(0)
+    assert nlp2.EXECUTOR_QUEUE_DEPTH.value() == 1
+    release.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert nlp2.EXECUTOR_QUEUE_DEPTH.value() == 0
+
+
+def test_answer_timings_and_metrics_endpoint(stub_qa_session, monkeypatch):
+    """
+    Test that an answer frame breaks down its time when asked and that the
+    spans show up on /metrics
+    """
+    retriever = RunnableLambda(lambda question: [Document(page_content="Alice worked at Acme.", metadata={})])
+    chain = nlp2.create_qa_chain(retriever, llm=FakeListChatModel(responses=["Acme."]))
+
+    stub_qa_session(chain)
+    monkeypatch.setattr(nlp2.answer_cache, "similarity_threshold", 0.0)
+    question = f"Where did Alice work? {uuid.uuid4()}"
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/question-answer?user_id=1") as websocket:
+            websocket.send_text(json.dumps({"type": "question", "content": question, "timings": True}))
+            timed_frame = json.loads(websocket.receive_text())
+            websocket.send_text(json.dumps({"type": "question", "content": question}))
+            plain_frame = json.loads(websocket.receive_text())
+            metrics = client.get("/metrics")
+
+    assert timed_frame["content"] == "Acme."
+    assert {"cache_lookup", "queue", "retrieval", "llm", "total"} <= set(timed_frame["timings"])
+    assert timed_frame["timings"]["total"] >= timed_frame["timings"]["llm"]
+    assert "timings" not in plain_frame
+    assert metrics.headers["content-type"].startswith("text/plain")
+    assert 'pdf_qa_stage_seconds_count{stage="llm"}' in metrics.text
+    assert 'pdf_qa_answer_cache_lookups_total{result="hit"}' in metrics.text
+    assert "pdf_qa_active_sessions" in metrics.text
@@ -11,6 +11,7 @@ from httpx._client import AsyncClient
 from fastapi import status
 from main import app
 import os
+import uuid
 
 
 @pytest.mark.asyncio
@@ -73,3 +74,368 @@ async def test_upload_unsupported_file_format():
     assert response.status_code == status.HTTP_400_BAD_REQUEST
     assert response.json()["detail"] == "File must be a PDF."
 
+
+
+def make_unique_pdf():
+    """Build a small PDF whose bytes have never been uploaded before."""
+    import fitz
+
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), f"Unique test document {uuid.uuid4().hex}")
+    return doc.tobytes()
+
+
+def delete_uploaded_pdfs(document_ids):
+    from database.config import SessionLocal
+    from database.models import PDFChunk, PDFDocument, PDFPage
+
+    db = SessionLocal()
+    try:
+        documents = db.query(PDFDocument).filter(PDFDocument.id.in_(document_ids))
+        content_hashes = {pdf.content_hash for pdf in documents}
+        for model in (PDFPage, PDFChunk):
+            db.query(model).filter(model.content_hash.in_(content_hashes)).delete()
+        documents.delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.mark.asyncio
+async def test_upload_pdf_reports_background_job(monkeypatch):
+    """
+    Test that an upload returns a job id whose status tracks extraction
+    """
+    import main
+    from langchain_core.documents import Document
+    from database.config import SessionLocal
+    from database.models import PDFChunk, PDFDocument, get_pdf_pages_by_hash
+
+    indexed = {}
+
+    def fake_index_document(content_hash, pages, previous_hash=None):
+        indexed[content_hash] = pages
+        return [Document(page_content=pages[0], metadata={"page": 1, "start_index": 0})]
+
+    monkeypatch.setattr(main, "index_document", fake_index_document)
+    pdf_data = make_unique_pdf()
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        files = {"file": ("report.pdf", pdf_data, "application/pdf")}
+        response = await client.post("/upload-pdf/", files=files)
+        job_id = response.json()["job_id"]
+        status_response = await client.get(f"/upload-pdf/status/{job_id}")
+        missing_response = await client.get("/upload-pdf/status/unknown")
+
+    document_id = response.json()["id"]
+    job = status_response.json()
+    assert job["status"] == "done"
+    assert job["pages_total"] == 1
+    assert job["pages_done"] == job["pages_total"]
+    assert missing_response.status_code == status.HTTP_404_NOT_FOUND
+
+    db = SessionLocal()
+    try:
+        pdf = db.query(PDFDocument).filter_by(id=document_id).first()
+        pages = get_pdf_pages_by_hash(db, pdf.content_hash)
+        chunks = db.query(PDFChunk).filter_by(content_hash=pdf.content_hash).all()
+        assert pdf.content is None
+        assert pdf.page_count == len(pages) == 1
+        assert "Unique test document" in pages[0]
+        assert indexed == {pdf.content_hash: pages}
+        assert [(chunk.chunk_index, chunk.page_number, chunk.text) for chunk in chunks] == [(0, 1, pages[0])]
+        os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{pdf.content_hash}.pdf"))
+    finally:
+        db.close()
+    delete_uploaded_pdfs([document_id])
+
+
+@pytest.mark.asyncio
+async def test_upload_same_bytes_skips_processing(monkeypatch):
+    """
+    Test that re-uploading known bytes under another name reuses the
+    extracted text and index instead of processing the file again
+    """
+    import main
+
+    indexed = []
+
+    def fake_index_document(content_hash, pages, previous_hash=None):
+        indexed.append(content_hash)
+        return []
+
+    monkeypatch.setattr(main, "index_document", fake_index_document)
+    pdf_data = make_unique_pdf()
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        first = await client.post("/upload-pdf/", files={"file": ("a.pdf", pdf_data, "application/pdf")})
+        second = await client.post("/upload-pdf/", files={"file": ("b.pdf", pdf_data, "application/pdf")})
+
+    assert first.json()["status"] == "queued"
+    assert second.json()["status"] == "done"
+    assert second.json()["job_id"] is None
+    assert len(indexed) == 1
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{indexed[0]}.pdf"))
+    delete_uploaded_pdfs([first.json()["id"], second.json()["id"]])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_uploads_of_same_bytes_share_one_job(monkeypatch):
+    """
+    Test that bytes uploaded again while still being processed follow the
+    running job, and every uploader's document is completed by it
+    """
+    import asyncio
+    import time
+    import main
+    from database.config import SessionLocal
+    from database.models import PDFDocument
+
+    indexed = []
+
+    def slow_index_document(content_hash, pages, previous_hash=None):
+        indexed.append(content_hash)
+        time.sleep(0.3)
+        return []
+
+    monkeypatch.setattr(main, "index_document", slow_index_document)
+    pdf_data = make_unique_pdf()
+    user_id, other_user_id = uuid.uuid4().int % 10**9, uuid.uuid4().int % 10**9
+
+    async def upload(user):
+        async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+            files = {"file": ("same.pdf", pdf_data, "application/pdf")}
+            return (await client.post("/upload-pdf/", params={"user_id": user}, files=files)).json()
+
+    first = asyncio.ensure_future(upload(user_id))
+    await asyncio.sleep(0.1)
+    again, other = await asyncio.gather(upload(user_id), upload(other_user_id))
+    first = await first
+
+    assert len(indexed) == 1
+    assert again["id"] == first["id"] and again["job_id"] == first["job_id"] == other["job_id"]
+    db = SessionLocal()
+    try:
+        pdfs = db.query(PDFDocument).filter(PDFDocument.user_id.in_([user_id, other_user_id])).all()
+        assert sorted(pdf.id for pdf in pdfs) == sorted([first["id"], other["id"]])
+        assert all(pdf.page_count == 1 for pdf in pdfs)
+    finally:
+        db.close()
+    assert not main.uploads_in_flight
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{indexed[0]}.pdf"))
+    delete_uploaded_pdfs([first["id"], other["id"]])
+
+
+@pytest.mark.asyncio
+async def test_job_evicted_from_cache_still_runs(monkeypatch):
+    """
+    Test that an upload whose job is evicted from the job cache before it
+    starts is still processed, and its status can still be read meanwhile
+    """
+    import asyncio
+    import time
+    import main
+    from database.config import SessionLocal
+    from database.models import PDFDocument
+    from utils.cache import LRUCache
+
+    indexed = []
+
+    def slow_index_document(content_hash, pages, previous_hash=None):
+        indexed.append(content_hash)
+        time.sleep(0.3)
+        return []
+
+    monkeypatch.setattr(main, "index_document", slow_index_document)
+    monkeypatch.setattr(main, "upload_jobs", LRUCache(maxsize=0))
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        files = {"file": ("evicted.pdf", make_unique_pdf(), "application/pdf")}
+        upload = asyncio.ensure_future(client.post("/upload-pdf/", files=files))
+        await asyncio.sleep(0.2)
+        [in_flight] = main.uploads_in_flight.values()
+        running = await client.get(f"/upload-pdf/status/{in_flight['job']['job_id']}")
+        response = (await upload).json()
+
+    assert running.json()["status"] == "indexing"
+    db = SessionLocal()
+    try:
+        assert db.query(PDFDocument).filter_by(id=response["id"]).one().page_count == 1
+    finally:
+        db.close()
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{indexed[0]}.pdf"))
+    delete_uploaded_pdfs([response["id"]])
+
+
+@pytest.mark.asyncio
+async def test_reupload_with_changes_replaces_previous_version(monkeypatch):
+    """
+    Test that changed bytes under the same name update the user's document
+    in place, index against the previous version, and drop the old content
+    """
+    import main
+    from database.config import SessionLocal
+    from database.models import PDFDocument, get_pdf_pages_by_hash
+
+    calls = []
+    released = []
+
+    def fake_index_document(content_hash, pages, previous_hash=None):
+        calls.append((content_hash, previous_hash))
+        return []
+
+    monkeypatch.setattr(main, "index_document", fake_index_document)
+    monkeypatch.setattr(main, "delete_document_index", released.append)
+    user_id = uuid.uuid4().int % 10**9
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        params = {"user_id": user_id}
+        first = await client.post("/upload-pdf/", params=params, files={"file": ("manual.pdf", make_unique_pdf(), "application/pdf")})
+        second = await client.post("/upload-pdf/", params=params, files={"file": ("manual.pdf", make_unique_pdf(), "application/pdf")})
+
+    assert second.json()["status"] == "queued"
+    assert second.json()["id"] == first.json()["id"]
+    (old_hash, _), (new_hash, previous_hash) = calls
+    assert previous_hash == old_hash != new_hash
+    assert released == [old_hash]
+    assert not os.path.exists(os.path.join(main.UPLOAD_DIRECTORY, f"{old_hash}.pdf"))
+
+    db = SessionLocal()
+    try:
+        pdf = db.query(PDFDocument).filter_by(id=first.json()["id"]).one()
+        assert pdf.content_hash == new_hash
+        assert get_pdf_pages_by_hash(db, old_hash) == []
+        assert len(get_pdf_pages_by_hash(db, new_hash)) == pdf.page_count == 1
+    finally:
+        db.close()
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{new_hash}.pdf"))
+    delete_uploaded_pdfs([first.json()["id"]])
+
+
+@pytest.mark.parametrize("delays", [(0.1, 0.5), (0.5, 0.1)])
+@pytest.mark.asyncio
+async def test_versions_processed_together_release_every_replaced_one(monkeypatch, delays):
+    """
+    Test that two new versions uploaded back to back leave the document on
+    the later one, whichever finishes first, and release both others
+    """
+    import asyncio
+    import time
+    import main
+    from database.config import SessionLocal
+    from database.models import PDFDocument, get_pdf_pages_by_hash
+
+    calls = []
+    released = []
+
+    def slow_index_document(content_hash, pages, previous_hash=None):
+        calls.append(content_hash)
+        if len(calls) > 1:
+            time.sleep(delays[len(calls) - 2])
+        return []
+
+    monkeypatch.setattr(main, "index_document", slow_index_document)
+    monkeypatch.setattr(main, "delete_document_index", released.append)
+    params = {"user_id": uuid.uuid4().int % 10**9}
+
+    async def upload():
+        async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+            files = {"file": ("manual.pdf", make_unique_pdf(), "application/pdf")}
+            return (await client.post("/upload-pdf/", params=params, files=files)).json()
+
+    first = await upload()
+    second = asyncio.ensure_future(upload())
+    await asyncio.sleep(0.05)
+    third = await upload()
+    await second
+
+    old_hash, second_hash, third_hash = calls
+    assert sorted(released) == sorted([old_hash, second_hash])
+    db = SessionLocal()
+    try:
+        pdf = db.query(PDFDocument).filter_by(id=first["id"]).one()
+        assert pdf.content_hash == third_hash
+        assert get_pdf_pages_by_hash(db, old_hash) == get_pdf_pages_by_hash(db, second_hash) == []
+    finally:
+        db.close()
+    assert not os.path.exists(os.path.join(main.UPLOAD_DIRECTORY, f"{second_hash}.pdf"))
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{third_hash}.pdf"))
+    delete_uploaded_pdfs([first["id"]])
+
+
+@pytest.mark.asyncio
+async def test_failed_version_is_released(monkeypatch):
+    """
+    Test that a new version failing to index leaves the document on its
+    previous content and drops the new file and pages
+    """
+    import main
+    from database.config import SessionLocal
+    from database.models import PDFDocument, get_pdf_pages_by_hash
+
+    calls = []
+
+    def fake_index_document(content_hash, pages, previous_hash=None):
+        calls.append(content_hash)
+        if previous_hash:
+            raise RuntimeError("embedding failed")
+        return []
+
+    monkeypatch.setattr(main, "index_document", fake_index_document)
+    monkeypatch.setattr(main, "delete_document_index", lambda content_hash: None)
+    params = {"user_id": uuid.uuid4().int % 10**9}
+
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        first = await client.post("/upload-pdf/", params=params, files={"file": ("manual.pdf", make_unique_pdf(), "application/pdf")})
+        second = await client.post("/upload-pdf/", params=params, files={"file": ("manual.pdf", make_unique_pdf(), "application/pdf")})
+        job = (await client.get(f"/upload-pdf/status/{second.json()['job_id']}")).json()
+
+    old_hash, new_hash = calls
+    assert job["status"] == "failed"
+    db = SessionLocal()
+    try:
+        pdf = db.query(PDFDocument).filter_by(id=first.json()["id"]).one()
+        assert pdf.content_hash == old_hash
+        assert get_pdf_pages_by_hash(db, new_hash) == []
+        assert len(get_pdf_pages_by_hash(db, old_hash)) == 1
+    finally:
+        db.close()
+    assert not os.path.exists(os.path.join(main.UPLOAD_DIRECTORY, f"{new_hash}.pdf"))
+    os.remove(os.path.join(main.UPLOAD_DIRECTORY, f"{old_hash}.pdf"))
+    delete_uploaded_pdfs([first.json()["id"]])
+
+
+@pytest.mark.asyncio
+async def test_upload_rejects_non_pdf_content():
+    """
+    Test that a file named .pdf without PDF content is rejected
+    """
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        files = {"file": ("fake.pdf", b"not really a pdf", "application/pdf")}
+        response = await client.post("/upload-pdf/", files=files)
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["detail"] == "File must be a PDF."
+
+
+def test_spool_upload_memory_is_bounded_by_chunk(tmp_path):
+    """
+    Test that copying a large upload allocates about one chunk, not the file
+    """
+    import hashlib
+    import tracemalloc
+    from main import spool_upload, UPLOAD_CHUNK_SIZE
+
+    data = b"%PDF-" + os.urandom(16 * UPLOAD_CHUNK_SIZE)
+    source_path = tmp_path / "upload.pdf"
+    source_path.write_bytes(data)
+
+    with open(source_path, "rb") as source, open(tmp_path / "copy.pdf", "wb") as destination:
+        tracemalloc.start()
+        size, header, content_hash = spool_upload(source, destination)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    assert (size, header, content_hash) == (len(data), b"%PDF-", hashlib.sha256(data).hexdigest())
+    assert (tmp_path / "copy.pdf").read_bytes() == data
+    assert peak < 2 * UPLOAD_CHUNK_SIZE
@@ -0,0 +1,61 @@
+"""
+Test the streaming question-answer protocol
+
+This test module checks that a question sent with `"stream": true` is
+answered with `answer_chunk` frames followed by an `answer_end` frame,
+and that plain questions still get a single `answer` frame.
+"""
+
+import json
+
+from fastapi.testclient import TestClient
+from langchain_core.documents import Document
+
+from main import app
+
+
+TOKENS = ["Alice ", "worked ", "at ", "Acme."]
+
+
+class FakeRetrievalChain:
+    """Stands in for create_retrieval_chain's output without calling an LLM."""
+
+    async def ainvoke(self, inputs):
+        return {"input": inputs["input"], "answer": "".join(TOKENS)}
+
+    async def astream(self, inputs):
+        # Like the real chain: input and context first, then answer pieces
+        yield {"input": inputs["input"]}
+        yield {"context": [Document(page_content="Alice worked at Acme.", metadata={"content_hash": "abc", "page": 1})]}
+        for token in TOKENS:
+            yield {"answer": token}
+
+
+def connect(stub_qa_session):
+    stub_qa_session(FakeRetrievalChain())
+    return TestClient(app).websocket_connect("/ws/question-answer?user_id=1")
+
+
+def test_streamed_answer_frames(stub_qa_session):
+    """
+    Test that a streaming question yields chunks then an end frame
+    """
+    with connect(stub_qa_session) as websocket:
+        websocket.send_text(json.dumps({"type": "question", "content": "Where did Alice work?", "stream": True}))
+        frames = [json.loads(websocket.receive_text()) for _ in range(len(TOKENS) + 1)]
+
+    assert [f["type"] for f in frames] == ["answer_chunk"] * len(TOKENS) + ["answer_end"]
+    assert [f["content"] for f in frames[:-1]] == TOKENS
+    assert frames[-1]["content"] == "".join(TOKENS)
+    assert frames[-1]["sources"] == [{"content_hash": "abc", "page": 1, "document_id": 1}]
+
+
+def test_plain_question_still_gets_single_answer(stub_qa_session):
+    """
+    Test that clients not asking for streaming keep the old protocol
+    """
+    with connect(stub_qa_session) as websocket:
+        websocket.send_text(json.dumps({"type": "question", "content": "Where did Alice work?"}))
+        frame = json.loads(websocket.receive_text())
+
+    assert frame == {"type": "answer", "content": "".join(TOKENS)}
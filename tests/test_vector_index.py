@@ -0,0 +1,135 @@
+"""
+Test the persisted per-document vector index
+
+This test module checks that a document is chunked and embedded once
+into the on-disk index under its content hash and that its retriever
+only returns chunks belonging to that document.
+"""
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from utils import nlp2
+
+
+@pytest.fixture
+def vector_index(tmp_path, monkeypatch):
+    # Use an isolated index directory and an offline embedder
+    monkeypatch.setattr(nlp2, "VECTOR_INDEX_DIRECTORY", str(tmp_path / "vector_index"))
+    monkeypatch.setattr(nlp2, "get_embeddings", lambda: DeterministicFakeEmbedding(size=32))
+    return tmp_path / "vector_index"
+
+
+def test_index_document_persists_chunks(vector_index):
+    """
+    Test that indexing a document stores its chunks on disk
+    """
+    assert not nlp2.has_document_index("a1")
+
+    chunks = nlp2.index_document("a1", "Alice worked at Acme as an engineer. " * 100)
+
+    assert len(chunks) > 1
+    assert chunks[1].metadata["start_index"] > 0
+    assert nlp2.has_document_index("a1")
+    assert vector_index.exists()
+
+
+def test_reindex_replaces_previous_chunks(vector_index):
+    """
+    Test that re-indexing a document does not leave stale chunks behind
+    """
+    nlp2.index_document("a1", "old content " * 500)
+    chunks = nlp2.index_document("a1", "new content")
+
+    stored = nlp2.get_vector_store().get(where={"content_hash": "a1"})
+    assert len(stored["ids"]) == len(chunks) == 1
+    assert stored["documents"] == ["new content"]
+
+
+def test_retriever_is_scoped_to_document(vector_index):
+    """
+    Test that the retriever only returns chunks of the requested document
+    """
+    nlp2.index_document("a1", "Alice worked at Acme as an engineer.")
+    nlp2.index_document("b2", "Bob studied physics at a university.")
+
+    docs = nlp2.load_retriever(["b2"]).invoke("Where did Bob study?")
+
+    assert docs
+    assert all(doc.metadata["content_hash"] == "b2" for doc in docs)
+
+
+def test_retriever_spans_all_user_documents(vector_index):
+    """
+    Test that one retriever searches every document of a user, and only those
+    """
+    nlp2.index_document("a1", ["Alice worked at Acme.", "Alice studied at MIT."])
+    nlp2.index_document("b2", "Bob studied physics.\fBob worked at Initech.")
+    nlp2.index_document("c3", "Carol's document belongs to another user.")
+
+    docs = nlp2.load_retriever(["a1", "b2"]).invoke("Where did they study?")
+
+    assert {doc.metadata["content_hash"] for doc in docs} <= {"a1", "b2"}
+    stored = nlp2.get_vector_store().get(where={"content_hash": "b2"})
+    assert sorted(meta["page"] for meta in stored["metadatas"]) == [1, 2]
+    assert "Bob worked at Initech." in stored["documents"]
+
+
+def test_new_version_only_embeds_changed_chunks(vector_index, monkeypatch):
+    """
+    Test that re-indexing a new version embeds only the chunks that changed
+    """
+    embedded = []
+
+    class CountingEmbedding(DeterministicFakeEmbedding):
+        def embed_documents(self, texts):
+            embedded.extend(texts)
+            return super().embed_documents(texts)
+
+    monkeypatch.setattr(nlp2, "get_embeddings", lambda: CountingEmbedding(size=32))
+    pages = [f"Page {i} of the manual describes step {i} in detail." for i in range(300)]
+    nlp2.index_document("v1", pages)
+    embedded.clear()
+
+    pages[41] = "Page 41 now describes a corrected procedure."
+    chunks = nlp2.index_document("v2", pages, previous_hash="v1")
+
+    assert embedded == ["Page 41 now describes a corrected procedure."]
+    stored = nlp2.get_vector_store().get(where={"content_hash": "v2"}, include=["documents", "embeddings"])
+    assert len(stored["ids"]) == len(chunks) == 300
+    old = nlp2.get_vector_store().get(where={"content_hash": "v1"}, include=["embeddings"])
+    assert list(stored["embeddings"][0]) == list(old["embeddings"][0])
+
+    nlp2.delete_document_index("v1")
+    assert not nlp2.has_document_index("v1")
+
+
+def test_reindex_same_hash_drops_removed_chunks(vector_index):
+    """
+    Test that re-indexing with fewer chunks deletes the ones left over
+    """
+    nlp2.index_document("a1", ["one", "two", "three"])
+    nlp2.index_document("a1", ["one", "three"])
+
+    stored = nlp2.get_vector_store().get(where={"content_hash": "a1"})
+    assert sorted(stored["ids"]) == ["a1-0", "a1-1"]
+    assert sorted(stored["documents"]) == ["one", "three"]
+
+
+def test_large_document_is_written_in_batches(vector_index, monkeypatch):
+    """
+    Test that a document with more chunks than Chroma takes in one write
+    is still indexed in full
+    """
+    vector_store = nlp2.get_vector_store()
+    monkeypatch.setattr(vector_store._client, "get_max_batch_size", lambda: 2)
+    batches = []
+    upsert = vector_store._collection.upsert
+    monkeypatch.setattr(vector_store._collection, "upsert", lambda ids, **kwargs: batches.append(len(ids)) or upsert(ids=ids, **kwargs))
+
+    chunks = nlp2.index_document("a1", [f"page {i} about topic {i}" for i in range(5)])
+
+    stored = vector_store.get(where={"content_hash": "a1"})
+    assert len(chunks) == 5
+    assert batches == [2, 2, 1]
+    assert sorted(stored["ids"]) == [f"a1-{i}" for i in range(5)]
@@ -0,0 +1,80 @@
+"""
+Test the NumPy vector store
+
+This test module checks that the vectorised MMR selects what LangChain's
+MMR selects, that stored documents are memory-mapped when opened again,
+and that the `numpy` backend indexes, retrieves and deletes documents
+like Chroma does.
+"""
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+
+from utils import nlp2
+from utils.embeddings import HashingEmbeddings
+from utils.vector_store import NumpyVectorStore, mmr_select, normalize_rows
+
+
+def test_mmr_matches_langchain():
+    """
+    Test that the vectorised MMR picks the same candidates in the same order
+    """
+    rng = np.random.default_rng(3)
+    for lambda_mult in (0.0, 0.25, 0.5, 1.0):
+        candidates = normalize_rows(rng.normal(size=(20, 16)))
+        query = normalize_rows(rng.normal(size=16))
+        expected = maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=5)
+        assert mmr_select(candidates @ query, candidates, 5, lambda_mult) == expected
+
+
+def test_store_round_trip_is_memory_mapped(tmp_path):
+    """
+    Test that a saved document is read back memory-mapped, replaced on save
+    and gone after delete
+    """
+    embeddings = HashingEmbeddings(dim=64)
+    texts = ["Alice wrote Python.", "Bob studied physics.", "Carol runs the budget."]
+    docs = [Document(page_content=text, metadata={"page": i + 1}) for i, text in enumerate(texts)]
+    store = NumpyVectorStore(str(tmp_path), embeddings)
+    store.save("a1", ["a1-0", "a1-1", "a1-2"], docs, embeddings.embed_documents(texts))
+
+    loaded = NumpyVectorStore(str(tmp_path), embeddings).load("a1")
+    assert isinstance(loaded.matrix, np.memmap) and loaded.matrix.dtype == np.float32
+    assert [doc.metadata["page"] for doc in loaded.docs] == [1, 2, 3]
+    found = store.search(["a1"], [embeddings.embed_query("Who studied physics?")], k=1)
+    assert found[0][0].page_content == "Bob studied physics."
+
+    store.save("a1", ["a1-0"], docs[:1], embeddings.embed_documents(texts[:1]))
+    assert len(store.load("a1")) == 1
+    store.delete("a1")
+    assert not store.exists("a1") and store.load("a1") is None
+
+
+@pytest.fixture
+def numpy_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(nlp2, "VECTOR_INDEX_DIRECTORY", str(tmp_path / "vector_index"))
+    monkeypatch.setattr(nlp2, "VECTOR_BACKEND", "numpy")
+    monkeypatch.setattr(nlp2, "get_embeddings", lambda: HashingEmbeddings(dim=256))
+    nlp2.question_vectors_cache.clear()
+
+
+@pytest.mark.parametrize("batch_size", [32, 0])
+def test_numpy_backend_indexes_and_retrieves(numpy_backend, monkeypatch, batch_size):
+    """
+    Test that documents are indexed, searched and deleted through the numpy backend
+    """
+    monkeypatch.setattr(nlp2, "QA_BATCH_SIZE", batch_size)
+    nlp2.index_document("a1", ["Alice built a Python project.", "Alice likes tea."])
+    nlp2.index_document("b2", ["Bob worked at Initech on compilers."])
+    assert nlp2.find_unindexed_documents(["a1", "b2", "c3"]) == ["c3"]
+
+    docs = nlp2.load_retriever(["a1", "b2"], mode="vector").invoke("Where did Bob work on compilers?")
+    assert docs[0].page_content == "Bob worked at Initech on compilers."
+    assert {doc.metadata["content_hash"] for doc in docs} <= {"a1", "b2"}
+
+    nlp2.delete_document_index("b2")
+    assert nlp2.find_unindexed_documents(["a1", "b2"]) == ["b2"]
+    docs = nlp2.load_retriever(["a1", "b2"], mode="vector").invoke("Where did Bob work on compilers?")
+    assert all(doc.metadata["content_hash"] == "a1" for doc in docs)
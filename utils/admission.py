@@ -0,0 +1,121 @@
+"""
+Admission control for questions.
+
+Every question that needs retrieval or the LLM takes a slot of a
+`FairQueue` first. At most `concurrency` questions run at once; the
+rest wait in one FIFO per user, and freed slots go to the users in
+turn, so a user firing many questions cannot starve everyone else. At
+most `max_depth` questions wait: beyond that, and for questions that
+waited `timeout` seconds, the caller is told to come back later instead
+of joining a queue it would time out in anyway. Overload thus costs
+some clients an early, explicit refusal rather than every client a
+timeout, and the latency of admitted questions stays bounded.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from utils.metrics import registry
+
+QUEUE_DEPTH = registry.gauge("pdf_qa_queue_depth", "Questions waiting for admission.")
+REJECTED = registry.counter("pdf_qa_rejected_questions_total", "Questions turned away by admission control.", ["reason"])
+
+
+class QueueFullError(Exception):
+    """No slot is free and the queue is at its maximum depth."""
+
+
+class QueueTimeoutError(Exception):
+    """A queued question was not admitted in time."""
+
+
+class FairQueue:
+    """
+    Slots for `concurrency` concurrent questions, with waiting questions
+    queued per user and admitted round-robin across users. Bound to the
+    event loop it is used on.
+    """
+
+    def __init__(self, concurrency, max_depth, timeout=None):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.running = 0
+        self.depth = 0
+        # user -> waiting futures; the first user is the next one served
+        self._queues = OrderedDict()
+
+    def position(self, user, future):
+        """1-based place in line of a waiting question, given the round-robin order."""
+        users = list(self._queues)
+        rank = self._queues[user].index(future)
+        ahead = sum(min(len(queue), rank) for queue in self._queues.values())
+        ahead += sum(1 for other in users[:users.index(user)] if len(self._queues[other]) > rank)
+        return ahead + 1
+
+    async def acquire(self, user, on_queued=None):
+        """
+        Take a slot, waiting in line if none is free. `on_queued(position)`
+        is awaited when the question has to wait. Raises `QueueFullError`
+        or `QueueTimeoutError` when the question is turned away.
+        """
+        if self.running < self.concurrency and not self.depth:
+            self.running += 1
+            return
+        if self.depth >= self.max_depth:
+            REJECTED.inc(reason="queue_full")
+            raise QueueFullError()
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(future)
+        self._set_depth(self.depth + 1)
+        try:
+            if on_queued is not None:
+                await on_queued(self.position(user, future))
+            await asyncio.wait_for(future, self.timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot arrived as the caller gave up; hand it on
+                self.release()
+            else:
+                self._remove(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                REJECTED.inc(reason="timeout")
+                raise QueueTimeoutError() from None
+            raise
+
+    def release(self):
+        """Give the slot to the next waiting question, or free it."""
+        while self._queues:
+            user, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self._set_depth(self.depth - 1)
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, user, on_queued=None):
+        await self.acquire(user, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _remove(self, user, future):
+        queue = self._queues.get(user)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self._set_depth(self.depth - 1)
+            if not queue:
+                del self._queues[user]
+
+    def _set_depth(self, depth):
+        QUEUE_DEPTH.inc(depth - self.depth)
+        self.depth = depth
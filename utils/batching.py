@@ -0,0 +1,270 @@
+"""
+Micro-batching of the per-question retrieval work.
+
+Sessions asking about the same popular document at the same moment would
+each embed their question and search the index on their own. Instead,
+`MicroBatcher` holds the requests arriving within a few milliseconds of
+each other and hands them to one blocking call: the questions are
+embedded in a single batch, and the vectors of each document set are
+scored against all of its questions with one matrix product before MMR
+picks every question's chunks (see `utils.vector_store`).
+
+`SingleFlight` covers identical questions: while one is being answered,
+the same question about the same documents waits for that answer (or
+follows its stream) rather than being answered a second time.
+"""
+
+import asyncio
+import contextvars
+from typing import Callable, List
+
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from utils.metrics import add_timings, collect_timings, registry
+
+BATCH_SIZES = registry.histogram(
+    "pdf_qa_batch_size",
+    "Requests handled per micro-batch.",
+    ["batcher"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+DEDUPLICATED = registry.counter(
+    "pdf_qa_deduplicated_questions_total", "Questions answered by an identical question already in flight."
+)
+
+
+def detach(coroutine):
+    """
+    Run `coroutine` as a task with a context of its own. Work shared by
+    several requests would otherwise run in the context of the one that
+    happened to start it, and its timing spans be credited to that request
+    only; the spans are handed to every request it serves instead.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coroutine)
+
+
+async def collect(coroutine):
+    """Await `coroutine` and return its result with the stage timings it recorded."""
+    with collect_timings() as timings:
+        result = await coroutine
+    return result, timings
+
+
+class MicroBatcher:
+    """
+    Coalesce the items submitted within `window` seconds of the first one
+    (or until `max_size` are waiting) into one call of `process(items)`,
+    a blocking function returning one result per item, run with `run`.
+    Futures are bound to a loop, so use one batcher per event loop.
+    """
+
+    def __init__(self, name, process, run, window=0.003, max_size=32):
+        self.name = name
+        self.process = process
+        self.run = run
+        self.window = window
+        self.max_size = max_size
+        self._pending = []  # (item, future)
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        result, timings = await future
+        add_timings(timings)
+        return result
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # Keep a reference so the task is not garbage collected mid-batch
+            task = detach(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        BATCH_SIZES.observe(len(batch), batcher=self.name)
+        try:
+            results, timings = await collect(self.run(self.process, [item for item, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            # Callers that gave up (e.g. a closed socket) have cancelled theirs
+            if not future.done():
+                future.set_result((result, timings))
+
+
+class Flight:
+    """
+    The callers sharing one call. The call reports progress (e.g. its place
+    in a queue) with `notify(*args)`, which awaits every caller's listener;
+    callers joining later are sent the latest notification, until the call
+    says it no longer holds with `clear()`.
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self.notification = None
+
+    async def notify(self, *args):
+        self.notification = args
+        for listener in list(self.listeners):
+            try:
+                await listener(*args)
+            except Exception:
+                # A caller that went away must not fail the call for the others
+                pass
+
+    def clear(self):
+        self.notification = None
+
+    async def join(self, listener):
+        if listener is not None:
+            self.listeners.append(listener)
+            if self.notification is not None:
+                await listener(*self.notification)
+
+    def leave(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+
+class SingleFlight:
+    """
+    Share one in-flight call among the callers asking for the same key.
+    Factories are given the call's `Flight`, through which each caller's
+    `listener` hears of its progress.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+    async def run(self, key, factory, listener=None):
+        """Await `factory(flight)`, or the call already running for `key`."""
+        call = self._calls.get(key)
+        if call is None:
+            flight = Flight()
+            task = detach(collect(factory(flight)))
+            self._calls[key] = flight, task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            # Nobody may be left to read the error if every caller gave up
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        else:
+            flight, task = call
+            DEDUPLICATED.inc()
+        try:
+            await flight.join(listener)
+            # One caller giving up must not cancel the answer for the others
+            result, timings = await asyncio.shield(task)
+        finally:
+            flight.leave(listener)
+        add_timings(timings)
+        return result
+
+    def stream(self, key, factory, listener=None):
+        """
+        Iterate over the async iterator `factory(flight)`, or over the one
+        already running for `key`; every caller gets every item, from the first.
+        """
+        stream = self._streams.get(key)
+        if stream is None:
+            flight = Flight()
+            stream = SharedStream(factory(flight), flight)
+            self._streams[key] = stream
+            stream.task.add_done_callback(lambda _: self._streams.pop(key, None))
+        else:
+            DEDUPLICATED.inc()
+        return stream.subscribe(listener)
+
+
+class SharedStream:
+    """
+    Consume an async iterator in a task of its own, keeping its items so
+    that any number of subscribers can replay them. The task runs to the
+    end even if every subscriber leaves, like a `SingleFlight` call.
+    """
+
+    def __init__(self, items, flight=None):
+        self.flight = flight or Flight()
+        self.items = []
+        self.done = False
+        self.error = None
+        self.timings = {}
+        self._changed = asyncio.Event()
+        self.task = detach(self._consume(items))
+
+    async def _consume(self, items):
+        try:
+            with collect_timings() as self.timings:
+                async for item in items:
+                    self.items.append(item)
+                    self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, listener=None):
+        await self.flight.join(listener)
+        try:
+            position = 0
+            while True:
+                changed = self._changed
+                while position < len(self.items):
+                    yield self.items[position]
+                    position += 1
+                if self.done:
+                    add_timings(self.timings)
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.flight.leave(listener)
+
+
+def embed_queries(embeddings, texts):
+    """Embed questions in one call when the embedder supports it."""
+    embed_many = getattr(embeddings, "embed_queries", None)
+    if embed_many is not None:
+        return embed_many(texts)
+    return [embeddings.embed_query(text) for text in texts]
+
+
+class BatchedRetriever(BaseRetriever):
+    """
+    Vector retriever over `content_hashes` whose async searches go through
+    `search(content_hashes, query)`, so concurrent questions are batched;
+    `search_sync` serves synchronous calls.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    content_hashes: List[str]
+    search: Callable
+    search_sync: Callable
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.search_sync(self.content_hashes, query)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        return await self.search(self.content_hashes, query)
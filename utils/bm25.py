@@ -0,0 +1,229 @@
+"""
+Keyword (BM25) retrieval over indexed chunks.
+
+Next to its vectors, every document gets an inverted index of its chunks
+built at ingestion and saved as one JSON file per content hash. A search
+merges the indexes of the documents in scope and scores their chunks
+with BM25, entirely in memory and without calling the embedding model.
+
+`HybridRetriever` serves the QA chain: on its own it does keyword-only
+retrieval, and given a vector retriever it fuses both rankings with
+reciprocal rank fusion, so exact terms (names, IDs) and paraphrases both
+find their chunks.
+"""
+
+import asyncio
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables.config import run_in_executor
+from pydantic import ConfigDict
+
+from utils.cache import LRUCache
+
+# BM25 term frequency saturation and length normalisation
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Rank offset of reciprocal rank fusion; larger values flatten the ranks
+RRF_K = 60
+
+_TERM_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TERM_PATTERN.findall(text.lower())
+
+
+class KeywordIndex:
+    """
+    Inverted index of one document's chunks: term -> (chunk positions,
+    frequencies), held as NumPy arrays so scoring is vectorised.
+    """
+
+    def __init__(self, ids, texts, metadatas, lengths, postings):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        self.postings = {
+            term: (np.array([p for p, _ in entries], dtype=np.int64), np.array([f for _, f in entries], dtype=np.float32))
+            for term, entries in postings.items()
+        }
+
+    @classmethod
+    def from_documents(cls, ids, docs):
+        postings = {}
+        lengths = []
+        for position, doc in enumerate(docs):
+            terms = tokenize(doc.page_content)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings.setdefault(term, []).append((position, frequency))
+        return cls(list(ids), [doc.page_content for doc in docs], [doc.metadata for doc in docs], lengths, postings)
+
+    def to_dict(self):
+        return {
+            "ids": self.ids,
+            "texts": self.texts,
+            "metadatas": self.metadatas,
+            "lengths": self.lengths.astype(int).tolist(),
+            "postings": {
+                term: [[int(p), int(f)] for p, f in zip(positions, frequencies)]
+                for term, (positions, frequencies) in self.postings.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["ids"], data["texts"], data["metadatas"], data["lengths"], data["postings"])
+
+
+class KeywordIndexStore:
+    """
+    Keyword indexes saved under `directory`, with the most recently used
+    ones kept loaded in memory.
+    """
+
+    def __init__(self, directory, cache_size=256):
+        self.directory = directory
+        self._loaded = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}.json")
+
+    def save(self, content_hash, ids, docs):
+        index = KeywordIndex.from_documents(ids, docs)
+        path = self._path(content_hash)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(index.to_dict(), f)
+        os.replace(f"{path}.tmp", path)
+        self._loaded.set(content_hash, index)
+
+    def load(self, content_hash):
+        """Return the index of a document, or None if it has none."""
+        index = self._loaded.get(content_hash)
+        if index is None:
+            with self._lock:
+                try:
+                    with open(self._path(content_hash)) as f:
+                        index = KeywordIndex.from_dict(json.load(f))
+                except FileNotFoundError:
+                    return None
+                self._loaded.set(content_hash, index)
+        return index
+
+    def exists(self, content_hash):
+        return content_hash in self._loaded or os.path.exists(self._path(content_hash))
+
+    def delete(self, content_hash):
+        self._loaded.pop(content_hash)
+        try:
+            os.remove(self._path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def search(self, content_hashes, query, k):
+        """
+        Return the `k` best `(Document, score)` pairs for `query` among the
+        chunks of `content_hashes`, with BM25 statistics taken over exactly
+        those documents.
+        """
+        indexes = [index for index in map(self.load, content_hashes) if index is not None]
+        chunk_count = sum(len(index.lengths) for index in indexes)
+        if not chunk_count:
+            return []
+        average_length = sum(float(index.lengths.sum()) for index in indexes) / chunk_count or 1.0
+
+        # One score per chunk of each document, accumulated term by term
+        scores = [np.zeros(len(index.lengths), dtype=np.float32) for index in indexes]
+        norms = [BM25_K1 * (1 - BM25_B + BM25_B * index.lengths / average_length) for index in indexes]
+        for term in set(tokenize(query)):
+            matches = [index.postings.get(term) for index in indexes]
+            document_frequency = sum(len(match[0]) for match in matches if match)
+            if not document_frequency:
+                continue
+            idf = math.log(1 + (chunk_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            for score, norm, match in zip(scores, norms, matches):
+                if match:
+                    positions, frequencies = match
+                    score[positions] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm[positions])
+
+        all_scores = np.concatenate(scores)
+        candidates = np.flatnonzero(all_scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-all_scores[candidates], k - 1)[:k]]
+        offsets = np.cumsum([0] + [len(index.lengths) for index in indexes])
+        results = []
+        for flat in sorted(candidates, key=lambda flat: -all_scores[flat]):
+            which = int(np.searchsorted(offsets, flat, side="right")) - 1
+            index, position = indexes[which], int(flat - offsets[which])
+            results.append((
+                Document(page_content=index.texts[position], metadata=dict(index.metadatas[position])),
+                float(all_scores[flat]),
+            ))
+        return results
+
+
+def fuse_rankings(rankings, k, rrf_k=RRF_K):
+    """
+    Merge ranked lists of documents with reciprocal rank fusion and return
+    the `k` best. The same chunk found by several rankings is kept once.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = (doc.metadata.get("content_hash"), doc.metadata.get("page"), doc.metadata.get("start_index"), doc.page_content)
+            score, _ = fused.get(key, (0.0, doc))
+            fused[key] = (score + 1 / (rrf_k + rank + 1), doc)
+    return [doc for _, doc in heapq.nlargest(k, fused.values(), key=lambda item: item[0])]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Keyword retriever over `content_hashes`, fused with `vector_retriever`
+    when one is given. Async searches load and score the keyword indexes
+    off the event loop with `run(func, *args)` (by default the loop's
+    executor), concurrently with the vector search.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    keyword_store: Any
+    content_hashes: List[str]
+    k: int = 3
+    vector_retriever: Optional[BaseRetriever] = None
+    run: Optional[Callable] = None
+
+    def _keyword_documents(self, query):
+        return [doc for doc, _ in self.keyword_store.search(self.content_hashes, query, self.k)]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        keyword_docs = self._keyword_documents(query)
+        if self.vector_retriever is None:
+            return keyword_docs
+        vector_docs = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return fuse_rankings([vector_docs, keyword_docs], self.k)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        if self.run is not None:
+            keyword_search = self.run(self._keyword_documents, query)
+        else:
+            keyword_search = run_in_executor(None, self._keyword_documents, query)
+        if self.vector_retriever is None:
+            return await keyword_search
+        vector_docs, keyword_docs = await asyncio.gather(
+            self.vector_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}),
+            keyword_search,
+        )
+        return fuse_rankings([vector_docs, keyword_docs], self.k)
@@ -0,0 +1,231 @@
+"""
+Small in-process caches shared by the QA pipeline.
+
+The caches are bounded both by entry count (least recently used entries
+are evicted first) and by age, so memory stays capped no matter how many
+WebSocket sessions are open.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time-to-live per entry.
+
+    `on_evict(key, value)` is called, outside the cache's lock, for every
+    entry dropped because the cache is full or the entry expired.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._building = {}  # key -> Future of the value being built
+        self._lock = threading.RLock()
+
+    def _expired(self, expires_at):
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _evicted(self, items):
+        if self.on_evict is not None:
+            for key, value in items:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if not self._expired(expires_at):
+                self._data.move_to_end(key)
+                return value
+            del self._data[key]
+        self._evicted([(key, value)])
+        return default
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted_key, (_, evicted_value) = self._data.popitem(last=False)
+                evicted.append((evicted_key, evicted_value))
+        self._evicted(evicted)
+
+    def get_or_create(self, key, factory):
+        """
+        Return the cached value for `key`, building it with `factory` on a
+        miss. The build runs outside the cache's lock: only callers asking
+        for the same key wait for it, and they share its result or error.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            value = self.get(key)
+            if value is not None:
+                return value
+            building = self._building.get(key)
+            if building is None:
+                building = self._building[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return building.result()
+        try:
+            value = factory()
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            building.set_exception(e)
+            raise
+        with self._lock:
+            self.set(key, value)
+            del self._building[key]
+        building.set_result(value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+def normalize_question(question):
+    """Lower-case a question and drop extra whitespace and trailing punctuation."""
+    return " ".join(question.lower().split()).rstrip(" ?!.")
+
+
+class AnswerCache:
+    """
+    Cache of answers keyed by the documents they were answered from and the
+    normalised question.
+
+    Besides exact matches, a question can be served from a cached answer
+    whose question embedding has a cosine similarity of at least
+    `similarity_threshold` (0 disables near-duplicate matching). Entries
+    are bounded by count and age like `LRUCache`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, similarity_threshold=0.0):
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        # (scope, question) -> (answer, sources, vector)
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl, on_evict=self._forget)
+        self._questions = {}  # scope -> normalised questions cached for it
+        self._lock = threading.RLock()
+
+    def _forget(self, key, entry):
+        # An answer left the LRU, so its question leaves the scope's index
+        scope, question = key
+        with self._lock:
+            questions = self._questions.get(scope)
+            if questions is None or key in self._entries:
+                return
+            questions.discard(question)
+            if not questions:
+                del self._questions[scope]
+
+    def get(self, scope, question):
+        """
+        The cached `(answer, sources)` of exactly this (normalised) question,
+        or None; unlike `lookup`, a miss is not counted.
+        """
+        entry = self._entries.get((scope, normalize_question(question)))
+        return None if entry is None else self._count(entry)
+
+    def lookup(self, scope, question, embed=None):
+        """
+        Return `(hit, vector)`, where `hit` is the cached `(answer, sources)`
+        or None. On an exact miss the question is embedded with `embed` (when
+        near-duplicate matching is on) and compared with the questions cached
+        for the scope; the vector is returned so it can be stored with the
+        new answer.
+        """
+        entry = self._entries.get((scope, normalize_question(question)))
+        vector = None
+        if entry is None and embed is not None and self.similarity_threshold > 0:
+            vector = embed(question)
+            with self._lock:
+                entry = self._get_similar(scope, vector)
+        return self._count(entry), vector
+
+    async def alookup(self, scope, question, embed=None):
+        """
+        `lookup` with an asynchronous `embed`, e.g. one batching the
+        questions of concurrent sessions; like there, it is only awaited
+        after an exact miss.
+        """
+        entry = self._entries.get((scope, normalize_question(question)))
+        vector = None
+        if entry is None and embed is not None and self.similarity_threshold > 0:
+            vector = await embed(question)
+            with self._lock:
+                entry = self._get_similar(scope, vector)
+        return self._count(entry), vector
+
+    def _count(self, entry):
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[0], entry[1]
+
+    def _get_similar(self, scope, vector):
+        best, best_score = None, self.similarity_threshold
+        query = np.asarray(vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query) or 1.0
+        for question in list(self._questions.get(scope, ())):
+            entry = self._entries.get((scope, question))
+            if entry is None or entry[2] is None:
+                continue
+            cached = np.asarray(entry[2], dtype=np.float32)
+            score = float(query @ cached) / (query_norm * (np.linalg.norm(cached) or 1.0))
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def set(self, scope, question, answer, sources=None, vector=None):
+        with self._lock:
+            question = normalize_question(question)
+            self._entries.set((scope, question), (answer, sources or [], vector))
+            self._questions.setdefault(scope, set()).add(question)
+
+    def invalidate(self, content_hash):
+        """Drop every answer that was produced from the document with this hash."""
+        with self._lock:
+            for scope in [scope for scope in self._questions if content_hash in scope]:
+                for question in self._questions.pop(scope):
+                    self._entries.pop((scope, question))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._questions.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,131 @@
+"""
+Token-aware chunking of extracted PDF pages.
+
+Chunks are measured in tokens rather than characters, so their size can
+be derived from the LLM's context window: the `k` retrieved chunks, the
+prompt and the answer have to fit in it together. `CHUNKING_STRATEGY`
+selects where chunks may start and end:
+
+- `page` (default): chunks never cross a page boundary.
+- `section`: chunks also never cross a heading, and carry the heading
+  they belong to as `section` metadata.
+
+Each page is tokenized once and cut into windows in a single pass, so
+splitting is linear in the size of the text. Windows end at a paragraph
+or sentence break near their end when there is one.
+"""
+
+import os
+import re
+
+from langchain_core.documents import Document
+
+CHUNKING_STRATEGY = os.getenv("CHUNKING_STRATEGY", "page")
+# Preferred chunk size in tokens; smaller if the context window requires it
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+# Tokens repeated at the start of the next chunk of the same section
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Context tokens kept free for the prompt template, the question and the answer
+PROMPT_RESERVE_TOKENS = int(os.getenv("PROMPT_RESERVE_TOKENS", "512"))
+ANSWER_RESERVE_TOKENS = int(os.getenv("ANSWER_RESERVE_TOKENS", "1024"))
+
+# Words and single punctuation marks; close to the token counts of BPE
+# tokenizers such as Llama 3's on English text, without loading one
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = frozenset(".!?")
+# Markdown headings, numbered headings ("2.1 Scope") and short all-caps lines
+_HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]+\S[^\n]*|\d+(?:\.\d+)*\.?[ \t]+[A-Z][^\n]{0,80}|[A-Z][A-Z0-9 ,&:/()-]{2,80})[ \t]*$",
+    re.MULTILINE,
+)
+
+
+def count_tokens(text):
+    """Estimate the number of LLM tokens in `text`."""
+    return sum(1 for _ in _TOKEN_PATTERN.finditer(text))
+
+
+def get_chunk_tokens(context_tokens, k, preferred=CHUNK_TOKENS):
+    """
+    Chunk size in tokens such that `k` chunks plus the prompt and answer
+    reserves fit in a context window of `context_tokens`.
+    """
+    budget = context_tokens - PROMPT_RESERVE_TOKENS - ANSWER_RESERVE_TOKENS
+    return max(1, min(preferred, budget // max(1, k)))
+
+
+def split_text(text, chunk_tokens, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Split `text` into windows of at most `chunk_tokens` tokens, each
+    overlapping the previous one by `overlap_tokens`. Returns a list of
+    `(start, end, token_count)` character spans.
+    """
+    spans = [match.span() for match in _TOKEN_PATTERN.finditer(text)]
+    total = len(spans)
+    overlap_tokens = min(overlap_tokens, chunk_tokens // 2)
+    chunks = []
+    start = 0
+    while start < total:
+        end = min(start + chunk_tokens, total)
+        if end < total:
+            end = _find_break(text, spans, start + max(1, chunk_tokens * 3 // 4), end)
+        chunks.append((spans[start][0], spans[end - 1][1], end - start))
+        if end == total:
+            break
+        start = max(end - overlap_tokens, start + 1)
+    return chunks
+
+
+def _find_break(text, spans, lowest, end):
+    # Last paragraph break, else last sentence end, among the tokens ending
+    # the window; scans at most a quarter of a window, keeping splits linear
+    sentence_end = None
+    for i in range(end, lowest, -1):
+        if "\n\n" in text[spans[i - 1][1]:spans[i][0]]:
+            return i
+        if sentence_end is None and text[spans[i - 1][0]] in _SENTENCE_END:
+            sentence_end = i
+    return sentence_end or end
+
+
+def find_sections(text):
+    """Return `(start, heading)` for every heading line in `text`."""
+    return [(match.start(), match.group().strip().lstrip("#").strip()) for match in _HEADING_PATTERN.finditer(text)]
+
+
+def chunk_pages(pages, chunk_tokens, metadata=None, strategy=None, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Chunk a document given as a list of page texts into `Document`s tagged
+    with `metadata` plus their 1-based `page`, the `start_index` of the
+    chunk within the page, its `token_count` and, for the `section`
+    strategy, the `section` heading it falls under.
+    """
+    strategy = strategy or CHUNKING_STRATEGY
+    if strategy not in ("page", "section"):
+        raise ValueError(f"Unknown chunking strategy {strategy!r}; expected 'page' or 'section'")
+
+    docs = []
+    section = None
+    for page_number, page_text in enumerate(pages, start=1):
+        # Pieces of the page that chunks may not cross, with their heading
+        pieces = [(0, len(page_text), section)]
+        if strategy == "section":
+            pieces = []
+            bounds = [(0, section)] + find_sections(page_text)
+            for (start, heading), (stop, _) in zip(bounds, bounds[1:] + [(len(page_text), None)]):
+                pieces.append((start, stop, heading))
+            section = pieces[-1][2]
+
+        for piece_start, piece_stop, heading in pieces:
+            piece = page_text[piece_start:piece_stop]
+            for start, end, token_count in split_text(piece, chunk_tokens, overlap_tokens):
+                chunk_metadata = {
+                    **(metadata or {}),
+                    "page": page_number,
+                    "start_index": piece_start + start,
+                    "token_count": token_count,
+                }
+                if heading:
+                    chunk_metadata["section"] = heading
+                docs.append(Document(page_content=piece[start:end], metadata=chunk_metadata))
+    return docs
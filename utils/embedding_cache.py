@@ -0,0 +1,252 @@
+"""
+Persistent cache of chunk embeddings.
+
+Identical chunks show up constantly: the same document across sessions,
+boilerplate pages shared between PDFs, re-uploads. `CachedEmbeddings`
+wraps any embedder and only sends chunks it has never seen to the
+underlying model.
+
+Vectors live in a fixed-size memory-mapped float32 matrix with one slot
+per entry, and a small SQLite table maps (chunk hash) -> slot together
+with the last time it was used. When the cache is full the least
+recently used slots are overwritten, so the files never grow past
+`EMBEDDING_CACHE_SIZE` rows. The capacity is stored with the cache, and
+a cache reopened with another size is grown, or compacted to its most
+recently used entries.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from utils.batching import embed_queries
+from utils.metrics import registry
+
+# Directory holding one cache per embedding model
+EMBEDDING_CACHE_DIRECTORY = os.getenv("EMBEDDING_CACHE_DIRECTORY", "embedding_cache")
+# Maximum number of vectors kept per model; 0 disables the cache
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+# Keys per SQLite query, well below its limit on bound parameters
+QUERY_BATCH_SIZE = 500
+
+EMBEDDING_CACHE_LOOKUPS = registry.counter(
+    "pdf_qa_embedding_cache_lookups_total", "Chunk embeddings looked up in the disk cache.", ["result"]
+)
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingDiskCache:
+    """
+    Size-bounded on-disk store of vectors for one embedding model.
+    """
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_entries_last_used ON entries (last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self._db.commit()
+
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row:
+            dim = row[0]
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'capacity'").fetchone()
+            # Caches written before the capacity was stored: read it off the file
+            stored_capacity = row[0] if row else os.path.getsize(self._vectors_path) // (4 * dim)
+            if stored_capacity != capacity:
+                self._resize(dim, stored_capacity)
+            self._open_vectors(dim, mode="r+")
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.directory, "vectors.f32")
+
+    def _open_vectors(self, dim, mode):
+        self.dim = dim
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+        self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('capacity', ?)", (self.capacity,))
+        self._db.commit()
+
+    def _resize(self, dim, stored_capacity):
+        """
+        Fit the vectors file written with `stored_capacity` rows to the
+        current capacity. Growing keeps every slot; shrinking keeps the most
+        recently used entries, moved to the first slots.
+        """
+        if self.capacity < stored_capacity:
+            old = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(stored_capacity, dim))
+            kept = self._db.execute(
+                "SELECT key, slot, last_used FROM entries ORDER BY last_used DESC LIMIT ?", (self.capacity,)
+            ).fetchall()
+            vectors = np.array(old[[slot for _, slot, _ in kept]]) if kept else np.zeros((0, dim), dtype=np.float32)
+            del old
+            self._db.execute("DELETE FROM entries")
+            self._db.executemany(
+                "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                [(key, slot, last_used) for slot, (key, _, last_used) in enumerate(kept)],
+            )
+            self._db.commit()
+            new = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(stored_capacity, dim))
+            new[:len(vectors)] = vectors
+            new.flush()
+            del new
+        with open(self._vectors_path, "r+b") as f:
+            f.truncate(self.capacity * dim * 4)
+
+    def _slots(self, keys):
+        """{key: slot} for the `keys` that are stored, looked up in batches."""
+        slots = {}
+        for start in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[start:start + QUERY_BATCH_SIZE]
+            slots.update(self._db.execute(
+                f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return slots
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, keys):
+        """Return {key: vector} for every key that is cached."""
+        if self._vectors is None or not keys:
+            return {}
+        with self._lock:
+            found = {key: np.array(self._vectors[slot]) for key, slot in self._slots(keys).items()}
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._db.commit()
+        return found
+
+    def put_many(self, keys, vectors):
+        """Store `vectors` (one row per key), evicting least recently used entries if full."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not keys:
+            return
+        keys, vectors = keys[-self.capacity:], vectors[-self.capacity:]
+        with self._lock:
+            if self._vectors is None:
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (vectors.shape[1],))
+                self._open_vectors(vectors.shape[1], mode="w+")
+
+            stored = self._slots(keys)
+            new_keys = [key for key in keys if key not in stored]
+
+            # Slots are filled in order and only reused through eviction
+            next_slot = self._db.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM entries").fetchone()[0]
+            free_slots = list(range(next_slot, min(self.capacity, next_slot + len(new_keys))))
+            evict = len(new_keys) - len(free_slots)
+            if evict > 0:
+                # The least recently used entries other than those being stored again
+                victims = [
+                    (key, slot) for key, slot in self._db.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (evict + len(stored),)
+                    ).fetchall()
+                    if key not in stored
+                ][:evict]
+                self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+                free_slots.extend(slot for _, slot in victims)
+
+            slots = dict(stored)
+            slots.update(zip(new_keys, free_slots))
+            now = time.time()
+            rows = [(key, slots[key], now) for key in keys if key in slots]
+            self._db.executemany("INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)", rows)
+            for key, vector in zip(keys, vectors):
+                if key in slots:
+                    self._vectors[slots[key]] = vector
+            self._vectors.flush()
+            self._db.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedder that serves previously seen chunks from an `EmbeddingDiskCache`
+    and embeds only the misses, in one call to the wrapped embedder.
+    Queries are passed through, since providers may embed them differently.
+    """
+
+    def __init__(self, embeddings, cache, model_name):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        keys = [hash_text(text) for text in texts]
+        found = self.cache.get_many(list(dict.fromkeys(keys)))
+
+        # Embed each distinct unseen text once, however often it repeats
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        hits = len(texts) - sum(1 for key in keys if key in missing)
+        self.cache.hits += hits
+        self.cache.misses += len(missing)
+        EMBEDDING_CACHE_LOOKUPS.inc(hits, result="hit")
+        EMBEDDING_CACHE_LOOKUPS.inc(len(missing), result="miss")
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            found.update(zip(missing, (np.asarray(vector, dtype=np.float32) for vector in vectors)))
+            self.cache.put_many(list(missing), np.vstack([found[key] for key in missing]))
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts):
+        return embed_queries(self.embeddings, texts)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_model_name(embeddings):
+    return getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+def get_embedding_cache(model_name):
+    """Return the process-wide disk cache for `model_name`, opening it on first use."""
+    directory = os.path.join(EMBEDDING_CACHE_DIRECTORY, re.sub(r"[^\w.-]+", "_", model_name))
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = EmbeddingDiskCache(directory, EMBEDDING_CACHE_SIZE)
+            _caches[directory] = cache
+        return cache
+
+
+def with_embedding_cache(embeddings):
+    """Wrap `embeddings` in the disk cache for its model, unless caching is disabled."""
+    if EMBEDDING_CACHE_SIZE <= 0:
+        return embeddings
+    model_name = get_model_name(embeddings)
+    return CachedEmbeddings(embeddings, get_embedding_cache(model_name), model_name)
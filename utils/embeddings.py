@@ -0,0 +1,109 @@
+"""
+Embedding providers for the vector index.
+
+`EMBEDDING_BACKEND` selects the provider:
+
+- `google` (default): Google Generative AI embeddings, one network round
+  trip per batch.
+- `local`: a deterministic hashing vectorizer over NumPy. It needs no
+  network or model download and embeds whole batches of chunks with a few
+  matrix operations, which makes indexing fast offline and in tests.
+"""
+
+import os
+import re
+import zlib
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+load_dotenv('.env')
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "google")
+# Dimension of the local hashing embeddings
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "1024"))
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Local embeddings built with the hashing trick.
+
+    Every lower-cased word and word bigram is hashed (CRC32, so vectors are
+    stable across processes) into one of `dim` signed buckets. Counts are
+    damped with log1p and rows are L2-normalised, so cosine similarity
+    reduces to a dot product. Texts are embedded `batch_size` at a time as
+    a single dense matrix.
+    """
+
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM, batch_size=512):
+        self.dim = dim
+        self.batch_size = batch_size
+        self.model_name = f"local-hashing-{dim}"
+
+    def _features(self, text):
+        words = _TOKEN_PATTERN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def _embed_batch(self, texts):
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode()) for feature in self._features(text)),
+                dtype=np.uint32,
+            )
+            rows.append(np.full(len(hashes), row, dtype=np.intp))
+            columns.append((hashes % self.dim).astype(np.intp))
+            # The top bit picks the sign so colliding features tend to cancel out
+            signs.append(np.where(hashes >> 31, -1.0, 1.0).astype(np.float32))
+
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if rows:
+            np.add.at(matrix, (np.concatenate(rows), np.concatenate(columns)), np.concatenate(signs))
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def embed_array(self, texts):
+        """Embed `texts` into a float32 matrix with one row per text."""
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack([
+            self._embed_batch(texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ])
+
+    def embed_documents(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_array([text])[0].tolist()
+
+    def embed_queries(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+
+def create_google_embeddings():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    return GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+
+
+EMBEDDING_BACKENDS = {
+    "google": create_google_embeddings,
+    "local": HashingEmbeddings,
+}
+
+
+def create_embeddings(backend=None):
+    """Create the embedding provider for `backend` (default: `EMBEDDING_BACKEND`)."""
+    backend = backend or EMBEDDING_BACKEND
+    try:
+        factory = EMBEDDING_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f"Unknown embedding backend {backend!r}; expected one of {sorted(EMBEDDING_BACKENDS)}"
+        )
+    return factory()
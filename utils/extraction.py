@@ -0,0 +1,113 @@
+"""
+PDF text extraction for uploaded documents.
+
+Extraction is CPU bound, so it runs in a process pool instead of the web
+worker. A document is split into page ranges that are extracted in
+parallel, so large PDFs finish in roughly 1 / workers of the serial time,
+and the text is returned as one string per page rather than being
+concatenated as it is read.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF for PDF text extraction
+
+# Separates pages when a document's text is stored as a single string
+PAGE_SEPARATOR = "\f"
+
+# Number of worker processes used for extraction
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+# Number of pages extracted by a worker in one go
+EXTRACTION_BATCH_PAGES = int(os.getenv("EXTRACTION_BATCH_PAGES", "32"))
+
+_process_pool = None
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+
+def count_pdf_pages(file_path):
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+# The document a worker process last read from, kept open so the ranges
+# of one PDF handed to the same worker do not parse it again
+_open_document = (None, None)
+
+
+def open_worker_document(file_path):
+    global _open_document
+    key = (file_path, os.stat(file_path).st_mtime_ns)
+    cached_key, doc = _open_document
+    if cached_key != key:
+        if doc is not None:
+            doc.close()
+        doc = fitz.open(file_path)
+        _open_document = (key, doc)
+    return doc
+
+
+def extract_page_range(file_path, start, stop):
+    """Return the text of pages `start` to `stop` (exclusive) of the PDF at `file_path`."""
+    doc = open_worker_document(file_path)
+    return [doc[page_number].get_text() for page_number in range(start, stop)]
+
+
+def get_page_ranges(pages_total, workers=EXTRACTION_WORKERS, batch_pages=EXTRACTION_BATCH_PAGES):
+    """
+    Split `pages_total` pages into consecutive (start, stop) ranges of at
+    most `batch_pages` pages, small enough that every worker gets one.
+    """
+    size = max(1, min(batch_pages, -(-pages_total // max(1, workers))))
+    return [(start, min(start + size, pages_total)) for start in range(0, pages_total, size)]
+
+
+async def extract_pdf_pages(file_path, on_progress=None):
+    """
+    Extract the text of every page of the PDF at `file_path` across the
+    worker processes and return it as a list with one string per page.
+
+    Page ranges are extracted in parallel, each worker opening the file by
+    path so no document bytes are pickled, and merged back in page order.
+    `on_progress(pages_done, pages_total)` is called as ranges finish.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+
+    pages_total = await loop.run_in_executor(pool, count_pdf_pages, file_path)
+    if on_progress:
+        on_progress(0, pages_total)
+
+    async def extract_range(start, stop):
+        return start, await loop.run_in_executor(pool, extract_page_range, file_path, start, stop)
+
+    tasks = [asyncio.ensure_future(extract_range(start, stop)) for start, stop in get_page_ranges(pages_total)]
+    pages = [None] * pages_total
+    pages_done = 0
+    try:
+        for next_range in asyncio.as_completed(tasks):
+            start, batch = await next_range
+            pages[start:start + len(batch)] = batch
+            pages_done += len(batch)
+            if on_progress:
+                on_progress(pages_done, pages_total)
+    finally:
+        # A failed range cancels the ranges that have not started yet
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return pages
@@ -0,0 +1,303 @@
+"""
+Routing of LLM calls across a pool of long-lived Groq clients.
+
+Every configured API key gets one `ChatGroq` client for the life of the
+process, so its HTTP connections are reused between questions. An
+`LLMRouter` sits in front of them and behaves like a chat model inside
+LangChain chains:
+
+- Keys are tried in order; a failure fails over to the next key.
+- A key answering 429 is skipped until its `retry-after` has passed.
+- A key that fails `failure_threshold` times in a row is skipped (circuit
+  open) for `reset_timeout` seconds, then given one trial request (half
+  open): the first caller is let through and the others keep skipping
+  the key until the trial succeeds, which closes the circuit, or fails,
+  which opens it again. A trial that never reports is replaced by another
+  after a further `reset_timeout`.
+- If the first key has not answered within `hedge_delay` seconds, the
+  same request is sent to the next key and the first answer wins.
+- Failovers and hedges spend from a retry budget that refills with
+  traffic, so an outage cannot multiply the load on the remaining keys.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from langchain_core.runnables import Runnable
+
+load_dotenv('.env')
+
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "Llama3-8b-8192")
+# Context window of the model in tokens, shared by retrieved chunks, prompt and answer
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "8192"))
+# Optional override of the Groq API URL, e.g. a local stub server in tests
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")
+# Seconds before a slow request is hedged on the next key; 0 disables hedging
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "5"))
+# Consecutive failures that open a key's circuit, and how long it stays open
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))
+LLM_CIRCUIT_RESET = float(os.getenv("LLM_CIRCUIT_RESET", "30"))
+# Extra attempts (failovers and hedges) allowed per request, on average
+LLM_RETRY_RATIO = float(os.getenv("LLM_RETRY_RATIO", "0.2"))
+# Cool-down for a rate limited key when the server does not say how long
+DEFAULT_RATE_LIMIT_COOLDOWN = 10.0
+
+
+class NoLLMAvailableError(RuntimeError):
+    pass
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of requests: each request
+    deposits `ratio` tokens and each retry withdraws one.
+    """
+
+    def __init__(self, ratio=LLM_RETRY_RATIO, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def get_retry_after(error):
+    """Return the server's requested back-off for a rate limit error, or None if it is not one."""
+    response = getattr(error, "response", None)
+    if getattr(error, "status_code", None) != 429 and getattr(response, "status_code", None) != 429:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return DEFAULT_RATE_LIMIT_COOLDOWN
+
+
+class LLMEndpoint:
+    """
+    One long-lived client plus the health state the router keeps for it.
+    """
+
+    def __init__(self, name, llm, failure_threshold=LLM_FAILURE_THRESHOLD, reset_timeout=LLM_CIRCUIT_RESET):
+        self.name = name
+        self.llm = llm
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+        self._lock = threading.Lock()
+
+    def is_available(self, now=None):
+        return (now or time.monotonic()) >= self.unavailable_until
+
+    def acquire(self, now=None):
+        """
+        Whether a request may be sent to this key now. Once an open circuit
+        has waited out `reset_timeout`, only the caller getting True is
+        sent: the key stays skipped for the others while its trial runs.
+        """
+        now = now or time.monotonic()
+        with self._lock:
+            if now < self.unavailable_until:
+                return False
+            if self.consecutive_failures >= self.failure_threshold:
+                self.unavailable_until = now + self.reset_timeout
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.unavailable_until = 0.0
+
+    def record_failure(self, error):
+        now = time.monotonic()
+        retry_after = get_retry_after(error)
+        with self._lock:
+            if retry_after is not None:
+                self.unavailable_until = max(self.unavailable_until, now + retry_after)
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.unavailable_until = now + self.reset_timeout
+
+
+class LLMRouter(Runnable):
+    """
+    Chat-model runnable spreading calls over `endpoints`; see the module
+    docstring for the failover, circuit breaking and hedging rules.
+    """
+
+    def __init__(self, endpoints, hedge_delay=LLM_HEDGE_DELAY, retry_budget=None):
+        self.endpoints = list(endpoints)
+        self.hedge_delay = hedge_delay
+        self.retry_budget = retry_budget or RetryBudget()
+
+    def candidates(self):
+        """
+        Endpoints not known to be down, in priority order. A half-open
+        circuit's trial is only claimed when its endpoint is tried; see `_claim`.
+        """
+        now = time.monotonic()
+        return [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+
+    def _claim(self, candidates, first=False):
+        """
+        Pop the next of `candidates` that takes the request. If none does,
+        the first attempt falls back on the endpoint that recovers first;
+        later attempts get None.
+        """
+        while candidates:
+            endpoint = candidates.pop(0)
+            if endpoint.acquire():
+                return endpoint
+        if not first:
+            return None
+        if not self.endpoints:
+            raise NoLLMAvailableError("No LLM API key is configured.")
+        return min(self.endpoints, key=lambda endpoint: endpoint.unavailable_until)
+
+    def _attempts(self):
+        # The first attempt is free; every further one needs retry budget
+        self.retry_budget.deposit()
+        candidates = self.candidates()
+        endpoint = self._claim(candidates, first=True)
+        while endpoint is not None:
+            yield endpoint
+            if not candidates or not self.retry_budget.try_spend():
+                return
+            endpoint = self._claim(candidates)
+
+    def invoke(self, input, config=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            try:
+                result = endpoint.llm.invoke(input, config, **kwargs)
+            except Exception as e:
+                endpoint.record_failure(e)
+                error = e
+                continue
+            endpoint.record_success()
+            return result
+        raise error or NoLLMAvailableError("No LLM endpoint is available.")
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self.retry_budget.deposit()
+        candidates = self.candidates()
+        pending = {}
+        errors = []
+        hedge = bool(self.hedge_delay)
+
+        def launch(endpoint):
+            if endpoint is None:
+                return
+            task = asyncio.ensure_future(endpoint.llm.ainvoke(input, config, **kwargs))
+            pending[task] = endpoint
+
+        launch(self._claim(candidates, first=True))
+        try:
+            while pending:
+                timeout = self.hedge_delay if hedge and candidates else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The request is slow: race it on the next key, budget permitting
+                    if self.retry_budget.try_spend():
+                        launch(self._claim(candidates))
+                    else:
+                        hedge = False
+                    continue
+                for task in done:
+                    endpoint = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        endpoint.record_failure(e)
+                        errors.append(e)
+                        continue
+                    endpoint.record_success()
+                    return result
+                if not pending and candidates and self.retry_budget.try_spend():
+                    launch(self._claim(candidates))
+        finally:
+            # Losing hedges are cancelled and reaped so no request outlives the call
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        raise errors[-1] if errors else NoLLMAvailableError("No LLM endpoint is available.")
+
+    def stream(self, input, config=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            started = False
+            try:
+                for chunk in endpoint.llm.stream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                endpoint.record_failure(e)
+                # Once tokens reached the client the answer cannot be swapped
+                if started:
+                    raise
+                error = e
+                continue
+            endpoint.record_success()
+            return
+        raise error or NoLLMAvailableError("No LLM endpoint is available.")
+
+    async def astream(self, input, config=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            started = False
+            try:
+                async for chunk in endpoint.llm.astream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                endpoint.record_failure(e)
+                # Once tokens reached the client the answer cannot be swapped
+                if started:
+                    raise
+                error = e
+                continue
+            endpoint.record_success()
+            return
+        raise error or NoLLMAvailableError("No LLM endpoint is available.")
+
+
+def create_groq_client(api_key, base_url=None):
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        groq_api_key=api_key,
+        model_name=LLM_MODEL_NAME,
+        base_url=base_url or GROQ_BASE_URL,
+        # Retries are the router's job, so a rate limited key fails over at once
+        max_retries=0,
+    )
+
+
+def get_api_keys():
+    keys = [os.getenv("GROQ_API_KEY"), os.getenv("GROQ_API_KEY_BACKUP")]
+    return [key for key in keys if key]
+
+
+@lru_cache(maxsize=None)
+def get_llm_router():
+    """The process-wide router over one long-lived client per configured key."""
+    return LLMRouter([
+        LLMEndpoint(f"groq-{index}", create_groq_client(key))
+        for index, key in enumerate(get_api_keys())
+    ])
@@ -1,50 +1,421 @@
 from fastapi import WebSocketDisconnect
 from langchain_community.vectorstores import Chroma  # Vector store for content retrieval
-from langchain_groq import ChatGroq
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import Document
+from chromadb.utils.batch_utils import create_batches
 
 from langchain_core.prompts import ChatPromptTemplate 
+from langchain_core.runnables import Runnable
 from langchain.chains.retrieval import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 
+import asyncio
+import contextvars
 import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from operator import itemgetter
 from dotenv import load_dotenv
+
+from utils.admission import FairQueue, QueueFullError, QueueTimeoutError
+from utils.batching import BatchedRetriever, MicroBatcher, SingleFlight, embed_queries
+from utils.bm25 import HybridRetriever, KeywordIndexStore
+from utils.cache import AnswerCache, LRUCache, normalize_question
+from utils.embedding_cache import get_model_name, hash_text, with_embedding_cache
+from utils.embeddings import EMBEDDING_BACKEND, create_embeddings
+from utils.extraction import PAGE_SEPARATOR
+from utils.chunking import chunk_pages, get_chunk_tokens
+from utils.llm import get_llm_router, LLM_CONTEXT_TOKENS
+from utils.vector_store import DocumentVectors, NumpyVectorStore, search_vectors
+from utils.metrics import ERRORS, record_stage, registry, timed
 load_dotenv('.env')
-## load the GROQ And OpenAI API KEY 
-groq_api_key=os.getenv('GROQ_API_KEY')
-backup_groq_api_key = os.getenv('GROQ_API_KEY_BACKUP')
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-
-
-# Load extracted text into a vector store for efficient retrieval
-def create_vector_store(pdf_text):
-   
-    if isinstance(pdf_text, list):
-        pdf_text = " ".join(pdf_text)
-    # Create a Document object
-    doc = Document(page_content=pdf_text, metadata={})
-    text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,
+
+
+# Directory where the persisted vector index for all uploaded documents lives
+VECTOR_INDEX_DIRECTORY = os.getenv("VECTOR_INDEX_DIRECTORY", "vector_index")
+# Name of the Chroma collection holding the chunks of every document; one per
+# embedding backend, since their vectors are not comparable
+COLLECTION_NAME = f"pdf_documents_{EMBEDDING_BACKEND}"
+# Where vectors are stored and searched: `chroma`, or `numpy` for the
+# memory-mapped matrices of `utils.vector_store` (exact search, no database)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+# Chunks retrieved per question, and the chunk size in tokens that lets
+# them fit in the model's context window next to the prompt and answer
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "3"))
+CHUNK_TOKENS = get_chunk_tokens(LLM_CONTEXT_TOKENS, RETRIEVAL_K)
+# How chunks are retrieved: `hybrid` fuses vector (MMR) and BM25 keyword
+# rankings, `vector` and `keyword` use one of them; `keyword` never calls
+# the embedding model
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# MMR settings of the vector search: candidates fetched per question, and
+# their relevance/diversity balance (0 favours diversity)
+MMR_FETCH_K = 20
+MMR_LAMBDA = 0.25
+
+# Questions arriving within QA_BATCH_WINDOW_MS of each other are embedded
+# and searched together, up to QA_BATCH_SIZE at a time; 0 turns batching
+# off and leaves vector search to Chroma
+QA_BATCH_SIZE = int(os.getenv("QA_BATCH_SIZE", "32"))
+QA_BATCH_WINDOW_MS = float(os.getenv("QA_BATCH_WINDOW_MS", "3"))
+# Vectors of recently searched documents, and of recently asked questions
+# so a question is embedded once for the answer cache and retrieval
+DOCUMENT_VECTORS_CACHE_SIZE = int(os.getenv("DOCUMENT_VECTORS_CACHE_SIZE", "64"))
+# Batched questions about more documents than this are searched by
+# Chroma's filtered index rather than by loading every document's vectors
+MATRIX_SEARCH_MAX_DOCUMENTS = int(os.getenv("MATRIX_SEARCH_MAX_DOCUMENTS", "16"))
+document_vectors_cache = LRUCache(maxsize=DOCUMENT_VECTORS_CACHE_SIZE)
+question_vectors_cache = LRUCache(maxsize=1024, ttl=600)
+
+# Process-wide cache of built QA chains keyed by content hashes, bounded
+# so memory stays capped however many WebSocket sessions are open
+QA_CHAIN_CACHE_SIZE = int(os.getenv("QA_CHAIN_CACHE_SIZE", "256"))
+QA_CHAIN_CACHE_TTL = float(os.getenv("QA_CHAIN_CACHE_TTL", "1800"))
+qa_chain_cache = LRUCache(maxsize=QA_CHAIN_CACHE_SIZE, ttl=QA_CHAIN_CACHE_TTL)
+
+# Answers keyed by document set and normalised question, so repeated questions
+# skip retrieval and the LLM; near-duplicates match above the similarity threshold
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+answer_cache = AnswerCache(
+    maxsize=ANSWER_CACHE_SIZE,
+    ttl=ANSWER_CACHE_TTL,
+    similarity_threshold=ANSWER_CACHE_SIMILARITY,
 )
-    
-    split_docs = text_splitter.split_documents([doc])
-    embeddings = GoogleGenerativeAIEmbeddings(model = "models/embedding-001")
-    
-    docsearch = Chroma.from_documents(split_docs, embedding=embeddings)
-    return docsearch.as_retriever(
-        search_type="mmr",
-        search_kwargs={'k': 3, 'lambda_mult': 0.25}
+
+# Opened vector stores and keyword index stores keyed by their directory;
+# the lock guards both registries
+_vector_stores = {}
+_keyword_stores = {}
+_vector_stores_lock = threading.Lock()
+
+# Maximum number of questions answered at the same time by one worker,
+# questions allowed to wait for one of those slots, and seconds they may
+# wait before being told to retry
+QA_MAX_CONCURRENCY = int(os.getenv("QA_MAX_CONCURRENCY", "16"))
+QA_MAX_QUEUE_DEPTH = int(os.getenv("QA_MAX_QUEUE_DEPTH", "64"))
+QA_QUEUE_TIMEOUT = float(os.getenv("QA_QUEUE_TIMEOUT", "30"))
+# Threads available for blocking embedding, indexing and vector store work
+QA_EXECUTOR_WORKERS = int(os.getenv("QA_EXECUTOR_WORKERS", "8"))
+qa_executor = ThreadPoolExecutor(max_workers=QA_EXECUTOR_WORKERS, thread_name_prefix="qa")
+
+# One admission queue, and one set of batchers, per event loop, since
+# asyncio primitives are bound to a loop
+_admission_queues = weakref.WeakKeyDictionary()
+_batchers = weakref.WeakKeyDictionary()
+
+ANSWER_CACHE_LOOKUPS = registry.counter("pdf_qa_answer_cache_lookups_total", "Answer cache lookups.", ["result"])
+INDEXED_CHUNKS = registry.counter(
+    "pdf_qa_indexed_chunks_total", "Chunks indexed, embedded anew or with a reused vector.", ["source"]
+)
+EXECUTOR_QUEUE_DEPTH = registry.gauge(
+    "pdf_qa_executor_queue_depth", "Blocking tasks waiting for a QA executor thread."
+)
+
+
+def get_admission_queue():
+    loop = asyncio.get_running_loop()
+    queue = _admission_queues.get(loop)
+    if queue is None:
+        queue = FairQueue(QA_MAX_CONCURRENCY, QA_MAX_QUEUE_DEPTH, QA_QUEUE_TIMEOUT)
+        _admission_queues[loop] = queue
+    return queue
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run blocking or CPU-bound work in the bounded QA executor so it never
+    stalls the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context over so timing spans reach its request
+    context = contextvars.copy_context()
+    # Counted as waiting until a thread picks it up or the caller gives up,
+    # whichever comes first
+    waiting = [True]
+
+    def stop_waiting():
+        try:
+            waiting.pop()
+        except IndexError:
+            return
+        EXECUTOR_QUEUE_DEPTH.dec()
+
+    def call():
+        stop_waiting()
+        return context.run(func, *args, **kwargs)
+
+    EXECUTOR_QUEUE_DEPTH.inc()
+    try:
+        return await loop.run_in_executor(qa_executor, call)
+    finally:
+        stop_waiting()
+
+
+@asynccontextmanager
+async def qa_slot(user_id=None, on_queued=None):
+    """
+    Hold one of the `QA_MAX_CONCURRENCY` slots of this worker, admitted
+    fairly among users through the admission queue (see
+    `utils.admission`), and time the wait as `queue`.
+    """
+    queue = get_admission_queue()
+    with timed("queue"):
+        await queue.acquire(user_id, on_queued)
+    try:
+        yield
+    finally:
+        queue.release()
+
+
+class TimedRunnable(Runnable):
+    """Runnable timing every call of `runnable` as a span of `stage`."""
+
+    def __init__(self, runnable, stage):
+        self.runnable = runnable
+        self.stage = stage
+
+    def invoke(self, input, config=None, **kwargs):
+        with timed(self.stage):
+            return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        with timed(self.stage):
+            return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        with timed(self.stage):
+            yield from self.runnable.stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        first = True
+        with timed(self.stage):
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                if first:
+                    record_stage(f"{self.stage}_first_token", time.perf_counter() - start)
+                    first = False
+                yield chunk
+
+
+def get_embeddings():
+    # Chunks seen before, in any document, are served from the disk cache
+    return with_embedding_cache(create_embeddings(EMBEDDING_BACKEND))
+
+
+def get_vector_store():
+    """
+    Open the persisted vector store that holds the chunks of every uploaded
+    document under the `content_hash` of its PDF, so identical uploads
+    share one set of chunks and embeddings: a Chroma collection, or a
+    `NumpyVectorStore` when `VECTOR_BACKEND` is `numpy`. The store is
+    opened once per process and shared by every retriever.
+    """
+    if VECTOR_BACKEND not in ("chroma", "numpy"):
+        raise ValueError(f"Unknown vector backend {VECTOR_BACKEND!r}; expected 'chroma' or 'numpy'")
+    key = (VECTOR_INDEX_DIRECTORY, VECTOR_BACKEND)
+    with _vector_stores_lock:
+        vector_store = _vector_stores.get(key)
+        if vector_store is None:
+            with timed("vector_load"):
+                if VECTOR_BACKEND == "numpy":
+                    vector_store = NumpyVectorStore(
+                        os.path.join(VECTOR_INDEX_DIRECTORY, f"numpy_{EMBEDDING_BACKEND}"),
+                        get_embeddings(),
+                        cache_size=DOCUMENT_VECTORS_CACHE_SIZE,
+                    )
+                else:
+                    vector_store = Chroma(
+                        collection_name=COLLECTION_NAME,
+                        embedding_function=get_embeddings(),
+                        persist_directory=VECTOR_INDEX_DIRECTORY,
+                    )
+            _vector_stores[key] = vector_store
+        return vector_store
+
+
+def get_keyword_index_store():
+    """
+    Open the BM25 keyword indexes stored next to the vector index, once
+    per process.
+    """
+    directory = os.path.join(VECTOR_INDEX_DIRECTORY, "bm25")
+    with _vector_stores_lock:
+        store = _keyword_stores.get(directory)
+        if store is None:
+            store = KeywordIndexStore(directory)
+            _keyword_stores[directory] = store
+        return store
+
+
+# Split extracted text into overlapping chunks ready to be embedded
+def split_pdf_text(pdf_text, metadata=None):
+    """
+    Split a document into token-sized chunks (see `utils.chunking`) that
+    never cross a page boundary, each tagged with its 1-based `page` number,
+    `start_index` and `token_count` on top of `metadata`.
+
+    `pdf_text` is either a list with the text of each page, or a string
+    whose pages are separated by `PAGE_SEPARATOR`.
+    """
+    pages = pdf_text if isinstance(pdf_text, list) else pdf_text.split(PAGE_SEPARATOR)
+    with timed("chunking"):
+        return chunk_pages(pages, CHUNK_TOKENS, metadata=metadata)
+
+
+def has_document_index(content_hash):
+    """Return True if this document is already in the vector and keyword indexes."""
+    if not get_keyword_index_store().exists(content_hash):
+        return False
+    vector_store = get_vector_store()
+    if VECTOR_BACKEND == "numpy":
+        return vector_store.exists(content_hash)
+    result = vector_store.get(where={"content_hash": content_hash}, limit=1)
+    return len(result["ids"]) > 0
+
+
+def find_unindexed_documents(content_hashes):
+    """Return the content hashes that are missing from the indexes."""
+    return [content_hash for content_hash in content_hashes if not has_document_index(content_hash)]
+
+
+def index_document(content_hash, pdf_text, previous_hash=None):
+    """
+    Chunk and embed a document once and persist the result in the vector
+    index under the PDF's content hash, replacing any chunks previously
+    stored for the same hash. Returns the indexed chunks in id order.
+
+    Chunks whose text is already indexed, for this hash or for
+    `previous_hash` (the version of the document this one replaces),
+    reuse their stored vectors, so only new or changed chunks are embedded.
+    """
+    split_docs = split_pdf_text(pdf_text, metadata={"content_hash": content_hash})
+    vector_store = get_vector_store()
+    # Answers given from the previous version of the document are stale
+    answer_cache.invalidate(content_hash)
+    document_vectors_cache.pop((VECTOR_INDEX_DIRECTORY, content_hash))
+
+    vectors = {}
+    existing_ids = []
+    for source_hash in dict.fromkeys([content_hash, previous_hash]):
+        if source_hash is None:
+            continue
+        if VECTOR_BACKEND == "numpy":
+            stored = vector_store.load(source_hash)
+            if stored is None:
+                continue
+            for doc, vector in zip(stored.docs, stored.matrix):
+                vectors.setdefault(hash_text(doc.page_content), vector)
+            continue
+        stored = vector_store.get(where={"content_hash": source_hash}, include=["documents", "embeddings"])
+        if source_hash == content_hash:
+            existing_ids = stored["ids"]
+        for text, vector in zip(stored["documents"], stored["embeddings"]):
+            vectors.setdefault(hash_text(text), vector)
+
+    # Embed each new or changed chunk text once, in one batch
+    keys = [hash_text(doc.page_content) for doc in split_docs]
+    missing = {}
+    for key, doc in zip(keys, split_docs):
+        if key not in vectors:
+            missing.setdefault(key, doc.page_content)
+    if missing:
+        with timed("embedding"):
+            vectors.update(zip(missing, vector_store.embeddings.embed_documents(list(missing.values()))))
+    INDEXED_CHUNKS.inc(len(missing), source="embedded")
+    INDEXED_CHUNKS.inc(len(split_docs) - len(missing), source="reused")
+
+    ids = [f"{content_hash}-{i}" for i in range(len(split_docs))]
+    stale_ids = sorted(set(existing_ids) - set(ids))
+    with timed("vector_build"):
+        if VECTOR_BACKEND == "numpy":
+            # Written out whole; the old files are replaced, stale ids and all
+            vector_store.save(content_hash, ids, split_docs, [vectors[key] for key in keys])
+        elif stale_ids:
+            vector_store.delete(ids=stale_ids)
+        if split_docs and VECTOR_BACKEND != "numpy":
+            # Upsert with the vectors worked out above; the wrapper's
+            # add_documents would embed every chunk again. Chroma refuses
+            # writes above its max batch size, so large documents go in
+            # several batches, as add_documents would send them
+            for batch_ids, batch_embeddings, batch_metadatas, batch_documents in create_batches(
+                api=vector_store._client,
+                ids=ids,
+                embeddings=[[float(value) for value in vectors[key]] for key in keys],
+                metadatas=[doc.metadata for doc in split_docs],
+                documents=[doc.page_content for doc in split_docs],
+            ):
+                vector_store._collection.upsert(
+                    ids=batch_ids,
+                    embeddings=batch_embeddings,
+                    documents=batch_documents,
+                    metadatas=batch_metadatas,
+                )
+        get_keyword_index_store().save(content_hash, ids, split_docs)
+    return split_docs
+
+
+def delete_document_index(content_hash):
+    """Remove every chunk of a document from the vector and keyword indexes."""
+    vector_store = get_vector_store()
+    answer_cache.invalidate(content_hash)
+    document_vectors_cache.pop((VECTOR_INDEX_DIRECTORY, content_hash))
+    get_keyword_index_store().delete(content_hash)
+    if VECTOR_BACKEND == "numpy":
+        vector_store.delete(content_hash)
+        return
+    existing = vector_store.get(where={"content_hash": content_hash})
+    if existing["ids"]:
+        vector_store.delete(ids=existing["ids"])
+
+
+# Load one retriever over every document a user can ask about
+def load_retriever(content_hashes, mode=None):
+    """
+    The search is restricted to the user's documents by a metadata filter
+    evaluated inside the index, so nothing is concatenated or rebuilt as
+    the user's library grows. `mode` defaults to `RETRIEVAL_MODE`.
+    """
+    mode = mode or RETRIEVAL_MODE
+    if mode not in ("hybrid", "vector", "keyword"):
+        raise ValueError(f"Unknown retrieval mode {mode!r}; expected 'hybrid', 'vector' or 'keyword'")
+    vector_retriever = None
+    if mode != "keyword" and QA_BATCH_SIZE > 0:
+        vector_retriever = BatchedRetriever(
+            content_hashes=list(content_hashes),
+            search=search_batched,
+            search_sync=search_documents,
+        )
+    elif mode != "keyword" and VECTOR_BACKEND == "numpy":
+        vector_retriever = get_vector_store().as_retriever(
+            content_hashes, k=RETRIEVAL_K, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA
+        )
+    elif mode != "keyword":
+        vector_retriever = get_vector_store().as_retriever(
+            search_type="mmr",
+            search_kwargs={
+                'k': RETRIEVAL_K,
+                'fetch_k': MMR_FETCH_K,
+                'lambda_mult': MMR_LAMBDA,
+                'filter': {"content_hash": {"$in": list(content_hashes)}},
+            }
+        )
+    if mode == "vector":
+        return vector_retriever
+    return HybridRetriever(
+        keyword_store=get_keyword_index_store(),
+        content_hashes=list(content_hashes),
+        k=RETRIEVAL_K,
+        vector_retriever=vector_retriever,
+        run=run_blocking,
     )
 
 # Set up the LangChain conversational retrieval chain
-def create_qa_chain(retriever,groq_api_key):
+def create_qa_chain(retriever, llm=None):
     
-    llm=ChatGroq(
-            groq_api_key=groq_api_key,
-             model_name="Llama3-8b-8192")
+    # Calls go through the pool of long-lived clients with key failover
+    llm=llm or get_llm_router()
 
     prompt = ChatPromptTemplate.from_template(
     """
@@ -62,59 +433,323 @@ def create_qa_chain(retriever,groq_api_key):
     )
 
 
+    # Both steps are timed, so per-request breakdowns show retrieval and LLM apart
     document_chain = create_stuff_documents_chain(
-        llm, 
+        TimedRunnable(llm, "llm"),
         prompt
     ) 
     retrieval_chain = create_retrieval_chain(
-        retriever,
+        TimedRunnable(itemgetter("input") | retriever, "retrieval"),
         document_chain
     )
     return retrieval_chain
 
-async def get_answer_from_model(question, pdf_content):
+
+def get_qa_chain(content_hashes):
+    """
+    Return the retrieval chain over a set of documents, building it only on
+    the first request so sessions on the same documents share it.
+    """
+    content_hashes = tuple(sorted(content_hashes))
+    return qa_chain_cache.get_or_create(
+        content_hashes,
+        lambda: create_qa_chain(load_retriever(content_hashes)),
+    )
+
+
+def embed_question(question):
+    return embed_questions([question])[0]
+
+
+def embed_questions(questions):
+    """
+    Vectors of `questions`, embedding those not asked recently in one call.
+    """
+    embeddings = get_vector_store().embeddings
+    model_name = get_model_name(embeddings)
+    vectors = {question: question_vectors_cache.get((model_name, question)) for question in questions}
+    missing = [question for question, vector in vectors.items() if vector is None]
+    if missing:
+        with timed("embedding"):
+            embedded = embed_queries(embeddings, missing)
+        for question, vector in zip(missing, embedded):
+            vectors[question] = vector
+            question_vectors_cache.set((model_name, question), vector)
+    return [vectors[question] for question in questions]
+
+
+def get_document_vectors(content_hash):
+    """The chunks and normalised vectors of an indexed document, cached in memory."""
+    if VECTOR_BACKEND == "numpy":
+        # Memory-mapped, and cached by the store itself
+        with timed("vector_load"):
+            vectors = get_vector_store().load(content_hash)
+        return vectors if vectors is not None else DocumentVectors.empty()
+    key = (VECTOR_INDEX_DIRECTORY, content_hash)
+    vectors = document_vectors_cache.get(key)
+    if vectors is None:
+        with timed("vector_load"):
+            result = get_vector_store().get(
+                where={"content_hash": content_hash},
+                include=["documents", "metadatas", "embeddings"],
+            )
+        vectors = DocumentVectors.from_store_result(result)
+        # Not indexed yet (or by another worker); look again next time
+        if len(vectors):
+            document_vectors_cache.set(key, vectors)
+    return vectors
+
+
+def search_questions(requests):
+    """
+    Retrieve the chunks for a batch of `(content_hashes, question)`
+    requests: the questions are embedded in one call, and each document
+    set is searched for all of its questions with one matrix product.
+    """
+    vectors = embed_questions([question for _, question in requests])
+    scopes = {}
+    for position, (content_hashes, _) in enumerate(requests):
+        scopes.setdefault(tuple(sorted(content_hashes)), []).append(position)
+
+    results = [None] * len(requests)
+    for scope, positions in scopes.items():
+        if VECTOR_BACKEND == "chroma" and len(scope) > MATRIX_SEARCH_MAX_DOCUMENTS:
+            # A large library would be loaded in full for every batch
+            with timed("vector_search"):
+                found = [search_vector_store(scope, vectors[position]) for position in positions]
+        else:
+            document_vectors = [get_document_vectors(content_hash) for content_hash in scope]
+            with timed("vector_search"):
+                found = search_vectors(
+                    document_vectors,
+                    [vectors[position] for position in positions],
+                    k=RETRIEVAL_K,
+                    fetch_k=MMR_FETCH_K,
+                    lambda_mult=MMR_LAMBDA,
+                )
+        for position, docs in zip(positions, found):
+            results[position] = docs
+    return results
+
+
+def search_vector_store(content_hashes, vector):
+    """MMR search of the Chroma index, filtered to these documents, for a question vector."""
+    return get_vector_store().max_marginal_relevance_search_by_vector(
+        vector,
+        k=RETRIEVAL_K,
+        fetch_k=MMR_FETCH_K,
+        lambda_mult=MMR_LAMBDA,
+        filter={"content_hash": {"$in": list(content_hashes)}},
+    )
+
+
+def search_documents(content_hashes, question):
+    return search_questions([(content_hashes, question)])[0]
+
+
+def get_batchers():
+    """The question embedding and search batchers of the running event loop."""
+    loop = asyncio.get_running_loop()
+    batchers = _batchers.get(loop)
+    if batchers is None:
+        window = QA_BATCH_WINDOW_MS / 1000
+        batchers = {
+            "embed": MicroBatcher("embed", embed_questions, run_blocking, window, QA_BATCH_SIZE),
+            "search": MicroBatcher("search", search_questions, run_blocking, window, QA_BATCH_SIZE),
+            "answers": SingleFlight(),
+        }
+        _batchers[loop] = batchers
+    return batchers
+
+
+async def embed_question_batched(question):
+    return await get_batchers()["embed"].submit(question)
+
+
+async def search_batched(content_hashes, question):
+    return await get_batchers()["search"].submit((tuple(content_hashes), question))
+
+
+def get_cached_answer(question, content_hashes):
+    """
+    The cached `(answer, sources)` of exactly this question about these
+    documents, or None. Cheap enough to try before admission.
+    """
+    hit = answer_cache.get(tuple(sorted(content_hashes)), question)
+    if hit is not None:
+        ANSWER_CACHE_LOOKUPS.inc(result="hit")
+    return hit
+
+
+async def lookup_cached_answer(question, content_hashes):
+    """
+    Return `(hit, vector)` from the answer cache for a question about
+    these documents; see `AnswerCache.lookup`.
+    """
+    scope = tuple(sorted(content_hashes))
+    with timed("cache_lookup"):
+        # Keyword retrieval promises no embedding calls, so it only gets exact hits
+        if answer_cache.similarity_threshold > 0 and RETRIEVAL_MODE != "keyword" and QA_BATCH_SIZE > 0:
+            # On an exact miss, embedded together with the other questions of
+            # the moment; the vector is kept for retrieval
+            hit, vector = await answer_cache.alookup(scope, question, embed_question_batched)
+        elif answer_cache.similarity_threshold > 0 and RETRIEVAL_MODE != "keyword":
+            # Embedding the question may be a network call, so keep it off the loop
+            hit, vector = await run_blocking(answer_cache.lookup, scope, question, embed_question)
+        else:
+            hit, vector = answer_cache.lookup(scope, question)
+    ANSWER_CACHE_LOOKUPS.inc(result="miss" if hit is None else "hit")
+    return hit, vector
+
+
+def remember_answer(question, content_hashes, answer, sources, vector):
+    answer_cache.set(tuple(sorted(content_hashes)), question, answer, sources, vector)
+
+
+def get_sources(response):
+    # Metadata of the chunks an answer was generated from, copied so callers
+    # can annotate it without touching the chunks
+    return [dict(doc.metadata) for doc in response.get("context", [])]
+
+
+async def get_answer_from_model(question, content_hashes, retrieval_chain=None, user_id=None, on_queued=None):
+    """
+    Answer a question about the documents with these content hashes.
+
+    Unless the exact question was answered before, the question waits for
+    a slot of the admission queue as `user_id`, awaiting
+    `on_queued(position)` if it has to queue; `QueueFullError` or
+    `QueueTimeoutError` is raised if it is turned away.
+    """
+    if not content_hashes:
+        return "No PDF has been uploaded yet. Please upload a PDF before asking questions."
+
+    # Repeated questions are answered from the cache in milliseconds
+    hit = get_cached_answer(question, content_hashes)
+    if hit is not None:
+        return hit[0]
+    if QA_BATCH_SIZE > 0:
+        # The same question about the same documents, already being
+        # answered for another session, is waited for rather than asked
+        # again; its place in the queue is reported to every session
+        key = (tuple(sorted(content_hashes)), normalize_question(question))
+        return await get_batchers()["answers"].run(
+            key,
+            lambda flight: generate_answer(
+                question, content_hashes, retrieval_chain, user_id, flight.notify, flight.clear
+            ),
+            listener=on_queued,
+        )
+    return await generate_answer(question, content_hashes, retrieval_chain, user_id, on_queued)
+
+
+async def generate_answer(question, content_hashes, retrieval_chain=None, user_id=None, on_queued=None, on_admitted=None):
     try:
-    
-        try:
-            
-            # Load PDF content into vector store
-            retriever = create_vector_store(pdf_content)
-            retrieval_chain = create_qa_chain(retriever,groq_api_key)
-    
+        # Reuse the session's chain, or the one shared for these documents;
+        # failover between API keys happens inside the chain's LLM router
+        retrieval_chain = retrieval_chain or await run_blocking(get_qa_chain, content_hashes)
+
+        async with qa_slot(user_id, on_queued):
+            if on_admitted is not None:
+                on_admitted()
+            # Matching near-duplicates embeds the question, so it waits for
+            # admission like the rest of the work
+            hit, vector = await lookup_cached_answer(question, content_hashes)
+            if hit is not None:
+                return hit[0]
+
             # Generate response using the question and memory context
-            response = retrieval_chain.invoke({
+            response = await retrieval_chain.ainvoke({
                                 "input": question,
                                 })
-            if response and 'answer' in response:
-                return response['answer']
-            
-            return "I apologize, but I couldn't generate a response. The content might be too long or complex."
-        except ValueError as ve:
-            if "max_new_tokens" in str(ve):
-                return "The response would be too long. Could you ask a more specific question?"
-        except WebSocketDisconnect:
-            return "Client disconnected"
-        except Exception as e:
-            return f"Error generating response: {str(e)}"
+        if response and 'answer' in response:
+            remember_answer(question, content_hashes, response['answer'], get_sources(response), vector)
+            return response['answer']
+        
+        return "I apologize, but I couldn't generate a response. The content might be too long or complex."
+    except (QueueFullError, QueueTimeoutError):
+        raise
+    except ValueError as ve:
+        ERRORS.inc(stage="answer")
+        if "max_new_tokens" in str(ve):
+            return "The response would be too long. Could you ask a more specific question?"
+        return f"Error generating response: {str(ve)}"
+    except WebSocketDisconnect:
+        return "Client disconnected"
     except Exception as e:
-        try:
-            
-            # Load PDF content into vector store
-            retriever = create_vector_store(pdf_content)
-            retrieval_chain = create_qa_chain(retriever,backup_groq_api_key)
-    
-            # Generate response using the question and memory context
-            response = retrieval_chain.invoke({
-                                "input": question,
-                                })
-            if response and 'answer' in response:
-                return response['answer']
-            
-            return "I apologize, but I couldn't generate a response. The content might be too long or complex."
-        except ValueError as ve:
-            if "max_new_tokens" in str(ve):
-                return "The response would be too long. Could you ask a more specific question?"
-        except WebSocketDisconnect:
-            return "Client disconnected"
-        except Exception as e:
-            return f"Error generating response: {str(e)}"
\ No newline at end of file
+        ERRORS.inc(stage="answer")
+        return f"Error generating response: {str(e)}"
+
+async def stream_answer_from_model(question, content_hashes, retrieval_chain=None, user_id=None, on_queued=None):
+    """
+    Stream the answer to a question as the chain produces it.
+
+    Yields `("chunk", text)` for every piece of the answer, then a single
+    `("end", {"content": answer, "sources": [...]})` carrying the complete
+    answer and the metadata of the chunks it was retrieved from. Admission
+    works as for `get_answer_from_model`; a question turned away raises
+    before yielding anything.
+    """
+    if not content_hashes:
+        message = "No PDF has been uploaded yet. Please upload a PDF before asking questions."
+        yield "chunk", message
+        yield "end", {"content": message, "sources": []}
+        return
+
+    hit = get_cached_answer(question, content_hashes)
+    if hit is not None:
+        answer, sources = hit
+        yield "chunk", answer
+        yield "end", {"content": answer, "sources": [dict(source) for source in sources]}
+        return
+
+    if QA_BATCH_SIZE > 0:
+        # Sessions asking the same question about the same documents follow
+        # the stream already under way, from its first chunk
+        key = (tuple(sorted(content_hashes)), normalize_question(question))
+        events = get_batchers()["answers"].stream(
+            key,
+            lambda flight: generate_answer_stream(
+                question, content_hashes, retrieval_chain, user_id, flight.notify, flight.clear
+            ),
+            listener=on_queued,
+        )
+    else:
+        events = generate_answer_stream(question, content_hashes, retrieval_chain, user_id, on_queued)
+    async for kind, payload in events:
+        if kind == "end":
+            # Each session gets its own copy to annotate
+            payload = {"content": payload["content"], "sources": [dict(source) for source in payload["sources"]]}
+        yield kind, payload
+
+
+async def generate_answer_stream(question, content_hashes, retrieval_chain=None, user_id=None, on_queued=None, on_admitted=None):
+    answer_parts = []
+    sources = []
+    try:
+        retrieval_chain = retrieval_chain or await run_blocking(get_qa_chain, content_hashes)
+        async with qa_slot(user_id, on_queued):
+            if on_admitted is not None:
+                on_admitted()
+            hit, vector = await lookup_cached_answer(question, content_hashes)
+            if hit is not None:
+                answer, sources = hit
+                yield "chunk", answer
+                yield "end", {"content": answer, "sources": sources}
+                return
+            async for part in retrieval_chain.astream({"input": question}):
+                if "context" in part:
+                    sources = get_sources(part)
+                if part.get("answer"):
+                    answer_parts.append(part["answer"])
+                    yield "chunk", part["answer"]
+        remember_answer(question, content_hashes, "".join(answer_parts), sources, vector)
+    except (QueueFullError, QueueTimeoutError):
+        raise
+    except Exception as e:
+        ERRORS.inc(stage="answer")
+        error = f"Error generating response: {str(e)}"
+        answer_parts.append(error)
+        yield "chunk", error
+
+    yield "end", {"content": "".join(answer_parts), "sources": sources}
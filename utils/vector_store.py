@@ -0,0 +1,213 @@
+"""
+Exact vector search over NumPy matrices, and a vector store built on it.
+
+A document has at most a few thousand chunks, so scoring every chunk is
+cheap: one matrix-vector product gives the cosine similarity of all of
+them (vectors are stored L2-normalised), `argpartition` finds the
+candidates, and MMR picks the final chunks from their pairwise
+similarities, all without an approximate index.
+
+`NumpyVectorStore` keeps each document's vectors as a contiguous float32
+`.npy` file next to a JSON file of its chunks. Files are memory-mapped
+when opened, so loading a document costs a page-in of the rows a search
+touches rather than a parse or a copy, and opened documents stay in an
+LRU cache.
+"""
+
+import json
+import os
+import shutil
+import threading
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from utils.cache import LRUCache
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class DocumentVectors:
+    """The chunks of one document with their vectors as an L2-normalised float32 matrix."""
+
+    def __init__(self, docs, matrix, ids=None):
+        self.docs = docs
+        self.matrix = matrix
+        self.ids = ids
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.zeros((0, 0), dtype=np.float32), [])
+
+    @classmethod
+    def from_store_result(cls, result):
+        """Build from a Chroma `get(...)` result including documents, metadatas and embeddings."""
+        docs = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(result["documents"], result["metadatas"])
+        ]
+        embeddings = result["embeddings"]
+        matrix = normalize_rows(embeddings) if len(embeddings) else np.zeros((0, 0), dtype=np.float32)
+        return cls(docs, matrix, result.get("ids"))
+
+    def __len__(self):
+        return len(self.docs)
+
+
+def top_k(scores, k):
+    """Indices of the `k` highest `scores`, best first."""
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+def mmr_select(query_scores, candidates, k, lambda_mult=0.5):
+    """
+    Maximal marginal relevance over normalised `candidates` with cosine
+    similarities `query_scores` to the query: positions of the `k` chosen
+    candidates, in the order chosen. Each step is one vectorised update
+    of every candidate's similarity to the chunks chosen so far.
+    """
+    k = min(k, len(candidates))
+    if k <= 0:
+        return []
+    similarity = candidates @ candidates.T
+    chosen = [int(np.argmax(query_scores))]
+    redundancy = similarity[chosen[0]].copy()
+    while len(chosen) < k:
+        scores = lambda_mult * query_scores - (1 - lambda_mult) * redundancy
+        scores[chosen] = -np.inf
+        best = int(np.argmax(scores))
+        chosen.append(best)
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return chosen
+
+
+def search_vectors(document_vectors, queries, k, fetch_k=20, lambda_mult=0.5):
+    """
+    Select `k` chunks for each query vector in `queries` among the chunks
+    of `document_vectors`. All queries are scored against each document's
+    matrix in place, without stacking the matrices; then, like Chroma's MMR
+    search, MMR keeps `k` of each query's `fetch_k` most similar chunks,
+    returned in order of similarity.
+    """
+    document_vectors = [vectors for vectors in document_vectors if len(vectors)]
+    if not document_vectors:
+        return [[] for _ in queries]
+    docs = [doc for vectors in document_vectors for doc in vectors.docs]
+    offsets = np.cumsum([0] + [len(vectors) for vectors in document_vectors])
+    queries = normalize_rows(queries)
+    scores = np.hstack([queries @ vectors.matrix.T for vectors in document_vectors])
+
+    def rows(indices):
+        owners = np.searchsorted(offsets, indices, side="right") - 1
+        return np.stack([
+            document_vectors[owner].matrix[index - offsets[owner]] for owner, index in zip(owners, indices)
+        ])
+
+    results = []
+    for row in scores:
+        candidates = top_k(row, fetch_k)
+        chosen = mmr_select(row[candidates], rows(candidates), k, lambda_mult)
+        results.append([
+            Document(page_content=docs[index].page_content, metadata=dict(docs[index].metadata))
+            for index in candidates[sorted(chosen)]
+        ])
+    return results
+
+
+class NumpyVectorStore:
+    """
+    Vectors and chunks of every indexed document, one `.npy` matrix and one
+    JSON file per content hash under `directory`.
+    """
+
+    def __init__(self, directory, embeddings, cache_size=256):
+        self.directory = directory
+        self.embeddings = embeddings
+        self._loaded = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, content_hash)
+
+    def save(self, content_hash, ids, docs, vectors):
+        """Store the chunks `docs` of a document with their `ids` and `vectors`, replacing any stored before."""
+        path = self._path(content_hash)
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        matrix = normalize_rows(vectors) if len(docs) else np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(tmp_path, "vectors.npy"), np.ascontiguousarray(matrix))
+        with open(os.path.join(tmp_path, "chunks.json"), "w") as f:
+            json.dump({
+                "ids": list(ids),
+                "texts": [doc.page_content for doc in docs],
+                "metadatas": [doc.metadata for doc in docs],
+            }, f)
+        with self._lock:
+            self._loaded.pop(content_hash)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+
+    def load(self, content_hash):
+        """Return the `DocumentVectors` of a document, or None if it is not indexed."""
+        vectors = self._loaded.get(content_hash)
+        if vectors is None:
+            with self._lock:
+                path = self._path(content_hash)
+                try:
+                    with open(os.path.join(path, "chunks.json")) as f:
+                        chunks = json.load(f)
+                    matrix = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+                except FileNotFoundError:
+                    return None
+                docs = [
+                    Document(page_content=text, metadata=metadata)
+                    for text, metadata in zip(chunks["texts"], chunks["metadatas"])
+                ]
+                vectors = DocumentVectors(docs, matrix, chunks["ids"])
+                self._loaded.set(content_hash, vectors)
+        return vectors
+
+    def exists(self, content_hash):
+        return content_hash in self._loaded or os.path.exists(os.path.join(self._path(content_hash), "vectors.npy"))
+
+    def delete(self, content_hash):
+        with self._lock:
+            self._loaded.pop(content_hash)
+            shutil.rmtree(self._path(content_hash), ignore_errors=True)
+
+    def search(self, content_hashes, queries, k, fetch_k=20, lambda_mult=0.5):
+        """Select `k` chunks among the documents `content_hashes` for each query vector."""
+        document_vectors = [vectors for vectors in map(self.load, content_hashes) if vectors is not None]
+        return search_vectors(document_vectors, queries, k, fetch_k, lambda_mult)
+
+    def as_retriever(self, content_hashes, k=4, fetch_k=20, lambda_mult=0.5):
+        return NumpyRetriever(store=self, content_hashes=list(content_hashes), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+
+
+class NumpyRetriever(BaseRetriever):
+    """MMR retriever over the documents `content_hashes` of a `NumpyVectorStore`."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    store: Any
+    content_hashes: List[str]
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        vector = self.store.embeddings.embed_query(query)
+        return self.store.search(self.content_hashes, [vector], self.k, self.fetch_k, self.lambda_mult)[0]
@@ -1,86 +1,223 @@
 # Import necessary modules from FastAPI for WebSocket handling
-from fastapi import Depends, WebSocket, WebSocketDisconnect, APIRouter
+from fastapi import WebSocket, WebSocketDisconnect, APIRouter
 
-from sqlalchemy.orm import Session
 # Import UUID module to generate unique session IDs
 import uuid
+import asyncio
+import os
+import time
 # Import the function that will process questions using NLP
-from utils.nlp2 import get_answer_from_model
+from utils.nlp2 import (
+    get_answer_from_model,
+    find_unindexed_documents,
+    get_qa_chain,
+    index_document,
+    run_blocking,
+    stream_answer_from_model,
+)
 
-from database.models import get_pdf_content_for_user  # Add this function to fetch user-specific PDF content
-from database.config import SessionLocal
+from database.models import (
+    get_pdf_documents_for_user_async,
+    get_pdf_pages_by_hash_async,
+    get_unindexed_content_hashes_for_user_async,
+    mark_pdf_documents_indexed_async,
+    replace_pdf_chunks_async,
+)
+from database.config import async_session_scope
+from utils.admission import QueueFullError, QueueTimeoutError
+from utils.metrics import ERRORS, collect_timings, registry, timed
 import json
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-        
-        
 
 
+# Open sessions allowed per worker, and seconds a session may stay silent
+# before it is closed (0 keeps idle sessions open)
+QA_MAX_SESSIONS = int(os.getenv("QA_MAX_SESSIONS", "1000"))
+QA_SESSION_IDLE_TIMEOUT = float(os.getenv("QA_SESSION_IDLE_TIMEOUT", "600"))
+# Close code asking clients to try again later
+TRY_AGAIN_LATER = 1013
+BUSY_MESSAGE = "The server is busy. Please try again in a moment."
+# Close code for a session that cannot be set up
+INTERNAL_ERROR = 1011
+INDEXING_FAILED_MESSAGE = "Your documents could not be prepared for questions. Please try again later."
 
 # Create a new APIRouter instance to handle routing
 router = APIRouter()
 # Dictionary to store active sessions and their associated data
 sessions = {}
+registry.gauge("pdf_qa_active_sessions", "Open question-answer WebSocket sessions.", function=lambda: len(sessions))
+SHED_SESSIONS = registry.counter("pdf_qa_shed_sessions_total", "Sessions refused or closed to shed load.", ["reason"])
+
+
+def timing_breakdown(timings, started_at):
+    # Milliseconds spent per stage, plus the total the client waited
+    breakdown = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+    breakdown["total"] = round((time.perf_counter() - started_at) * 1000, 3)
+    return breakdown
 
 # Define a WebSocket endpoint at "/ws/question-answer"
 @router.websocket("/ws/question-answer")
 async def question_answer_websocket(
     websocket: WebSocket, 
-    user_id: int, 
-    db: Session = Depends(get_db)
+    user_id: int
     ):
     
     # Accept the incoming WebSocket connection
     await websocket.accept()
+
+    # Past the session limit, say so right away instead of queueing the client
+    if len(sessions) >= QA_MAX_SESSIONS:
+        SHED_SESSIONS.inc(reason="capacity")
+        await websocket.send_text(json.dumps({"type": "busy", "content": BUSY_MESSAGE}))
+        await websocket.close(code=TRY_AGAIN_LATER)
+        return
     
-    # Generate a unique session ID for this connection
+    # Generate a unique session ID for this connection, and hold its place
+    # right away so a burst of connections cannot all pass the limit while
+    # their documents are looked up
     session_id = str(uuid.uuid4())
-    
-    
-    # Retrieve only the PDFs uploaded by this user
-    pdf_content = get_pdf_content_for_user(db,user_id=user_id)
+    sessions[session_id] = {"content_hashes": [], "document_ids": {}, "qa_chain": None}
 
+    async def on_queued(position):
+        # Tell the client its question is waiting, and behind how many others
+        await websocket.send_text(json.dumps({"type": "queued", "position": position}))
 
-    
-    # Initialize session data and memory buffer with placeholder PDF content
-    sessions[session_id] = {
-        "pdf_content": pdf_content
-    }
-    
     try:
+        # Retrieve only the PDFs uploaded by this user. Each query gets its own
+        # short-lived session so an open socket does not pin a pooled connection
+        async with async_session_scope() as db:
+            documents = await get_pdf_documents_for_user_async(db, user_id=user_id)
+            unverified = await get_unindexed_content_hashes_for_user_async(db, user_id=user_id)
+        # Identical files share one set of chunks, so map each hash to its document
+        document_ids = {}
+        for document_id, content_hash in documents:
+            document_ids.setdefault(content_hash, document_id)
+        content_hashes = sorted(document_ids)
+
+        # Documents uploaded before indexing existed are embedded once here,
+        # off the event loop so other sockets keep being served, then flagged
+        # so later connections do not look them up in the index again. The
+        # client hears how far along this is, and why the session ends if
+        # it fails
+        if unverified:
+            try:
+                missing = await run_blocking(find_unindexed_documents, unverified)
+                for done, content_hash in enumerate(missing):
+                    await websocket.send_text(json.dumps({"type": "indexing", "done": done, "total": len(missing)}))
+                    async with async_session_scope() as db:
+                        pages = await get_pdf_pages_by_hash_async(db, content_hash)
+                    chunks = await run_blocking(index_document, content_hash, pages)
+                    async with async_session_scope() as db:
+                        await replace_pdf_chunks_async(db, content_hash, chunks)
+                        await db.commit()
+                async with async_session_scope() as db:
+                    await mark_pdf_documents_indexed_async(db, unverified)
+                    await db.commit()
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                print(f"Failed to index documents for user {user_id}: {str(e)}")
+                ERRORS.inc(stage="indexing")
+                await websocket.send_text(json.dumps({"type": "error", "content": INDEXING_FAILED_MESSAGE}))
+                await websocket.close(code=INTERNAL_ERROR)
+                return
+
+        # Build the retrieval chain once per connection; sessions on the same
+        # documents share it through the process-wide chain cache
+        qa_chain = None
+        if content_hashes:
+            try:
+                qa_chain = await run_blocking(get_qa_chain, content_hashes)
+            except Exception as e:
+                print(f"Failed to build QA chain for user {user_id}: {str(e)}")
+
+        # Fill in the session with the user's documents and their ready-to-use chain
+        sessions[session_id].update({
+            "content_hashes": content_hashes,
+            "document_ids": document_ids,
+            "qa_chain": qa_chain
+        })
+
         # Infinite loop to handle continuous message exchange
         while True:
-            # Wait for and receive a question from the client
-            question = await websocket.receive_text()
+            # Wait for and receive a question from the client; silent
+            # sessions are closed so they do not hold resources forever
+            try:
+                question = await asyncio.wait_for(websocket.receive_text(), QA_SESSION_IDLE_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                SHED_SESSIONS.inc(reason="idle")
+                await websocket.close(code=1000, reason="Session idle")
+                break
             
             try:
                 question_data = json.loads(question)
                 question = question_data['content']
             except json.JSONDecodeError:
-                question = question  # Fallback to raw text if not JSON
+                # Fallback to raw text if not JSON
+                question_data = {"type": "question", "content": question}
+
+            # Clients may ask for a breakdown of where the answer's time went
+            with_timings = bool(question_data.get("timings"))
+            started_at = time.perf_counter()
             
-            if question_data["type"] == "question":
-                # Passes both the question and the PDF content associated with this session
-                answer = await get_answer_from_model(
-                        question = question, 
-                        pdf_content = sessions[session_id]["pdf_content"]
-                    
-                        ) # type: ignore
+            try:
+                if question_data["type"] == "question" and question_data.get("stream"):
+                    # Stream the answer as it is generated: one answer_chunk frame
+                    # per token, then answer_end with the full answer and sources
+                    with timed("question"), collect_timings() as timings:
+                        async for kind, payload in stream_answer_from_model(
+                                question = question,
+                                content_hashes = sessions[session_id]["content_hashes"],
+                                retrieval_chain = sessions[session_id]["qa_chain"],
+                                user_id = user_id,
+                                on_queued = on_queued
+                                ):
+                            if kind == "chunk":
+                                await websocket.send_text(
+                                    json.dumps({
+                                        "type": "answer_chunk",
+                                        "content": payload
+                                    }))
+                            else:
+                                # Tell the client which of its documents each source came from
+                                for source in payload["sources"]:
+                                    source["document_id"] = document_ids.get(source.get("content_hash"))
+                                if with_timings:
+                                    payload["timings"] = timing_breakdown(timings, started_at)
+                                await websocket.send_text(
+                                    json.dumps({
+                                        "type": "answer_end",
+                                        **payload
+                                    }))
+
+                elif question_data["type"] == "question":
+                    # Passes both the question and the PDF document associated with this session
+                    with timed("question"), collect_timings() as timings:
+                        answer = await get_answer_from_model(
+                                question = question, 
+                                content_hashes = sessions[session_id]["content_hashes"],
+                                retrieval_chain = sessions[session_id]["qa_chain"],
+                                user_id = user_id,
+                                on_queued = on_queued
+                                ) # type: ignore
                 
-                # Send the answer back to the client
-                await websocket.send_text(
-                    json.dumps({
+                    # Send the answer back to the client
+                    frame = {
                         "type": "answer",
                         "content": answer
-                    }))
+                    }
+                    if with_timings:
+                        frame["timings"] = timing_breakdown(timings, started_at)
+                    await websocket.send_text(json.dumps(frame))
+            except (QueueFullError, QueueTimeoutError):
+                # Overloaded: refuse this question now rather than let it time out
+                await websocket.send_text(json.dumps({"type": "busy", "content": BUSY_MESSAGE}))
     
     except WebSocketDisconnect:
-        # If the client disconnects, clean up by removing their session data
-        del sessions[session_id]
+        pass
     except Exception as e:
-        print(e)
\ No newline at end of file
+        print(e)
+        ERRORS.inc(stage="websocket")
+    finally:
+        # Whatever ends the connection, clean up by removing its session data
+        sessions.pop(session_id, None)